@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+'''Build the parser benchmark fixture corpus from scraped cases.
+
+Pulls a sample of cases per detail_loc from the case details bucket,
+anonymizes them and writes them to benchmarks/fixtures/<detail_loc>/.
+Every value under party, attorney, alias, related person, officer, bond,
+scheduling and warrant sections, and under document and docket history
+sections (which are free text), is scrubbed, except for types, roles and
+numbers. Elsewhere, values of prompts like names, addresses, judges and
+captions are scrubbed. Letters become X, digits 0 and dates 01/01/1970,
+and the real case number is swapped for a synthetic one, so the output can
+be checked in. Review the output before committing it anyway.
+
+    python benchmarks/build_parser_corpus.py --environment production --count 20
+'''
+from bs4 import BeautifulSoup
+import argparse
+import re
+import sys
+import os
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCHMARKS_DIR, '..'))
+FIXTURES_DIR = os.path.join(BENCHMARKS_DIR, 'fixtures')
+
+# Prompts whose values identify a person
+PII_PROMPT = re.compile(r'name|address|street|alias|dob|birth|phone|caption|case description|party|title|attorney|officer|agency'
+    r'|debtor|creditor|judge|company|against|favor|\bby\b|^vs', re.I)
+# Section headings (h5, or h6 within them) under which every value is scrubbed
+PII_SECTION = re.compile(r'defendant|plaintiff|respondent|petitioner|appellant|appellee|part(y|ies)|attorney|alias'
+    r'|related person|officer|complainant|witness|victim|bond|bail|complaint|schedul|warrant|service|document|docket|history', re.I)
+# Prompts whose values are categories or numbers, which parsers may branch on
+KEEP_PROMPT = re.compile(r'type|role|no\.|number', re.I)
+DATE = re.compile(r'\d{2}/\d{2}/\d{4}')
+ISO_DATE = re.compile(r'\d{4}-\d{2}-\d{2}')
+
+def anonymize_value(prompt, value):
+    if DATE.fullmatch(value):
+        return '01/01/1970'
+    elif ISO_DATE.fullmatch(value):
+        return '1970-01-01'
+    elif 'phone' in prompt.lower():
+        return '(000) 000-0000'
+    elif value:
+        # Keeps lengths and punctuation, which parsers may rely on
+        return re.sub(r'\d', '0', re.sub(r'[A-Za-z]', 'X', value))
+    return value
+
+def row_prompt(value):
+    prompt = value.find_previous('span', class_=re.compile('Prompt'))
+    if prompt and prompt.find_parent('tr') is value.find_parent('tr'):
+        return prompt.get_text(strip=True)
+    return ''
+
+def anonymize(case_html, case_number, fake_case_number):
+    soup = BeautifulSoup(case_html, 'html.parser')
+    for prompt in soup.find_all('span', class_=re.compile('Prompt')):
+        prompt_text = prompt.get_text(strip=True)
+        if not PII_PROMPT.search(prompt_text) or KEEP_PROMPT.search(prompt_text):
+            continue
+        values = [prompt.find_next('span', class_='Value')]
+        if prompt_text.lower().startswith('vs'):
+            values.append(prompt.find_previous('span', class_='Value'))  # the other side of a caption
+        for value in values:
+            if value and value.string:
+                value.string.replace_with(anonymize_value(prompt_text, value.string.strip()))
+
+    # Names and addresses also turn up in multi-column tables and free text, so scrub whole sections.
+    # Only values are touched; prompts and headings are what the parsers look for
+    section = subsection = ''
+    for tag in soup.find_all(['h5', 'h6', 'span']):
+        if tag.name == 'h5':
+            section, subsection = tag.get_text(strip=True), ''
+        elif tag.name == 'h6':
+            subsection = tag.get_text(strip=True)
+        elif ('Value' in tag.get('class', []) and (PII_SECTION.search(section) or PII_SECTION.search(subsection))
+                and not KEEP_PROMPT.search(row_prompt(tag))):
+            for string in list(tag.find_all(string=True)):
+                string.replace_with(anonymize_value('', string.strip()))
+    return str(soup).replace(case_number, fake_case_number)
+
+def sample_cases(detail_loc, count):
+    from mjcs.util import db_session
+    from mjcs.models import Case
+    from sqlalchemy import select
+    with db_session() as db:
+        return db.scalars(
+            select(Case.case_number)
+            .where(Case.detail_loc == detail_loc, Case.last_parse != None)
+            .order_by(Case.last_scrape.desc())
+            .limit(count)
+        ).all()
+
+def build(detail_locs, count):
+    from mjcs.parser import fetch_case_details
+    for detail_loc in detail_locs:
+        out_dir = os.path.join(FIXTURES_DIR, detail_loc)
+        os.makedirs(out_dir, exist_ok=True)
+        for i, case_number in enumerate(sample_cases(detail_loc, count)):
+            case_html, _ = fetch_case_details(case_number)
+            fake_case_number = f'{i + 1:0{len(case_number)}d}'
+            with open(os.path.join(out_dir, f'{fake_case_number}.html'), 'w', encoding='utf-8') as f:
+                f.write(anonymize(case_html, case_number, fake_case_number))
+        print(f'Wrote {detail_loc} fixtures to {out_dir}')
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--environment', '--env', default='development',
+        choices=['production', 'development'])
+    parser.add_argument('--profile', '-p',
+        help='AWS named profile to use for credentials (see https://docs.aws.amazon.com/cli/latest/userguide/cli-configure-profiles.html)')
+    parser.add_argument('--type', '-t', action='append',
+        help='Case type to sample (can be repeated, default: every parser type)')
+    parser.add_argument('--count', '-n', type=int, default=20,
+        help='Number of cases to sample per type')
+    args = parser.parse_args()
+
+    from mjcs.config import config
+    from mjcs.parser import parsers
+    config.initialize_from_environment(args.environment, args.profile)
+    build(args.type or list(parsers.keys()), args.count)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+'''Measure how long it takes a fresh interpreter to import Case Harvester modules.
+
+Each module is imported in a new subprocess, the way a Lambda cold start would,
+and the median wall time is reported along with the slowest imports recorded
+by `python -X importtime`. Pass --lambda to simulate the parser Lambda's
+environment, where the config is initialized on import.
+
+    python benchmarks/import_time.py --lambda mjcs.parser parser_lambda
+'''
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+def lambda_env():
+    env = dict(os.environ)
+    env.update({
+        'AWS_LAMBDA_FUNCTION_NAME': 'caseharvester_parser_benchmark',
+        'MJCS_DATABASE_URL': env.get('MJCS_DATABASE_URL', 'postgresql://benchmark@localhost/mjcs'),
+        'CASE_DETAILS_BUCKET': env.get('CASE_DETAILS_BUCKET', 'benchmark'),
+    })
+    return env
+
+def time_import(module, env, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, '-c', f'import {module}'], env=env, check=True)
+        timings.append(time.perf_counter() - start)
+    return timings
+
+def slowest_imports(module, env, count):
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+        env=env, check=True, capture_output=True, text=True)
+    imports = []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        imports.append((int(self_us), int(cumulative_us), name.strip()))
+    # Sorted by self time, so nested imports aren't counted twice
+    return sorted(imports, reverse=True)[:count]
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('modules', nargs='*', default=['mjcs.parser'],
+        help="Modules to import (default: mjcs.parser)")
+    parser.add_argument('--repeat', '-n', type=int, default=10,
+        help="Number of fresh interpreters to time per module")
+    parser.add_argument('--top', type=int, default=10,
+        help="Number of slowest imports (by self time) to list")
+    parser.add_argument('--lambda', dest='lambda_', action='store_true',
+        help="Simulate the Lambda environment (config initialized on import)")
+    args = parser.parse_args()
+
+    env = lambda_env() if args.lambda_ else dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join([ROOT, os.path.join(ROOT, 'lambda', 'parser'), env.get('PYTHONPATH', '')])
+    baseline = statistics.median(time_import('sys', env, args.repeat))
+    print(f'Interpreter startup: {baseline * 1000:.1f} ms')
+    for module in args.modules:
+        timings = time_import(module, env, args.repeat)
+        median = statistics.median(timings)
+        print(f'\n{module}: median {median * 1000:.1f} ms '
+            f'({(median - baseline) * 1000:.1f} ms over startup), '
+            f'min {min(timings) * 1000:.1f} ms, max {max(timings) * 1000:.1f} ms')
+        for self_us, cumulative_us, name in slowest_imports(module, env, args.top):
+            print(f'  {self_us / 1000:8.1f} ms self  {cumulative_us / 1000:8.1f} ms cumulative  {name}')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,289 @@
+#!/usr/bin/env python3
+'''Local stand-in for the MJCS endpoints the spider and scraper use.
+
+Serves a synthetic, deterministic population of cases through the same
+endpoints as Case Search: inquiry-index.jsp and processDisclaimer.jis for
+sessions, inquirySearch.jis (with XML export) for spider searches, and
+inquirySearchParam.jis and inquiryByCaseNum.jis for scrapes. Latency, the
+search row cap, 500 errors, query timeouts and 403s can all be injected.
+
+    python benchmarks/mjcs_standin.py --port 8000 --cases 100000 --latency 0.2 --error-rate 0.01
+
+Then point Case Harvester at it with MJCS_BASE_URL=http://127.0.0.1:8000/casesearch.
+See spider_scraper_loadtest.py to drive the spider and scraper against it.
+'''
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+from datetime import date, datetime, timedelta
+from xml.sax.saxutils import escape
+import threading
+import argparse
+import bisect
+import random
+import string
+import time
+import uuid
+
+COURTS = [
+    ('Baltimore City District Court', 'DV'),
+    ('Montgomery County Circuit Court', 'CC'),
+    ('Prince George\'s County District Court', 'DSCR'),
+    ('Anne Arundel County District Court', 'DSCIVIL'),
+]
+STATUSES = ['ACTIVE', 'CLOSED', 'OPEN', 'INACTIVE']
+
+DISCLAIMER_PAGE = '''<html><body>
+<p>Acceptance of the following agreement is required to use Case Search.</p>
+<form action="processDisclaimer.jis" method="post"><input type="hidden" name="disclaimer" value="Y"></form>
+</body></html>'''
+SEARCH_PAGE = '''<html><body><form action="inquirySearch.jis" method="post">
+<input type="hidden" name="searchtype" value="PERSON"></form></body></html>'''
+NO_RESULTS_PAGE = '''<html><body><span class="error">
+<br>CaseSearch will only display results that match your search criteria.</span></body></html>'''
+TIMEOUT_PAGE = '''<html><body><span class="error">
+<br>Sorry, but your query has timed out after 2 minutes. Please narrow your search.</span></body></html>'''
+
+
+class SyntheticCases:
+    '''A deterministic case population, indexed by party last name'''
+    def __init__(self, count, start_date, end_date, seed=0):
+        rng = random.Random(seed)
+        days = (end_date - start_date).days + 1
+        cases = []
+        for i in range(count):
+            court, detail_loc = COURTS[i % len(COURTS)]
+            filing_date = start_date + timedelta(rng.randrange(days))
+            last_name = ''.join(rng.choice(string.ascii_uppercase) for _ in range(rng.randint(3, 10)))
+            first_name = ''.join(rng.choice(string.ascii_uppercase) for _ in range(rng.randint(3, 8)))
+            cases.append({
+                'case_number': f'{detail_loc[0]}{filing_date.year}{i:07d}',
+                'name': f'{last_name}, {first_name}',
+                'court': court,
+                'case_type': detail_loc,
+                'status': STATUSES[i % len(STATUSES)],
+                'filing_date': filing_date,
+                'caption': f'State of Maryland vs. {first_name} {last_name}',
+            })
+        cases.sort(key=lambda case: case['name'])
+        self.cases = cases
+        self.names = [case['name'] for case in cases]
+        self.by_case_number = {case['case_number']: case for case in cases}
+
+    def search(self, prefix, filing_start, filing_end):
+        i = bisect.bisect_left(self.names, prefix)
+        j = bisect.bisect_left(self.names, prefix + '\uffff')
+        return [case for case in self.cases[i:j] if filing_start <= case['filing_date'] <= filing_end]
+
+
+class StandIn:
+    '''Shared state and fault injection settings for the request handlers'''
+    def __init__(self, cases, latency=0, row_cap=500, error_rate=0, timeout_rate=0, forbidden_rate=0,
+            session_ttl=1800, seed=0):
+        self.cases = cases
+        self.latency = latency # mean seconds per response
+        self.row_cap = row_cap
+        self.error_rate = error_rate
+        self.timeout_rate = timeout_rate
+        self.forbidden_rate = forbidden_rate
+        self.session_ttl = session_ttl # seconds
+        self.rng = random.Random(seed)
+        self.sessions = {}
+        self.lock = threading.Lock()
+        self.counts = {}
+
+    def count(self, name):
+        with self.lock:
+            self.counts[name] = self.counts.get(name, 0) + 1
+
+    def roll(self, rate):
+        with self.lock:
+            return self.rng.random() < rate
+
+    def valid_session(self, session_id):
+        with self.lock:
+            expires = self.sessions.get(session_id)
+            return expires and expires > time.monotonic()
+
+    def new_session(self):
+        session_id = uuid.uuid4().hex
+        with self.lock:
+            self.sessions[session_id] = time.monotonic() + self.session_ttl
+        return session_id
+
+
+def case_xml(cases):
+    fields = ['case_number', 'name', None, None, 'court', 'case_type', 'status', 'filing_date', 'caption']
+    rows = []
+    for case in cases:
+        values = []
+        for field in fields:
+            value = case.get(field) if field else ''
+            if isinstance(value, date):
+                value = value.strftime('%m/%d/%Y')
+            values.append(f'<field>{escape(value)}</field>')
+        rows.append(f"<row>{''.join(values)}</row>")
+    return f"<?xml version=\"1.0\" encoding=\"UTF-8\"?><table>{''.join(rows)}</table>"
+
+def case_html(case):
+    # Long enough to pass the scraper's length check, with the case number formatted like MJCS does
+    rows = ''.join(
+        f'<tr><td><span class="FirstColumnPrompt">{prompt}:</span></td><td><span class="Value">{escape(str(value))}</span></td></tr>'
+        for prompt, value in [
+            ('Case Number', case['case_number']),
+            ('Court System', case['court']),
+            ('Case Type', case['case_type']),
+            ('Case Status', case['status']),
+            ('Filing Date', case['filing_date'].strftime('%m/%d/%Y')),
+            ('Title', case['caption']),
+            ('Name', case['name']),
+        ]
+    )
+    return f'''<html><head><title>Case Information</title></head><body>
+<h5>Case Information</h5><table>{rows}</table>
+<p>{'This is a synthetic case generated for load testing. ' * 20}</p>
+</body></html>'''
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    standin = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def respond(self, status, body='', content_type='text/html;charset=UTF-8', headers=None):
+        body = body.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def session_id(self):
+        for cookie in self.headers.get('Cookie', '').split(';'):
+            name, _, value = cookie.strip().partition('=')
+            if name == 'JSESSIONID':
+                return value
+
+    def read_form(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        form = parse_qs(self.rfile.read(length).decode('utf-8'))
+        return {name: values[0] for name, values in form.items()}
+
+    def handle_request(self, method):
+        standin = self.standin
+        path = urlparse(self.path).path
+        endpoint = path.rsplit('/', 1)[-1]
+        form = self.read_form() if method == 'POST' else {}
+        standin.count('requests')
+        if standin.latency:
+            time.sleep(random.expovariate(1 / standin.latency))
+
+        if endpoint == 'inquiry-index.jsp':
+            return self.respond(200, DISCLAIMER_PAGE)
+        elif endpoint == 'processDisclaimer.jis':
+            if form.get('disclaimer') != 'Y':
+                return self.respond(200, DISCLAIMER_PAGE)
+            standin.count('sessions')
+            return self.respond(200, SEARCH_PAGE, headers={
+                'Set-Cookie': f'JSESSIONID={standin.new_session()}; Path=/'
+            })
+        elif endpoint not in ('inquirySearch.jis', 'inquirySearchParam.jis', 'inquiryByCaseNum.jis'):
+            return self.respond(404, 'Not found')
+
+        if not standin.valid_session(self.session_id()):
+            standin.count('redirects')
+            base = path[:-len(endpoint)]
+            return self.respond(302, headers={'Location': f'http://{self.headers["Host"]}{base}inquiry-index.jsp'})
+        if standin.roll(standin.forbidden_rate):
+            standin.count('403')
+            return self.respond(403, 'Forbidden')
+        if method == 'GET':
+            return self.respond(200, SEARCH_PAGE)
+        if standin.roll(standin.error_rate):
+            standin.count('500')
+            return self.respond(500, 'Internal Server Error')
+        if standin.roll(standin.timeout_rate):
+            standin.count('timeouts')
+            return self.respond(200, TIMEOUT_PAGE)
+
+        if endpoint == 'inquirySearch.jis':
+            standin.count('searches')
+            try:
+                prefix = form['lastName'].rstrip('%')
+                filing_start = datetime.strptime(form['filingStart'], '%m/%d/%Y').date()
+                filing_end = datetime.strptime(form['filingEnd'], '%m/%d/%Y').date()
+            except (KeyError, ValueError):
+                return self.respond(200, NO_RESULTS_PAGE)
+            results = standin.cases.search(prefix, filing_start, filing_end)[:standin.row_cap]
+            if not results:
+                return self.respond(200, NO_RESULTS_PAGE)
+            return self.respond(200, case_xml(results), content_type='application/xml;charset=UTF-8')
+        else:
+            standin.count('case_details')
+            case = standin.cases.by_case_number.get(form.get('caseId'))
+            if not case:
+                return self.respond(200, NO_RESULTS_PAGE)
+            return self.respond(200, case_html(case))
+
+    def do_GET(self):
+        self.handle_request('GET')
+
+    def do_POST(self):
+        self.handle_request('POST')
+
+def serve(standin, host='127.0.0.1', port=0):
+    '''Start the stand-in in a background thread and return the server (see server.server_address)'''
+    handler = type('StandInHandler', (Handler,), {'standin': standin})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def add_standin_arguments(parser):
+    parser.add_argument('--cases', type=int, default=100000,
+        help='Number of synthetic cases')
+    parser.add_argument('--start-date', type=lambda s: datetime.strptime(s, '%Y-%m-%d').date(), default=date(2020, 1, 1),
+        help='First filing date of the synthetic cases (YYYY-MM-DD)')
+    parser.add_argument('--end-date', type=lambda s: datetime.strptime(s, '%Y-%m-%d').date(), default=date(2020, 3, 31),
+        help='Last filing date of the synthetic cases (YYYY-MM-DD)')
+    parser.add_argument('--latency', type=float, default=0,
+        help='Mean response latency in seconds (exponentially distributed)')
+    parser.add_argument('--row-cap', type=int, default=500,
+        help='Maximum rows returned by a search (run the spider with the same SPIDER_ROW_CAP)')
+    parser.add_argument('--error-rate', type=float, default=0,
+        help='Fraction of searches and scrapes that return a 500')
+    parser.add_argument('--timeout-rate', type=float, default=0,
+        help='Fraction of searches and scrapes that return a query timeout page')
+    parser.add_argument('--forbidden-rate', type=float, default=0,
+        help='Fraction of requests that return a 403')
+    parser.add_argument('--session-ttl', type=int, default=1800,
+        help='Seconds before a session expires')
+    parser.add_argument('--seed', type=int, default=0)
+
+def standin_from_args(args):
+    cases = SyntheticCases(args.cases, args.start_date, args.end_date, args.seed)
+    return StandIn(cases, args.latency, args.row_cap, args.error_rate, args.timeout_rate,
+        args.forbidden_rate, args.session_ttl, args.seed)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    add_standin_arguments(parser)
+    args = parser.parse_args()
+
+    standin = standin_from_args(args)
+    server = serve(standin, args.host, args.port)
+    print(f'Serving {args.cases} synthetic cases at http://{args.host}:{server.server_address[1]}/casesearch')
+    try:
+        while True:
+            time.sleep(60)
+            print(standin.counts)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+'''Benchmark parser throughput against the HTML fixture corpus.
+
+Fixtures live in benchmarks/fixtures/<detail_loc>/<case_number>.html (see
+build_parser_corpus.py). Each case type is benchmarked in a fresh worker
+process, and cases/sec, p50/p95 parse latency and peak RSS are reported.
+
+By default parsed rows go to an in-memory stand-in for the database (the
+offline parse session), which doesn't touch the database at all. With
+--database-url the parsers write to a real (local) Postgres database
+instead, and every statement executed on its connections is counted to
+report statements per case. The baseline keeps results for each mode
+separately, and runs are only compared against the same mode.
+
+    python benchmarks/parser_throughput.py --save-baseline
+    python benchmarks/parser_throughput.py --database-url postgresql://localhost/mjcs_bench --save-baseline
+    python benchmarks/parser_throughput.py --type DV --fail-threshold 10
+'''
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+import multiprocessing
+import statistics
+import argparse
+import resource
+import json
+import time
+import glob
+import sys
+import os
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCHMARKS_DIR, '..'))
+FIXTURES_DIR = os.path.join(BENCHMARKS_DIR, 'fixtures')
+DEFAULT_BASELINE = os.path.join(BENCHMARKS_DIR, 'parser_baseline.json')
+
+def load_fixtures(detail_loc):
+    fixtures = []
+    for path in sorted(glob.glob(os.path.join(FIXTURES_DIR, detail_loc, '*.html'))):
+        with open(path, encoding='utf-8') as f:
+            fixtures.append((os.path.basename(path)[:-len('.html')], f.read()))
+    return fixtures
+
+def fixture_types():
+    return sorted(d for d in os.listdir(FIXTURES_DIR) if glob.glob(os.path.join(FIXTURES_DIR, d, '*.html')))
+
+
+class StandInWriter:
+    '''Discards parsed rows instead of writing them anywhere'''
+    def __init__(self):
+        self.ids = {}
+
+    def next_id(self, table_name):
+        self.ids[table_name] = self.ids.get(table_name, 0) + 1
+        return self.ids[table_name]
+
+    def write(self, detail_loc, table, rows):
+        pass
+
+def stand_in_session(writer, case_numbers):
+    from mjcs.parser.offline import OfflineSession
+    # Fixtures have no previous scrape versions
+    previous_versions = {case_number: [] for case_number in case_numbers}
+
+    @contextmanager
+    def session():
+        db = OfflineSession(writer, previous_versions)
+        yield db
+        db.commit()
+    return session
+
+def database_session(database_url):
+    from mjcs.config import config
+    from mjcs.util import db_session
+    from mjcs.models.common import TableBase
+    from mjcs import models
+    from sqlalchemy import event
+    os.environ['MJCS_DATABASE_URL'] = database_url
+    config.initialize_from_environment()
+    models.load_all()
+    TableBase.metadata.create_all(config.db_engine)
+    counter = {'statements': 0}
+    @event.listens_for(config.db_engine, 'before_cursor_execute')
+    def count(conn, cursor, statement, parameters, context, executemany):
+        counter['statements'] += 1
+    return db_session, counter
+
+def ensure_cases(fixtures, detail_loc):
+    from mjcs.util import db_session
+    from mjcs.models import Case
+    from sqlalchemy.dialects.postgresql import insert
+    with db_session() as db:
+        db.execute(insert(Case).values([
+            {'case_number': case_number, 'detail_loc': detail_loc} for case_number, _ in fixtures
+        ]).on_conflict_do_nothing())
+
+def benchmark_type(detail_loc, iterations, database_url=None):
+    from mjcs.parser import parsers
+    fixtures = load_fixtures(detail_loc)
+    parser = parsers[detail_loc]
+
+    if database_url:
+        session, counter = database_session(database_url)
+        ensure_cases(fixtures, detail_loc)
+        count_statements = lambda: counter['statements']
+    else:
+        session = stand_in_session(StandInWriter(), [case_number for case_number, _ in fixtures])
+        count_statements = None
+
+    # Warm up, so imports and mapper configuration aren't measured
+    for case_number, html in fixtures:
+        parser(case_number, html).parse(session)
+
+    latencies = []
+    statements_before = count_statements() if count_statements else 0
+    for _ in range(iterations):
+        for case_number, html in fixtures:
+            start = time.perf_counter()
+            parser(case_number, html).parse(session)
+            latencies.append(time.perf_counter() - start)
+
+    quantiles = statistics.quantiles(latencies, n=20, method='inclusive') if len(latencies) > 1 else latencies * 19
+    return {
+        'fixtures': len(fixtures),
+        'cases': len(latencies),
+        'cases_per_sec': len(latencies) / sum(latencies),
+        'p50_ms': statistics.median(latencies) * 1000,
+        'p95_ms': quantiles[18] * 1000,
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        'statements_per_case': (count_statements() - statements_before) / len(latencies) if count_statements else None,
+    }
+
+def run(detail_locs, iterations, database_url=None):
+    results = {}
+    for detail_loc in detail_locs:
+        # A fresh process per case type, so peak RSS is attributable to that type
+        with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('fork')) as executor:
+            results[detail_loc] = executor.submit(benchmark_type, detail_loc, iterations, database_url).result()
+    return results
+
+def pct_change(new, old):
+    return (new - old) / old * 100 if old else 0
+
+def report(results, baseline=None):
+    print(f"{'type':<10}{'cases':>7}{'cases/s':>10}{'p50 ms':>9}{'p95 ms':>9}{'rss MB':>9}{'stmts':>8}")
+    regressions = {}
+    for detail_loc, r in results.items():
+        statements = '-' if r['statements_per_case'] is None else f"{r['statements_per_case']:.1f}"
+        line = (f"{detail_loc:<10}{r['cases']:>7}{r['cases_per_sec']:>10.1f}{r['p50_ms']:>9.2f}"
+            f"{r['p95_ms']:>9.2f}{r['peak_rss_mb']:>9.1f}{statements:>8}")
+        if baseline and detail_loc in baseline:
+            b = baseline[detail_loc]
+            change = pct_change(r['cases_per_sec'], b['cases_per_sec'])
+            p95_change = pct_change(r['p95_ms'], b['p95_ms'])
+            line += f'   throughput {change:+.1f}%, p95 {p95_change:+.1f}%'
+            regressions[detail_loc] = -change
+            if r['statements_per_case'] is not None and b.get('statements_per_case') is not None:
+                statements_change = pct_change(r['statements_per_case'], b['statements_per_case'])
+                line += f', stmts {statements_change:+.1f}%'
+                regressions[detail_loc] = max(regressions[detail_loc], statements_change)
+            line += ' vs baseline'
+        print(line)
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--type', '-t', action='append',
+        help="Case type to benchmark (can be repeated, default: every type with fixtures)")
+    parser.add_argument('--iterations', '-n', type=int, default=20,
+        help="Number of passes over each type's fixtures")
+    parser.add_argument('--database-url',
+        help="Parse into this Postgres database instead of the in-memory stand-in")
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE,
+        help="Baseline results to compare against")
+    parser.add_argument('--save-baseline', action='store_true',
+        help="Save these results as the new baseline")
+    parser.add_argument('--fail-threshold', type=float,
+        help="Exit with an error if throughput drops, or statements per case rise, by more than this percentage")
+    args = parser.parse_args()
+
+    mode = 'database' if args.database_url else 'stand-in'
+    results = run(args.type or fixture_types(), args.iterations, args.database_url)
+    baselines = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baselines = json.load(f)
+    regressions = report(results, None if args.save_baseline else baselines.get(mode))
+
+    if args.save_baseline:
+        baselines[mode] = {**baselines.get(mode, {}), **results}
+        with open(args.baseline, 'w') as f:
+            json.dump(baselines, f, indent=2, sort_keys=True)
+        print(f'Saved {mode} baseline to {args.baseline}')
+    if args.fail_threshold is not None:
+        failed = [loc for loc, drop in regressions.items() if drop > args.fail_threshold]
+        if failed:
+            print(f"Regressed more than {args.fail_threshold}% against the {mode} baseline for {', '.join(failed)}")
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
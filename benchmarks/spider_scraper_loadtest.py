@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+'''Load test the spider and scraper against the local MJCS stand-in.
+
+Starts mjcs_standin.py in this process, then runs the real spider and
+scraper code over the stand-in's filing date range with the
+single-process pipeline (no parsing). Queues are in memory, case details
+go to an in-memory stand-in for the S3 bucket, and cases and scrapes are
+written to the (local, disposable) Postgres database given with
+--database-url. Reports requests/sec, cases/sec and what the stand-in
+served.
+
+    python benchmarks/spider_scraper_loadtest.py --database-url postgresql://localhost/mjcs_loadtest \\
+        --cases 50000 --latency 0.05 --error-rate 0.01 --row-cap 200
+'''
+from datetime import datetime
+import argparse
+import logging
+import time
+import uuid
+import sys
+import os
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCHMARKS_DIR, '..'))
+from mjcs_standin import serve, add_standin_arguments, standin_from_args
+
+
+class StandInBucket:
+    '''Keeps case details in memory instead of S3'''
+    def __init__(self):
+        self.objects = {}
+
+    def put_object(self, Body, Key, Metadata=None):
+        version_id = uuid.uuid4().hex
+        self.objects[Key] = (Body, Metadata)
+        return type('StandInObject', (), {'version_id': version_id})()
+
+def configure(args, base_url):
+    os.environ.update({
+        'MJCS_DATABASE_URL': args.database_url,
+        'MJCS_BASE_URL': base_url,
+        'MJCS_TARGET_RATE': str(args.rate),
+        'SPIDER_ROW_CAP': str(args.row_cap),
+        'QUEUE_BACKEND': 'memory',
+        'CASE_DETAILS_BUCKET': 'standin',
+    })
+    from mjcs.config import config, Config
+    from mjcs.models.common import TableBase
+    from mjcs import models
+    config.initialize_from_environment()
+    if not args.verbose:
+        logging.getLogger('mjcs').setLevel(logging.WARNING)
+    models.load_all()
+    TableBase.metadata.create_all(config.db_engine)
+    bucket = StandInBucket()
+    Config.case_details_bucket = property(lambda self: bucket)
+    return bucket
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--database-url', required=True,
+        help='Postgres database to write cases and scrapes to (tables are created if needed)')
+    parser.add_argument('--spider-workers', type=int, default=4)
+    parser.add_argument('--scraper-workers', type=int, default=8)
+    parser.add_argument('--rate', type=float, default=0,
+        help='MJCS_TARGET_RATE for the rate governor (default: unlimited)')
+    parser.add_argument('--verbose', '-v', action='store_true')
+    add_standin_arguments(parser)
+    args = parser.parse_args()
+
+    standin = standin_from_args(args)
+    server = serve(standin)
+    bucket = configure(args, f'http://127.0.0.1:{server.server_address[1]}/casesearch')
+
+    from mjcs.pipeline import Pipeline
+    from mjcs.session import RequestTimeout, Forbidden
+    pipeline = Pipeline(args.spider_workers, args.scraper_workers, parse=False)
+    start = time.perf_counter()
+    try:
+        pipeline.run(datetime.combine(args.start_date, datetime.min.time()),
+            datetime.combine(args.end_date, datetime.min.time()))
+    except (RequestTimeout, Forbidden) as e:
+        print(f'Pipeline stopped early by {type(e).__name__}')
+    elapsed = time.perf_counter() - start
+    server.shutdown()
+
+    requests = standin.counts.get('requests', 0)
+    print(f'{elapsed:.1f}s: {requests / elapsed:.1f} requests/s, '
+        f'{pipeline.new_cases / elapsed:.1f} new cases/s, {pipeline.scraped / elapsed:.1f} scraped cases/s')
+    print(f'Spider: {pipeline.queries} queries, {pipeline.new_cases} of {args.cases} cases found')
+    print(f'Scraper: {pipeline.scraped} scraped, {len(bucket.objects)} stored, {pipeline.failed} failed searches and scrapes')
+    print('Stand-in: ' + ', '.join(f'{name}={count}' for name, count in sorted(standin.counts.items())))
+
+if __name__ == '__main__':
+    main()
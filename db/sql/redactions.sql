@@ -1,5 +1,6 @@
 -- executed as mjcs_user connected to mjcs database
 -- assumes the following role is already created: mjcs_ro_redacted
+-- harvester redacted --create {view,materialized,table} regenerates these from the models' redacted columns
 
 GRANT SELECT ON ALL TABLES IN SCHEMA public, redacted TO mjcs_ro_redacted;
 
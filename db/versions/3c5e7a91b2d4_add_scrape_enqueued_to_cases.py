@@ -0,0 +1,24 @@
+"""Add scrape_enqueued to cases
+
+Revision ID: 3c5e7a91b2d4
+Revises: d79a86c541b0
+Create Date: 2026-10-19 10:12:31.482913
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3c5e7a91b2d4'
+down_revision = 'd79a86c541b0'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('cases', sa.Column('scrape_enqueued', sa.DateTime(), nullable=True))
+
+
+def downgrade():
+    op.drop_column('cases', 'scrape_enqueued')
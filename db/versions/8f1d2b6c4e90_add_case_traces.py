@@ -0,0 +1,34 @@
+"""Add case_traces
+
+Revision ID: 8f1d2b6c4e90
+Revises: 3c5e7a91b2d4
+Create Date: 2026-10-19 14:03:52.118402
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8f1d2b6c4e90'
+down_revision = '3c5e7a91b2d4'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('case_traces',
+        sa.Column('case_number', sa.String(), nullable=False),
+        sa.Column('discovered', sa.DateTime(), nullable=True),
+        sa.Column('enqueued', sa.DateTime(), nullable=True),
+        sa.Column('scraped', sa.DateTime(), nullable=True),
+        sa.Column('parsed', sa.DateTime(), nullable=True),
+        sa.ForeignKeyConstraint(['case_number'], ['cases.case_number'], ondelete='CASCADE'),
+        sa.PrimaryKeyConstraint('case_number')
+    )
+    op.create_index('ix_case_traces_scraped', 'case_traces', ['scraped'])
+
+
+def downgrade():
+    op.drop_index('ix_case_traces_scraped', table_name='case_traces')
+    op.drop_table('case_traces')
@@ -0,0 +1,37 @@
+"""Add case_changes
+
+Revision ID: b47e0c9a3d15
+Revises: 8f1d2b6c4e90
+Create Date: 2026-10-19 16:27:09.530871
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b47e0c9a3d15'
+down_revision = '8f1d2b6c4e90'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('case_changes',
+        sa.Column('seq', sa.BigInteger(), nullable=False),
+        sa.Column('xid', sa.BigInteger(), server_default=sa.text('txid_current()'), nullable=False),
+        sa.Column('case_number', sa.String(), nullable=False),
+        sa.Column('detail_loc', sa.String(), nullable=True),
+        sa.Column('last_parse', sa.DateTime(), nullable=True),
+        sa.Column('content_hash', sa.String(), nullable=True),
+        sa.Column('recorded', sa.DateTime(), server_default=sa.text('now()'), nullable=False),
+        sa.PrimaryKeyConstraint('seq')
+    )
+    op.create_index('ix_case_changes_case_number', 'case_changes', ['case_number'])
+    op.create_index('ix_case_changes_xid_seq', 'case_changes', ['xid', 'seq'])
+
+
+def downgrade():
+    op.drop_index('ix_case_changes_xid_seq', table_name='case_changes')
+    op.drop_index('ix_case_changes_case_number', table_name='case_changes')
+    op.drop_table('case_changes')
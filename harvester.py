@@ -5,7 +5,7 @@ from mjcs.models.common import TableBase
 from mjcs.spider import generate_spider_slices, Spider
 from mjcs.scraper import Scraper, RequestTimeout, Forbidden
 from mjcs.parser import Parser
-from mjcs.util import db_session, get_case_model_list
+from mjcs.util import db_session, get_case_model_list, JSONDatetimeEncoder
 from mjcs.collector import MDECCollector, BaltCityCollector
 import boto3
 from datetime import datetime, timedelta
@@ -137,6 +137,7 @@ def write_env_file(env_long, env_short, exports, db_name, username, password):
 
 def create_tables():
     print("Creating all tables")
+    models.load_all()
     TableBase.metadata.create_all(config.db_engine)
 
 def valid_date(s):
@@ -196,22 +197,81 @@ def run_scraper(args):
         raise Exception("Must specify --case, --from-queue, --stale, or --stale-count.")
 
 def run_parser(args):
-    parser = Parser(args.ignore_errors, args.parallel)
+    parser = Parser(args.ignore_errors, args.parallel, args.output_dir, args.output_format)
 
     if args.failed_queue:
         parser.parse_from_queue(config.parser_failed_queue)
     elif args.queue:
-        parser.parse_from_queue(config.parser_queue, parse_as=args.type)
+        parser.parse_from_queue(config.parser_queue, parse_as=args.type, failed_queue=config.parser_failed_queue)
     elif args.case:
         parser.parse_case(args.case, parse_as=args.type)
     elif args.unparsed:
-        parser.parse_unparsed(args.type)
+        parser.parse_unparsed(args.type, args.local, args.checkpoint)
     elif args.stale:
-        parser.parse_stale(args.type)
+        parser.parse_stale(args.type, args.local, args.checkpoint)
     elif args.reparse:
-        parser.reparse(args.type)
+        parser.reparse(args.type, args.local, args.checkpoint)
+
+def run_pipeline(args):
+    from mjcs.pipeline import Pipeline
+    pipeline = Pipeline(args.spider_workers, args.scraper_workers, args.parser_workers, args.queue_size, not args.no_parse)
+    try:
+        pipeline.run(args.start_date, args.end_date, args.court, args.site)
+    except (RequestTimeout, Forbidden) as e:
+        logger.warning(f'Caught {type(e).__name__} error: {e}')
+
+def run_load_parsed(args):
+    from mjcs.parser.offline import load_parsed_output
+    load_parsed_output(args.input_dir)
+
+def print_changes(args):
+    from mjcs.changes import iter_changes
+    count = 0
+    for change in iter_changes(args.after):
+        print(json.dumps(change, cls=JSONDatetimeEncoder))
+        count += 1
+        if args.limit and count >= args.limit:
+            break
+
+def run_freshness_report(args):
+    from mjcs.trace import freshness_report
+    since = datetime.now() - timedelta(days=args.days)
+    with db_session() as db:
+        report = freshness_report(db, since)
+    print(f'Case freshness for traces scraped in the last {args.days} days:')
+    print(f"{'stage':<24}{'cases':>10}{'p50':>12}{'p95':>12}")
+    fmt = lambda seconds: '-' if seconds is None else str(timedelta(seconds=round(seconds)))
+    for start, end, count, p50, p95 in report:
+        print(f"{f'{start} -> {end}':<24}{count:>10}{fmt(p50):>12}{fmt(p95):>12}")
+
+def print_case_documents(args):
+    from mjcs.documents import case_documents
+    case_numbers = list(args.case_numbers)
+    if args.input_file:
+        case_numbers += [line.strip() for line in args.input_file if line.strip()]
+    indent = 2 if len(case_numbers) == 1 else None # JSON lines for several cases
+    for i in range(0, len(case_numbers), config.CASE_BATCH_SIZE):
+        batch = case_numbers[i:i + config.CASE_BATCH_SIZE]
+        with db_session() as db:
+            documents = case_documents(db, batch, args.redacted)
+        for case_number in batch:
+            if case_number in documents:
+                print(json.dumps(documents[case_number], indent=indent))
+            else:
+                logger.warning(f'Case {case_number} not found')
+
+def run_redacted(args):
+    from mjcs.redaction import create_redacted, refresh_redacted
+    if args.create:
+        create_redacted(args.create)
+    else:
+        refresh_redacted()
 
 def export_tables(args):
+    if args.output_dir:
+        from mjcs.export import export_tables as export_local
+        export_local(args.output_dir, args.output_format, args.incremental, args.redacted, args.workers, args.table)
+        return
     case_models = get_case_model_list(models)
     with db_session() as db:
         for model in case_models:
@@ -264,6 +324,8 @@ if __name__ == '__main__':
         https://docs.aws.amazon.com/cli/latest/userguide/cli-multiple-profiles.html)")
     parser.add_argument('--log-file', help="Log to file")
     parser.add_argument('--cloudwatch', help="Log to the given AWS CloudWatch log group")
+    parser.add_argument('--metrics-port', type=int,
+        help="Serve request and scrape metrics in Prometheus text format on this port (at /metrics)")
     subparsers = parser.add_subparsers(title='Commands')
 
     parser_spider = subparsers.add_parser('spider',
@@ -343,12 +405,92 @@ if __name__ == '__main__':
             specifying --type), loading them into the parser queue")
     parser_parser.add_argument('--reparse', '-r', action='store_true',
         help="Reparse all or a specific type (using --type) of case, loading them into the parser queue")
+    parser_parser.add_argument('--local', '-l', action='store_true',
+        help="With --unparsed, --stale, or --reparse, stream cases straight from the \
+            database to local workers instead of loading them into the parser queue")
+    parser_parser.add_argument('--checkpoint',
+        help="With --local, record progress in this file and resume from it if it exists")
+    parser_parser.add_argument('--output-dir', '-o',
+        help="Write parsed rows to files in this directory, partitioned by case type, \
+            instead of the database (load them afterwards with load-parsed)")
+    parser_parser.add_argument('--output-format', choices=['csv', 'parquet'], default='csv',
+        help="File format for --output-dir (parquet requires pyarrow)")
     parser_parser.set_defaults(func=run_parser)
 
+    parser_pipeline = subparsers.add_parser('pipeline',
+        help="Spider, scrape and parse a search range in a single process, without going through SQS")
+    parser_pipeline.add_argument('--start-date','-s', type=valid_date, required=True,
+        help="Start date for search range. --end-date defaults to today if not specified")
+    parser_pipeline.add_argument('--end-date','-e', type=valid_date,
+        help="End date for search range (optional)")
+    parser_pipeline.add_argument('--court',
+        help="What court to search, e.g. BALTIMORE CITY")
+    parser_pipeline.add_argument('--site', choices=['CRIMINAL', 'CIVIL', 'TRAFFIC', 'CP'],
+        help="What venues to search, criminal/civil/traffic/civil citation")
+    parser_pipeline.add_argument('--spider-workers', type=int, default=4,
+        help="Number of concurrent searches")
+    parser_pipeline.add_argument('--scraper-workers', type=int, default=8,
+        help="Number of concurrent scrapes")
+    parser_pipeline.add_argument('--parser-workers', type=int, default=2,
+        help="Number of parser threads")
+    parser_pipeline.add_argument('--queue-size', type=int, default=1000,
+        help="Maximum number of cases waiting between stages before upstream stages block")
+    parser_pipeline.add_argument('--no-parse', action='store_true',
+        help="Only spider and scrape")
+    parser_pipeline.add_argument('--verbose', '-v', action='store_true',
+        help="Print debug information")
+    parser_pipeline.set_defaults(func=run_pipeline)
+
+    parser_load_parsed = subparsers.add_parser('load-parsed',
+        help="Bulk load files written by parser --output-dir into the database")
+    parser_load_parsed.add_argument('--input-dir', '-i', required=True,
+        help="Directory written by parser --output-dir")
+    parser_load_parsed.set_defaults(func=run_load_parsed)
+
+    parser_changes = subparsers.add_parser('changes',
+        help="Print the change feed of parsed cases as JSON lines, in feed order")
+    parser_changes.add_argument('--after', type=lambda s: tuple(int(part) for part in s.split(':')), default=(0, 0),
+        metavar='XID:SEQ', help="Only print changes after this position (the xid and seq of the last change seen)")
+    parser_changes.add_argument('--limit', '-n', type=int,
+        help="Stop after this many changes")
+    parser_changes.set_defaults(func=print_changes)
+
+    parser_freshness = subparsers.add_parser('freshness',
+        help="Report p50/p95 latency between discovery, scraping and parsing of cases")
+    parser_freshness.add_argument('--days', '-d', type=int, default=7,
+        help="Only include cases scraped in this many past days")
+    parser_freshness.set_defaults(func=run_freshness_report)
+
+    parser_case = subparsers.add_parser('case',
+        help="Print cases with all their related tables as JSON (one line per case when there are several)")
+    parser_case.add_argument('case_numbers', nargs='*', metavar='case_number')
+    parser_case.add_argument('--input-file', '-i', type=argparse.FileType('r'),
+        help="File with one case number per line")
+    parser_case.add_argument('--redacted', '-r', action='store_true',
+        help="Leave out redacted columns")
+    parser_case.set_defaults(func=print_case_documents)
+
+    parser_redacted = subparsers.add_parser('redacted',
+        help="Refresh redacted materialized views and tables from the change feed")
+    parser_redacted.add_argument('--create', choices=['view', 'materialized', 'table'],
+        help="Instead, (re)create the redacted schema from the models' redacted columns as views, "
+            "materialized views or tables")
+    parser_redacted.set_defaults(func=run_redacted)
+
     parser_export_tables = subparsers.add_parser('export-tables',
         help='Export all case-related tables to S3')
     parser_export_tables.add_argument('--redacted', '-r', action='store_true',
         help="Export only non-redacted columns and tables")
+    parser_export_tables.add_argument('--output-dir', '-o',
+        help="Export to local files in this directory instead of S3")
+    parser_export_tables.add_argument('--output-format', choices=['csv', 'parquet'], default='csv',
+        help="File format for --output-dir (parquet requires pyarrow)")
+    parser_export_tables.add_argument('--incremental', action='store_true',
+        help="Only export cases parsed since the last export to --output-dir")
+    parser_export_tables.add_argument('--workers', type=int, default=4,
+        help="Number of tables to export at once with --output-dir")
+    parser_export_tables.add_argument('--table', action='append',
+        help="Only export this table with --output-dir (can be repeated)")
     parser_export_tables.set_defaults(func=export_tables)
 
     if os.getenv('DEV_MODE'):
@@ -382,9 +524,13 @@ if __name__ == '__main__':
             log_group_name=args.cloudwatch,
             log_stream_name=ec2_metadata.instance_id,
             log_group_retention_days=config.CLOUDWATCH_RETENTION_DAYS,
-            boto3_client=config.boto3_session.client('logs')
+            boto3_client=config.client('logs')
         ))
 
+    if args.metrics_port:
+        from mjcs.metrics import serve_metrics
+        serve_metrics(args.metrics_port)
+
     if hasattr(args, 'func'):
         args.func(args)
     
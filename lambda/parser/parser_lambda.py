@@ -1,7 +1,14 @@
-from mjcs.parser import parse_case
+from mjcs.config import config
+from mjcs.parser import parse_case, parse_case_html, fetch_case_details
+from mjcs.queues import parser_messages
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import json
 
+# Number of S3 objects fetched concurrently for an SQS batch
+FETCH_WORKERS = 16
+
 def lambda_handler(event, context):
+    sqs_records = []
     for record in event['Records']:
         if 's3' in record:
             case_number = record['s3']['object']['key']
@@ -24,11 +31,63 @@ def lambda_handler(event, context):
                 print(f'Error parsing case {case_number} (https://mdcaseexplorer.com/case/{case_number})')
                 raise
         elif record.get('eventSource') == 'aws:sqs':
-            subrecords = json.loads(record['body'])['Records']
-            for subrecord in subrecords:
-                case_number = subrecord['manual']['case_number']
-                detail_loc = subrecord['manual']['detail_loc']
-                try:
-                    parse_case(case_number, detail_loc)
-                except:  # Ignore all parsing errors so entire batch doesn't fail
-                    pass
+            sqs_records.append(record)
+    if sqs_records:
+        return parse_sqs_batch(sqs_records)
+
+def parse_sqs_batch(records):
+    '''Fetch the batch's case details concurrently, parsing each case as soon as
+    it arrives, and report the messages with failed cases so only those are retried.
+
+    Failed cases from packed (multi-case) messages are re-enqueued on their own
+    instead, so the message's other cases aren't parsed again.'''
+    cases = []
+    messages = {}
+    for record in records:
+        body = json.loads(record['body'])
+        messages[record['messageId']] = (len(body['Records']), body.get('attempt', 0))
+        for subrecord in body['Records']:
+            cases.append((
+                subrecord['manual']['case_number'],
+                subrecord['manual']['detail_loc'],
+                record['messageId']
+            ))
+
+    failed_cases = {}
+    with ThreadPoolExecutor(max_workers=FETCH_WORKERS) as executor:
+        futures = {
+            executor.submit(fetch_case_details, case_number): (case_number, detail_loc, message_id)
+            for case_number, detail_loc, message_id in cases
+        }
+        for future in as_completed(futures):
+            case_number, detail_loc, message_id = futures[future]
+            try:
+                case_html, metadata_detail_loc = future.result()
+                parse_case_html(case_number, case_html, detail_loc or metadata_detail_loc)
+            except NotImplementedError:
+                pass
+            except Exception as e:
+                print(f'Error parsing case {case_number} (https://mdcaseexplorer.com/case/{case_number}): {e}')
+                failed_cases.setdefault(message_id, []).append((case_number, detail_loc))
+
+    failed_message_ids = []
+    for message_id, message_failed_cases in failed_cases.items():
+        n_cases, attempt = messages[message_id]
+        if n_cases == 1:
+            failed_message_ids.append(message_id)  # let SQS redrive it as usual
+            continue
+        if attempt + 1 < config.QUEUE_MAX_ATTEMPTS:
+            queue = config.parser_queue
+        else:
+            queue = config.parser_failed_queue
+        try:
+            queue.send(parser_messages(message_failed_cases, attempt + 1))
+        except Exception as e:
+            print(f'Failed to re-enqueue {len(message_failed_cases)} cases from message {message_id}: {e}')
+            failed_message_ids.append(message_id)
+
+    return {
+        'batchItemFailures': [
+            {'itemIdentifier': message_id} for message_id in failed_message_ids
+        ]
+    }
@@ -0,0 +1,56 @@
+'''Change feed of parsed cases.
+
+Every committed parse appends a row to case_changes. Consumers page through
+it in feed order, remembering the position (xid, seq) of the last change
+they processed, instead of rescanning whole tables. A case shows up again
+each time it's reparsed; rows with the same content_hash as the last one a
+consumer saw for that case can be skipped.
+'''
+from .models import CaseChange
+from .util import db_session
+from sqlalchemy import select, insert, func, tuple_
+
+# Position before the first change
+START = (0, 0)
+
+def record_change(db, case_number, detail_loc, last_parse, content_hash=None):
+    db.execute(
+        insert(CaseChange)
+        .values(case_number=case_number, detail_loc=detail_loc, last_parse=last_parse, content_hash=content_hash)
+    )
+
+def change_position(change):
+    return (change['xid'], change['seq'])
+
+def fetch_changes(db, after=START, limit=1000):
+    '''Return up to `limit` changes after position `after`, in feed order.
+
+    seq is assigned on insert rather than commit, so a long transaction (like
+    a bulk load) can commit low seqs after higher ones are already visible.
+    The feed is ordered by the id of the writing transaction instead, and
+    only returns changes from transactions older than every one still in
+    progress, so nothing can appear behind a consumer's position later.
+    '''
+    xmin = func.txid_snapshot_xmin(func.txid_current_snapshot())
+    rows = db.execute(
+        select(CaseChange.xid, CaseChange.seq, CaseChange.case_number, CaseChange.detail_loc,
+               CaseChange.last_parse, CaseChange.content_hash)
+        .where(tuple_(CaseChange.xid, CaseChange.seq) > tuple_(*after), CaseChange.xid < xmin)
+        .order_by(CaseChange.xid, CaseChange.seq)
+        .limit(limit)
+    ).all()
+    return [row._asdict() for row in rows]
+
+def current_position(db):
+    '''Position before any change from a transaction still in progress'''
+    return (db.scalar(select(func.txid_snapshot_xmin(func.txid_current_snapshot()))), 0)
+
+def iter_changes(after=START, page_size=1000):
+    '''Yield every finished change after `after`, a page (and transaction) at a time'''
+    while True:
+        with db_session() as db:
+            page = fetch_changes(db, after, page_size)
+        yield from page
+        if len(page) < page_size:
+            return
+        after = change_position(page[-1])
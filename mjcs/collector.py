@@ -1,10 +1,10 @@
 from .models import Case
-from .util import db_session, send_to_queue
+from .util import db_session, send_to_queue, claim_for_scraping
+from .queues import scraper_messages
 from .config import config
 from pypdf import PdfReader
 from datetime import datetime
 from sqlalchemy import select
-import json
 import re
 import io
 import requests
@@ -67,6 +67,7 @@ class Collector:
     def collect_case_numbers(self, target_date=None):
         target_date = target_date or datetime.now().date()
         response = requests.get(f'{self.url}/file{target_date.strftime("%Y-%m-%d")}.pdf')
+        discovered = datetime.now()
         pdfio = io.BytesIO(response.content)
         reader = PdfReader(pdfio)
         with db_session() as db:
@@ -85,10 +86,17 @@ class Collector:
 
             # Save new cases to database
             db.add_all(new_cases)
+            db.flush()
 
-            # Then send them to the scraper queue
-            messages = [json.dumps({'case_number': case_number}) for case_number in self.cases.keys()]
-            send_to_queue(config.scraper_queue, messages)
+            # Mark all listed cases as enqueued, skipping ones already waiting to be scraped
+            claimed = claim_for_scraping(db, list(self.cases.keys()))
+            for record in claimed:
+                if record['case_number'] in new_case_numbers:
+                    record['discovered'] = discovered.isoformat()
+        logger.info(f'Submitting {len(claimed)} cases to the scraper queue')
+
+        # Then send them to the scraper queue, once scrapers can see them in the database
+        send_to_queue(config.scraper_queue, scraper_messages(claimed))
 
     def parse_pdf_text(self, text, cm, tm, font_dict, font_size):
         if not text.strip():
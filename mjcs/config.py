@@ -1,8 +1,50 @@
 from sqlalchemy import create_engine
+from sqlalchemy.pool import QueuePool
+import threading
+import time
 import os
-import boto3
 import logging
 
+class MeteredQueuePool(QueuePool):
+    '''QueuePool that also keeps track of how long checkouts wait for a connection.
+
+    Wait time includes opening a new connection when the pool has to create one.
+    '''
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._metrics_lock = threading.Lock()
+        self.checkouts = 0
+        self.total_checkout_wait = 0.0
+        self.max_checkout_wait = 0.0
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            wait = time.perf_counter() - start
+            with self._metrics_lock:
+                self.checkouts += 1
+                self.total_checkout_wait += wait
+                self.max_checkout_wait = max(self.max_checkout_wait, wait)
+
+    def metrics(self):
+        with self._metrics_lock:
+            return {
+                'size': self.size(),
+                'in_use': self.checkedout(),
+                'idle': self.checkedin(),
+                'overflow': max(self.overflow(), 0),
+                'checkouts': self.checkouts,
+                'avg_checkout_wait_ms': self.total_checkout_wait / self.checkouts * 1000 if self.checkouts else 0,
+                'max_checkout_wait_ms': self.max_checkout_wait * 1000
+            }
+
+# SQLAlchemy names pool loggers after the pool class, which would put this one under
+# the mjcs logger and log every pool recreation after a fork
+logging.getLogger(f'{__name__}.{MeteredQueuePool.__name__}').setLevel(logging.WARNING)
+
+
 class Config:
     def __getattr__(self, name):
         if self.__getattribute__('initialized') == False:
@@ -13,6 +55,7 @@ class Config:
         self.initialized = False
         self.aws_profile = None
         self.environment = None
+        self._reset_aws()
         if os.getenv('AWS_LAMBDA_FUNCTION_NAME'):
             self.initialize_from_environment()
 
@@ -54,17 +97,36 @@ class Config:
         self.CASE_BATCH_SIZE = int(os.getenv('CASE_BATCH_SIZE',1000))
         self.QUERY_TIMEOUT = int(os.getenv('QUERY_TIMEOUT',135)) # seconds
         self.QUEUE_WAIT = int(os.getenv('QUEUE_WAIT',5)) # seconds
+        self.QUEUE_SEND_THREADS = int(os.getenv('QUEUE_SEND_THREADS',16))
+        self.QUEUE_SEND_RETRIES = int(os.getenv('QUEUE_SEND_RETRIES',5))
+        self.QUEUE_BACKEND = os.getenv('QUEUE_BACKEND', 'sqs') # sqs, sqlite or memory
+        self.QUEUE_DIR = os.getenv('QUEUE_DIR', 'queues') # where sqlite queues are stored
+        self.QUEUE_MAX_ATTEMPTS = int(os.getenv('QUEUE_MAX_ATTEMPTS',3)) # for cases in packed messages
+        self.SCRAPER_QUEUE_PACK_SIZE = int(os.getenv('SCRAPER_QUEUE_PACK_SIZE',10)) # cases per message
+        self.SCRAPER_QUEUE_BUFFER = int(os.getenv('SCRAPER_QUEUE_BUFFER',3)) # messages leased per scraper, including the one in progress
+        self.SCRAPER_QUEUE_RECEIVERS = int(os.getenv('SCRAPER_QUEUE_RECEIVERS',1)) # background receive threads per scraper
+        self.PARSER_QUEUE_PACK_SIZE = int(os.getenv('PARSER_QUEUE_PACK_SIZE',50)) # cases per message
+        self.QUEUE_LEASE_TIMEOUT = int(os.getenv('QUEUE_LEASE_TIMEOUT',300)) # seconds messages being worked on stay hidden
+        self.QUEUE_VISIBILITY_TIMEOUT = int(os.getenv('QUEUE_VISIBILITY_TIMEOUT',300)) # seconds, for local queues
+        self.MJCS_TARGET_RATE = float(os.getenv('MJCS_TARGET_RATE',5)) # requests/sec per process, 0 to disable rate limiting
+        self.MJCS_MIN_RATE = float(os.getenv('MJCS_MIN_RATE',0.1)) # requests/sec the rate governor never goes below
+        self.MJCS_RATE_BURST = int(os.getenv('MJCS_RATE_BURST',2)) # requests that may be sent back to back
+        self.MJCS_SLOW_RESPONSE = int(os.getenv('MJCS_SLOW_RESPONSE',30)) # seconds before a response counts as slow
+        self.MJCS_SESSION_POOL_SIZE = int(os.getenv('MJCS_SESSION_POOL_SIZE',2)) # spare authenticated sessions, 0 to disable
+        self.MJCS_SESSION_MAX_AGE = int(os.getenv('MJCS_SESSION_MAX_AGE',900)) # seconds before a session is swapped for a fresh one
         self.AWS_DEFAULT_REGION = os.getenv('AWS_DEFAULT_REGION', 'us-east-1')
         self.CLOUDWATCH_RETENTION_DAYS = os.getenv('CLOUDWATCH_RETENTION_DAYS', 30)
 
         # Spider options
         self.SPIDER_DAYS_PER_QUERY = int(os.getenv('SPIDER_DAYS_PER_QUERY',16))
+        self.SPIDER_ROW_CAP = int(os.getenv('SPIDER_ROW_CAP',500)) # most rows the MJCS returns for a search
 
         # Scraper options
         self.MAX_SCRAPE_AGE = int(os.getenv('MAX_SCRAPE_AGE', 14)) # days
         self.MAX_SCRAPE_AGE_INACTIVE = int(os.getenv('MAX_SCRAPE_AGE_INACTIVE', 90)) # days
         self.RESCRAPE_COEFFICIENT = float(os.getenv('RESCRAPE_COEFFICIENT', self.MAX_SCRAPE_AGE / (365 * 4 + 1) ))
         self.SCRAPE_QUEUE_THRESHOLD = int(os.getenv('SCRAPE_QUEUE_THRESHOLD', 5000000))
+        self.SCRAPE_ENQUEUE_WINDOW = int(os.getenv('SCRAPE_ENQUEUE_WINDOW', 72)) # hours a case stays enqueued before it can be sent again
         
         # Infrastructure identifiers
         self.MJCS_DATABASE_URL = os.getenv('MJCS_DATABASE_URL')
@@ -76,35 +138,136 @@ class Config:
         self.PARSER_TRIGGER_ARN = os.getenv('PARSER_TRIGGER_ARN')
         self.VPC_SUBNET_1_ID = os.getenv('VPC_SUBNET_1_ID')
         self.VPC_SUBNET_2_ID = os.getenv('VPC_SUBNET_2_ID')
+
+        # Database connection pool options, per process
+        self.DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE',5))
+        self.DB_MAX_OVERFLOW = int(os.getenv('DB_MAX_OVERFLOW',10))
+        self.DB_POOL_TIMEOUT = int(os.getenv('DB_POOL_TIMEOUT',30)) # seconds to wait for a connection
+        self.DB_POOL_RECYCLE = int(os.getenv('DB_POOL_RECYCLE',1800)) # seconds before a connection is replaced
+        self.DB_POOL_PRE_PING = bool(int(os.getenv('DB_POOL_PRE_PING',1))) # test connections on checkout
         self.ECS_CLUSTER_ARN = os.getenv('ECS_CLUSTER_ARN')
 
         # SQLAlchemy database engine
         if self.__getattribute__('MJCS_DATABASE_URL'):
-            self.db_engine = create_engine(self.MJCS_DATABASE_URL, future=True)
+            self.db_engine = create_engine(
+                self.MJCS_DATABASE_URL,
+                future=True,
+                poolclass=MeteredQueuePool,
+                pool_size=self.DB_POOL_SIZE,
+                max_overflow=self.DB_MAX_OVERFLOW,
+                pool_timeout=self.DB_POOL_TIMEOUT,
+                pool_recycle=self.DB_POOL_RECYCLE,
+                pool_pre_ping=self.DB_POOL_PRE_PING
+            )
+
+        # boto3 session, clients and resources are created on first use, to keep imports (and Lambda cold starts) fast
+        self._reset_aws()
 
+        self.initialized = True
+
+    def _reset_aws(self):
+        self._lock = threading.RLock()
+        self._pid = os.getpid()
+        self._boto3_session = None
+        self._clients = {}
+        self._local = threading.local()  # resources aren't thread-safe, so each thread gets its own
+        self._queues = {}
+
+    def _check_pid(self):
+        # boto3 sessions and their connections can't be shared with forked processes
+        if self._pid != os.getpid():
+            self._reset_aws()
+
+    @property
+    def boto3_session(self):
         # Create custom boto3 session to use aws_profile
-        self.boto3_session = boto3.session.Session(profile_name=self.aws_profile, region_name=self.AWS_DEFAULT_REGION)
+        self._check_pid()
+        with self._lock:
+            if not self._boto3_session:
+                import boto3
+                self._boto3_session = boto3.session.Session(profile_name=self.aws_profile, region_name=self.AWS_DEFAULT_REGION)
+            return self._boto3_session
 
-        # Generic boto3 resources/clients
-        self.sqs = self.boto3_session.resource('sqs')
-        self.dynamodb = self.boto3_session.resource('dynamodb')
-        self.s3 = self.boto3_session.resource('s3')
-        self.sns = self.boto3_session.resource('sns')
-        self.lambda_ = self.boto3_session.client('lambda')
+    def client(self, name):
+        '''Return a boto3 client shared by every thread in this process (clients are thread-safe)'''
+        self._check_pid()
+        client = self._clients.get(name)
+        if not client:
+            with self._lock:
+                if name not in self._clients:
+                    self._clients[name] = self.boto3_session.client(name)
+                client = self._clients[name]
+        return client
 
-        self.initialized = True
+    def _resource(self, name):
+        self._check_pid()
+        resources = self._local.__dict__.setdefault('resources', {})
+        if name not in resources:
+            with self._lock:  # sessions aren't thread-safe either
+                resources[name] = self.boto3_session.resource(name)
+        return resources[name]
+
+    # Generic boto3 resources/clients
+    @property
+    def sqs(self):
+        return self._resource('sqs')
+
+    @property
+    def dynamodb(self):
+        return self._resource('dynamodb')
+
+    @property
+    def s3(self):
+        return self._resource('s3')
+
+    @property
+    def sns(self):
+        return self._resource('sns')
+
+    @property
+    def lambda_(self):
+        return self.client('lambda')
+
+    @property
+    def cloudwatch(self):
+        return self.client('cloudwatch')
 
     @property
     def case_details_bucket(self):
-        return self.s3.Bucket(self.CASE_DETAILS_BUCKET)
+        buckets = self._local.__dict__.setdefault('buckets', {})
+        if self.CASE_DETAILS_BUCKET not in buckets:
+            buckets[self.CASE_DETAILS_BUCKET] = self.s3.Bucket(self.CASE_DETAILS_BUCKET)
+        return buckets[self.CASE_DETAILS_BUCKET]
     
+    def queue(self, name):
+        '''Return the named queue from the configured QUEUE_BACKEND, resolving it only once per process'''
+        self._check_pid()
+        queue = self._queues.get(name)
+        if queue:
+            return queue
+        from .queues import SQSQueue, SQLiteQueue, MemoryQueue, QUEUE_BACKENDS
+        if self.QUEUE_BACKEND not in QUEUE_BACKENDS:
+            raise Exception(f'Invalid queue backend {self.QUEUE_BACKEND}')
+        with self._lock:
+            # Local queues hold state, so every caller has to get the same instance
+            if name not in self._queues:
+                if self.QUEUE_BACKEND == 'sqs':
+                    sqs = self.client('sqs')
+                    self._queues[name] = SQSQueue(sqs, sqs.get_queue_url(QueueName=name)['QueueUrl'])
+                elif self.QUEUE_BACKEND == 'sqlite':
+                    path = os.path.join(self.QUEUE_DIR, f'{name}.sqlite3')
+                    self._queues[name] = SQLiteQueue(name, path, self.QUEUE_VISIBILITY_TIMEOUT)
+                else:
+                    self._queues[name] = MemoryQueue(name, self.QUEUE_VISIBILITY_TIMEOUT)
+            return self._queues[name]
+
     @property
     def spider_queue(self):
-        return self.sqs.get_queue_by_name(QueueName=self.SPIDER_QUEUE_NAME)
+        return self.queue(self.SPIDER_QUEUE_NAME or 'spider')
 
     @property
     def scraper_queue(self):
-        return self.sqs.get_queue_by_name(QueueName=self.SCRAPER_QUEUE_NAME)
+        return self.queue(self.SCRAPER_QUEUE_NAME or 'scraper')
         
     @property
     def parser_trigger(self):
@@ -112,11 +275,20 @@ class Config:
     
     @property
     def parser_failed_queue(self):
-        return self.sqs.get_queue_by_name(QueueName=self.PARSER_FAILED_QUEUE_NAME)
+        return self.queue(self.PARSER_FAILED_QUEUE_NAME or 'parser_failed')
     
     @property
     def parser_queue(self):
-        return self.sqs.get_queue_by_name(QueueName=self.PARSER_QUEUE_NAME)
-
+        return self.queue(self.PARSER_QUEUE_NAME or 'parser')
 
 config = Config()
+
+def _after_fork_in_child():
+    # Forked processes (e.g. parser workers) must not use the parent's pooled connections.
+    # close=False leaves them open for the parent and gives the child a fresh pool.
+    db_engine = config.__dict__.get('db_engine')
+    if db_engine:
+        db_engine.dispose(close=False)
+
+os.register_at_fork(after_in_child=_after_fork_in_child)
+
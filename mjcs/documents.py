@@ -0,0 +1,72 @@
+'''Whole cases as JSON documents, assembled by the database in a single query.
+
+A case document is the case's row in cases, its root case type row and
+every related table of that case type, keyed by relationship name:
+
+    {"case": {...}, "odycrim": {...}, "charges": [...], "defendants": [...], ...}
+
+Related rows are aggregated with json_agg subqueries generated from the
+root model's relationships, so a case with 15 related tables is still one
+round trip instead of one query per relationship.
+'''
+from .export import export_columns
+from .models import Case
+from . import models
+from sqlalchemy import select, func, literal, text
+from sqlalchemy.dialects.postgresql import aggregate_order_by
+from collections import defaultdict
+
+def related_json(table, case_number, redacted=False, many=True):
+    '''Scalar subquery returning a case's rows from table as JSON'''
+    rows = (
+        select(*export_columns(table, redacted))
+        .where(table.c.case_number == case_number)
+        .correlate_except(table)
+        .subquery(table.name)
+    )
+    if not many:
+        return select(func.row_to_json(rows.table_valued())).limit(1).scalar_subquery()
+    return select(
+        func.coalesce(
+            func.json_agg(aggregate_order_by(rows.table_valued(), rows.c.id)),
+            text("'[]'::json")
+        )
+    ).scalar_subquery()
+
+def document_query(detail_loc, case_numbers, redacted=False):
+    '''Select case_number and the case document for each of case_numbers, all of type detail_loc'''
+    cases = Case.__table__
+    selected = cases.alias('selected_cases')
+    case_number = selected.c.case_number
+    fields = [literal('case'), related_json(cases, case_number, redacted, many=False)]
+    if detail_loc in models.case_type_models:
+        root = getattr(models, detail_loc)
+        fields += [literal(root.__tablename__), related_json(root.__table__, case_number, redacted, many=False)]
+        for name, relationship in root.__mapper__.relationships.items():
+            if relationship.target is not cases:
+                fields += [literal(name), related_json(relationship.target, case_number, redacted, relationship.uselist)]
+    return (
+        select(case_number, func.json_build_object(*fields).label('document'))
+        .where(case_number.in_(case_numbers))
+    )
+
+def case_documents(db, case_numbers, redacted=False):
+    '''Return {case_number: document} for many cases, with one query per case type among them'''
+    by_type = defaultdict(list)
+    for case_number, detail_loc in db.execute(
+            select(Case.case_number, Case.detail_loc).where(Case.case_number.in_(case_numbers))):
+        by_type[detail_loc].append(case_number)
+    documents = {}
+    for detail_loc, type_case_numbers in by_type.items():
+        documents.update(db.execute(document_query(detail_loc, type_case_numbers, redacted)).all())
+    return documents
+
+def case_document(db, case_number, detail_loc=None, redacted=False):
+    '''Return one case's document, or None if there is no such case.
+
+    Pass the case's detail_loc if it's already known to skip looking it up.
+    '''
+    if not detail_loc:
+        detail_loc = db.scalar(select(Case.detail_loc).where(Case.case_number == case_number))
+    row = db.execute(document_query(detail_loc, [case_number], redacted)).first()
+    return row.document if row else None
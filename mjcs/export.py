@@ -0,0 +1,123 @@
+'''Local export of case tables to compressed CSV or Parquet files.
+
+Each table is streamed out of the database (COPY TO STDOUT for CSV, a
+server-side cursor for Parquet), and several tables are exported at once.
+Incremental exports only include cases that show up in the change feed
+after the previous export's watermark, a feed position (xid, seq) taken
+before any transaction that was still in progress, so parses that commit
+during an export are picked up by the next one. They contain every row of
+those cases, so consumers should replace each exported case's rows wholesale.
+'''
+from .config import config
+from .changes import current_position
+from .util import db_session, get_case_model_list
+from .parser.offline import CSV_NULL, OUTPUT_FORMATS, parquet_schema, parquet_value
+from . import models
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from sqlalchemy import select, tuple_
+import gzip
+import json
+import os
+import logging
+
+logger = logging.getLogger('mjcs')
+
+WATERMARK_FILE = 'watermark.json'
+
+def read_watermark(output_dir):
+    path = os.path.join(output_dir, WATERMARK_FILE)
+    if os.path.exists(path):
+        with open(path) as f:
+            watermark = json.load(f)
+        if 'xid' not in watermark:
+            logger.warning('Previous export watermark is a last_parse time, not a change feed position')
+            return None
+        return (watermark['xid'], watermark['seq'])
+
+def write_watermark(output_dir, position):
+    path = os.path.join(output_dir, WATERMARK_FILE)
+    with open(f'{path}.tmp', 'w') as f:
+        json.dump(dict(zip(('xid', 'seq'), position)), f)
+    os.replace(f'{path}.tmp', path)
+
+def export_columns(table, redacted=False):
+    return [col for col in table.columns if not (redacted and getattr(col, 'redacted', False))]
+
+def export_query(table, columns, since=None, until=None):
+    '''Select columns of table, only for cases changed between feed positions since and until if given'''
+    query = select(*columns)
+    if since:
+        position = tuple_(models.CaseChange.xid, models.CaseChange.seq)
+        changed = select(models.CaseChange.case_number).where(position > tuple_(*since), position < tuple_(*until))
+        query = query.where(table.c.case_number.in_(changed))
+    return query
+
+def export_csv(query, path):
+    with db_session() as db:
+        cursor = db.connection().connection.cursor()
+        sql = str(query.compile(db.get_bind(), compile_kwargs={'literal_binds': True}))
+        with gzip.open(path, 'wb') as f:
+            cursor.copy_expert(f"COPY ({sql}) TO STDOUT WITH (FORMAT csv, HEADER, NULL '{CSV_NULL}')", f)
+        return cursor.rowcount
+
+def export_parquet(query, columns, path):
+    import pyarrow as pa  # optional dependency, only needed for parquet output
+    import pyarrow.parquet as pq
+    schema = parquet_schema(columns)
+    rows = 0
+    with db_session() as db, pq.ParquetWriter(path, schema) as writer:
+        result = db.execute(query.execution_options(yield_per=config.CASE_BATCH_SIZE))
+        for partition in result.partitions():
+            batch = {col.name: [parquet_value(row[i]) for row in partition] for i, col in enumerate(columns)}
+            writer.write_table(pa.table(batch, schema=schema))
+            rows += len(partition)
+    return rows
+
+def export_table(table, output_dir, output_format='csv', since=None, until=None, redacted=False):
+    ext = 'csv.gz' if output_format == 'csv' else 'parquet'
+    path = os.path.join(output_dir, f'{table.name}.{ext}')
+    columns = export_columns(table, redacted)
+    query = export_query(table, columns, since, until)
+    begin = datetime.now()
+    if output_format == 'csv':
+        rows = export_csv(query, path)
+    else:
+        rows = export_parquet(query, columns, path)
+    logger.info(f'Exported {rows} rows from {table.name} in {(datetime.now() - begin).total_seconds():.1f}s')
+    return rows
+
+def export_tables(output_dir, output_format='csv', incremental=False, redacted=False, workers=4, tables=None):
+    '''Export case tables to a new directory under output_dir, and return that directory.
+
+    Incremental exports start from the watermark left in output_dir by the
+    previous export (full or incremental). The new watermark is only saved
+    once every table has been exported.
+    '''
+    if output_format not in OUTPUT_FORMATS:
+        raise Exception(f'Invalid output format {output_format}')
+    since = read_watermark(output_dir) if incremental else None
+    if incremental and not since:
+        logger.info('No previous export watermark found, exporting everything')
+    with db_session() as db:
+        until = current_position(db)
+
+    to_export = [model.__table__ for model in get_case_model_list(models)]
+    if tables:
+        to_export = [table for table in to_export if table.name in tables]
+    run_dir = os.path.join(output_dir, f"{'incremental' if since else 'full'}-{datetime.now().strftime('%Y%m%dT%H%M%S')}")
+    os.makedirs(run_dir)
+    logger.info(f'Exporting {len(to_export)} tables to {run_dir}' +
+        (f' for cases changed after feed position {since}' if since else ''))
+
+    # Full exports don't filter on changes, but the next incremental export starts where they did
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        jobs = [
+            executor.submit(export_table, table, run_dir, output_format, since, until, redacted)
+            for table in to_export
+        ]
+        rows = sum(job.result() for job in jobs)
+
+    write_watermark(output_dir, until)
+    logger.info(f'Exported {rows} rows to {run_dir}')
+    return run_dir
@@ -0,0 +1,275 @@
+from .config import config
+from .util import RepeatedTimer
+from bisect import bisect_left
+from contextlib import contextmanager
+import threading
+import logging
+import time
+
+logger = logging.getLogger('mjcs')
+
+# Most datapoints put_metric_data accepts in one call
+PUT_METRIC_DATA_MAX = 1000
+
+# Histogram bucket upper bounds
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 90, 120, 180) # seconds
+SIZE_BUCKETS = (0, 1, 5, 10, 25, 50, 100, 200, 300, 400, 499, 500) # search result rows
+
+
+class Counter:
+    '''Monotonic count per label set'''
+    def __init__(self, name, help, unit='Count'):
+        self.name = name
+        self.help = help
+        self.unit = unit
+        self.values = {}
+        self.exported = {}
+        self.lock = threading.Lock()
+
+    def inc(self, n=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + n
+
+    def prometheus_lines(self):
+        with self.lock:
+            values = dict(self.values)
+        yield f'# HELP {self.name} {self.help}'
+        yield f'# TYPE {self.name} counter'
+        for key, value in sorted(values.items()):
+            yield f'{self.name}{prometheus_labels(key)} {value}'
+
+    def cloudwatch_data(self, dimensions, now):
+        '''Datapoints for counts since the last export'''
+        with self.lock:
+            deltas = {key: value - self.exported.get(key, 0) for key, value in self.values.items()}
+            self.exported = dict(self.values)
+        return [
+            {
+                'MetricName': cloudwatch_name(self.name),
+                'Dimensions': dimensions + cloudwatch_dimensions(key),
+                'Timestamp': now,
+                'Value': delta,
+                'Unit': self.unit
+            }
+            for key, delta in deltas.items() if delta
+        ]
+
+
+class Histogram:
+    '''Distribution of observed values per label set, in fixed buckets'''
+    def __init__(self, name, help, buckets, unit='Seconds'):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        self.unit = unit
+        self.values = {} # label key -> [bucket counts (plus +Inf), sum, count]
+        self.exported = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            if key not in self.values:
+                self.values[key] = [[0] * (len(self.buckets) + 1), 0, 0]
+            counts, total, count = self.values[key]
+            counts[bisect_left(self.buckets, value)] += 1
+            self.values[key][1:] = [total + value, count + 1]
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def prometheus_lines(self):
+        with self.lock:
+            values = {key: ([*counts], total, count) for key, (counts, total, count) in self.values.items()}
+        yield f'# HELP {self.name} {self.help}'
+        yield f'# TYPE {self.name} histogram'
+        for key, (counts, total, count) in sorted(values.items()):
+            cumulative = 0
+            for bound, bucket_count in zip([*self.buckets, '+Inf'], counts):
+                cumulative += bucket_count
+                yield f'{self.name}_bucket{prometheus_labels(key + (("le", bound),))} {cumulative}'
+            yield f'{self.name}_sum{prometheus_labels(key)} {total}'
+            yield f'{self.name}_count{prometheus_labels(key)} {count}'
+
+    def cloudwatch_data(self, dimensions, now):
+        '''Datapoints for observations since the last export, as bucket bounds with counts
+
+        Values are bucket upper bounds (the last bucket is reported at the
+        largest bound), which is enough for CloudWatch to estimate percentiles.
+        '''
+        with self.lock:
+            deltas = {}
+            for key, (counts, _, _) in self.values.items():
+                exported = self.exported.get(key, [0] * len(counts))
+                deltas[key] = [c - e for c, e in zip(counts, exported)]
+                self.exported[key] = [*counts]
+        data = []
+        for key, counts in deltas.items():
+            bounds = [*self.buckets, self.buckets[-1]]
+            values = {}
+            for bound, count in zip(bounds, counts):
+                if count:
+                    values[bound] = values.get(bound, 0) + count
+            if values:
+                data.append({
+                    'MetricName': cloudwatch_name(self.name),
+                    'Dimensions': dimensions + cloudwatch_dimensions(key),
+                    'Timestamp': now,
+                    'Values': list(values.keys()),
+                    'Counts': list(values.values()),
+                    'Unit': self.unit
+                })
+        return data
+
+def prometheus_labels(key):
+    if not key:
+        return ''
+    return '{' + ','.join(f'{name}="{value}"' for name, value in key) + '}'
+
+def cloudwatch_name(name):
+    # Matches the CamelCase names of the other CaseHarvester metrics, e.g. mjcs_request_seconds -> MjcsRequestSeconds
+    return ''.join(part.capitalize() for part in name.split('_'))
+
+def cloudwatch_dimensions(key):
+    return [{'Name': cloudwatch_name(name), 'Value': str(value)} for name, value in key]
+
+
+class Registry:
+    '''Every counter and histogram in this process'''
+    def __init__(self):
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    def add(self, metric):
+        with self.lock:
+            return self.metrics.setdefault(metric.name, metric)
+
+    def counter(self, name, help, unit='Count'):
+        return self.add(Counter(name, help, unit))
+
+    def histogram(self, name, help, buckets=LATENCY_BUCKETS, unit='Seconds'):
+        return self.add(Histogram(name, help, buckets, unit))
+
+    def prometheus_text(self):
+        with self.lock:
+            metrics = list(self.metrics.values())
+        return '\n'.join(line for metric in metrics for line in metric.prometheus_lines()) + '\n'
+
+    def cloudwatch_data(self, dimensions):
+        '''Datapoints for everything recorded since the last call'''
+        from datetime import datetime
+        now = datetime.now()
+        with self.lock:
+            metrics = list(self.metrics.values())
+        return [datum for metric in metrics for datum in metric.cloudwatch_data(dimensions, now)]
+
+registry = Registry()
+
+# Request and scrape instrumentation, shared by every spider, scraper and session in the process
+mjcs_request_seconds = registry.histogram('mjcs_request_seconds',
+    'MJCS response time by endpoint and status')
+search_result_rows = registry.histogram('search_result_rows',
+    'Rows returned by spider searches', SIZE_BUCKETS, unit='Count')
+search_outcomes = registry.counter('search_outcomes',
+    'Spider search outcomes, including the row cap being hit and each FailedSearch error')
+scrape_outcomes = registry.counter('scrape_outcomes',
+    'Scrape outcomes, including each FailedScrape error')
+s3_write_seconds = registry.histogram('s3_write_seconds',
+    'Time to store case details in S3')
+db_write_seconds = registry.histogram('db_write_seconds',
+    'Time to record scrapes in the database')
+
+def serve_metrics(port, host='0.0.0.0'):
+    '''Serve the registry in Prometheus text format at http://host:port/metrics, in a background thread'''
+    from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] != '/metrics':
+                self.send_error(404)
+                return
+            body = registry.prometheus_text().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='metrics-server', daemon=True).start()
+    logger.info(f'Serving metrics at http://{host}:{server.server_address[1]}/metrics')
+    return server
+
+class MetricsReporter:
+    '''Sends CloudWatch metrics in the background while a worker runs.
+
+    Every interval, collect() is called for the latest datapoints, and
+    everything buffered is sent in batches that fit in a put_metric_data
+    call. Datapoints that fail to send are retried on the next flush, with
+    the oldest dropped once more than max_buffered are waiting.
+    '''
+    def __init__(self, collect=None, interval=60, namespace='CaseHarvester', max_buffered=10000):
+        self.collect = collect
+        self.namespace = namespace
+        self.max_buffered = max_buffered
+        self.buffer = []
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.timer = RepeatedTimer(interval, self.tick)
+
+    def add(self, metric_data):
+        with self.lock:
+            self.buffer += metric_data
+            dropped = len(self.buffer) - self.max_buffered
+            if dropped > 0:
+                logger.warning(f'Dropping {dropped} unsent metric datapoints')
+                del self.buffer[:dropped]
+
+    def flush(self):
+        with self.flush_lock:
+            with self.lock:
+                pending, self.buffer = self.buffer, []
+            for i in range(0, len(pending), PUT_METRIC_DATA_MAX):
+                batch = pending[i:i + PUT_METRIC_DATA_MAX]
+                try:
+                    config.cloudwatch.put_metric_data(
+                        Namespace=self.namespace,
+                        MetricData=batch
+                    )
+                except Exception as e:
+                    logger.warning(f'Failed to send {len(pending) - i} metric datapoints: {e}')
+                    self.add(pending[i:])
+                    return
+
+    def tick(self):
+        try:
+            if self.collect:
+                self.add(self.collect())
+            self.flush()
+        except Exception as e:
+            # Metrics failures shouldn't interrupt the worker
+            logger.warning(f'Failed to report metrics: {e}')
+
+    def start(self):
+        self.timer.start()
+        return self
+
+    def stop(self):
+        self.timer.stop()
+        self.tick()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
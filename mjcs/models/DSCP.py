@@ -165,6 +165,7 @@ class DSCPDefendantAlias(DSCPCaseTable, TableBase):
 
     id = Column(Integer, primary_key=True)
     alias_name = Column(String)
+    case_number = Column(String, ForeignKey('dscp.case_number', ondelete='CASCADE'), nullable=False, redacted=True)
 
 class DSCPRelatedPerson(DSCPCaseTable, TableBase):
     __tablename__ = 'dscp_related_persons'
@@ -171,6 +171,7 @@ class DSCRDefendantAlias(DSCRCaseTable, TableBase):
     city = Column(String)
     state = Column(String)
     zip_code = Column(String)
+    case_number = Column(String, ForeignKey('dscr.case_number', ondelete='CASCADE'), nullable=False, redacted=True)
 
 class DSCRRelatedPerson(DSCRCaseTable, TableBase):
     __tablename__ = 'dscr_related_persons'
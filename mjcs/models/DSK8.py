@@ -254,6 +254,7 @@ class DSK8DefendantAlias(DSK8CaseTable, TableBase):
     city = Column(String)
     state = Column(String)
     zip_code = Column(String)
+    case_number = Column(String, ForeignKey('dsk8.case_number', ondelete='CASCADE'), nullable=False, redacted=True)
 
 class DSK8RelatedPerson(DSK8CaseTable, TableBase):
     __tablename__ = 'dsk8_related_persons'
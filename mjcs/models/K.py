@@ -73,10 +73,10 @@ class KDefendant(KCaseTable, TableBase):
     id = Column(Integer, primary_key=True)
     party_type = Column(String, enum=True)
     name = Column(String, redacted=True)
-    race = Column(String, enum=True)
-    sex = Column(String)
-    height = Column(Integer)
-    weight = Column(Integer)
+    race = Column(String, enum=True, redacted=True)
+    sex = Column(String, redacted=True)
+    height = Column(Integer, redacted=True)
+    weight = Column(Integer, redacted=True)
     DOB = Column(Date, redacted=True)
     _DOB_str = Column('DOB_str',String, redacted=True)
 
@@ -89,7 +89,7 @@ class PGDefendant(PGCaseTable, TableBase):
     pg = relationship('PG', backref='defendants')
 
     id = Column(Integer, primary_key=True)
-    party_number = Column(Integer)
+    party_number = Column(Integer, redacted=True)
     name = Column(String, redacted=True)
     address_1 = Column(String, redacted=True)
     address_2 = Column(String, redacted=True)
@@ -1,60 +1,100 @@
 from .common import ColumnMetadata
 from .case import Case
 from .scraper import Scrape, ScrapeVersion
-from .DSCR import (DSCR, DSCRCharge, DSCRDefendant, DSCRDefendantAlias,
-                   DSCRRelatedPerson, DSCREvent, DSCRTrial, DSCRBailEvent)
-from .DSCP import (DSCP, DSCPCharge, DSCPDefendant, DSCPDefendantAlias,
-                   DSCPRelatedPerson, DSCPEvent, DSCPTrial, DSCPBailEvent)
-from .DSK8 import (DSK8, DSK8Charge, DSK8BailAndBond, DSK8Bondsman, DSK8Defendant,
-                   DSK8DefendantAlias, DSK8RelatedPerson, DSK8Event, DSK8Trial)
-from .DSCIVIL import (DSCIVIL, DSCIVILComplaint, DSCIVILHearing, DSCIVILJudgment,
-                      DSCIVILRelatedPerson, DSCIVILEvent, DSCIVILTrial)
-from .CC import (CC, CCDistrictCaseNumber, CCPlaintiff, CCDefendant,
-                 CCRelatedPerson, CCPartyAlias, CCPartyAddress, CCAttorney,
-                 CCCourtSchedule, CCJudgment, CCJudgmentModification,
-                 CCJudgmentAgainst, CCJudgmentInFavor, CCSupportOrder, CCDocument)
-from .ODYTRAF import (ODYTRAF, ODYTRAFReferenceNumber, ODYTRAFDefendant,
-                      ODYTRAFInvolvedParty, ODYTRAFAttorney, ODYTRAFCourtSchedule,
-                      ODYTRAFCharge, ODYTRAFWarrant, ODYTRAFBailBond,
-                      ODYTRAFBondSetting, ODYTRAFDocument, ODYTRAFAlias,
-                      ODYTRAFService)
-from .ODYCRIM import (ODYCRIM, ODYCRIMReferenceNumber, ODYCRIMDefendant,
-                      ODYCRIMInvolvedParty, ODYCRIMAlias, ODYCRIMAttorney,
-                      ODYCRIMCourtSchedule, ODYCRIMCharge, ODYCRIMProbation,
-                      ODYCRIMRestitution, ODYCRIMWarrant, ODYCRIMBailBond,
-                      ODYCRIMBondSetting, ODYCRIMDocument, ODYCRIMService,
-                      ODYCRIMSexOffenderRegistration)
-from .ODYCIVIL import (ODYCIVIL, ODYCIVILReferenceNumber, ODYCIVILCause, 
-                       ODYCIVILCauseRemedy, ODYCIVILDefendant, ODYCIVILInvolvedParty,
-                       ODYCIVILAlias, ODYCIVILAttorney, ODYCIVILJudgment, 
-                       ODYCIVILJudgmentStatus, ODYCIVILCourtSchedule, ODYCIVILWarrant,
-                       ODYCIVILDocument, ODYCIVILService, ODYCIVILJudgmentComment,
-                       ODYCIVILBondSetting, ODYCIVILBailBond, ODYCIVILDisposition)
-from .ODYCVCIT import (ODYCVCIT, ODYCVCITReferenceNumber, ODYCVCITDefendant,
-                      ODYCVCITInvolvedParty, ODYCVCITAlias, ODYCVCITAttorney,
-                      ODYCVCITCourtSchedule, ODYCVCITCharge, ODYCVCITProbation,
-                      ODYCVCITRestitution, ODYCVCITWarrant, ODYCVCITBailBond,
-                      ODYCVCITBondSetting, ODYCVCITDocument, ODYCVCITService)
-from .DSTRAF import (DSTRAF, DSTRAFCharge, DSTRAFDisposition, DSTRAFDefendant, 
-                      DSTRAFEvent, DSTRAFTrial, DSTRAFRelatedPerson)
-from .K import (K, KDefendant, KCharge,
-                 KRelatedPerson, KPartyAlias, KPartyAddress, KAttorney,
-                 KCourtSchedule, KJudgment, KJudgmentModification,
-                 KJudgmentAgainst, KJudgmentInFavor, KSupportOrder, KDocument,
-                 KSentencingNetTools)
-from .PG import (PG, PGCharge, PGDefendant, PGDefendantAlias, PGOtherParty, 
-                 PGAttorney, PGCourtSchedule, PGDocket, PGPlaintiff)
-from .DV import DV, DVDefendant, DVHearing, DVEvent, DVDefendantAttorney
-from .MCCR import (MCCR, MCCRAttorney, MCCRCharge, MCCRCourtSchedule,
-                   MCCRDefendant, MCCRDocket, MCCRBailBond, MCCRAudioMedia,
-                   MCCRJudgment, MCCRProbationOfficer, MCCRAlias, MCCRBondRemitter,
-                   MCCRDistrictCourtNumber, MCCRTrackingNumber, MCCRDWIMonitor)
-from .MCCI import (MCCI, MCCIAttorney, MCCICourtSchedule, MCCIDefendant, MCCIDocket,
-                   MCCIInterestedParty, MCCIIssue, MCCIJudgment, MCCIPlaintiff,
-                   MCCIAlias, MCCIWard, MCCIAudioMedia, MCCIGarnishee, MCCIResidentAgent)
-from .PGV import (PGV, PGVDefendant, PGVPlaintiff, PGVOtherParty, PGVAttorney, 
-                  PGVJudgment, PGVDocket, PGVCourtSchedule, PGVDefendantAlias)
-from .ODYCOSA import (ODYCOSA, ODYCOSAAttorney, ODYCOSADocument, ODYCOSAJudgment,
-                      ODYCOSAInvolvedParty, ODYCOSAReferenceNumber, ODYCOSACourtSchedule)
-from .ODYCOA import (ODYCOA, ODYCOAAttorney, ODYCOADocument, ODYCOAJudgment,
-                      ODYCOAInvolvedParty, ODYCOAReferenceNumber, ODYCOACourtSchedule)
\ No newline at end of file
+from .trace import CaseTrace
+from .change import CaseChange
+import importlib
+import sys
+
+# Case type models are imported on first access, so loading one parser doesn't
+# import (and map) the models for every case type
+case_type_models = {
+    'DSCR': ['DSCR', 'DSCRCharge', 'DSCRDefendant', 'DSCRDefendantAlias',
+             'DSCRRelatedPerson', 'DSCREvent', 'DSCRTrial', 'DSCRBailEvent'],
+    'DSCP': ['DSCP', 'DSCPCharge', 'DSCPDefendant', 'DSCPDefendantAlias',
+             'DSCPRelatedPerson', 'DSCPEvent', 'DSCPTrial', 'DSCPBailEvent'],
+    'DSK8': ['DSK8', 'DSK8Charge', 'DSK8BailAndBond', 'DSK8Bondsman', 'DSK8Defendant',
+             'DSK8DefendantAlias', 'DSK8RelatedPerson', 'DSK8Event',
+             'DSK8Trial'],
+    'DSCIVIL': ['DSCIVIL', 'DSCIVILComplaint', 'DSCIVILHearing', 'DSCIVILJudgment',
+                'DSCIVILRelatedPerson', 'DSCIVILEvent', 'DSCIVILTrial'],
+    'CC': ['CC', 'CCDistrictCaseNumber', 'CCPlaintiff', 'CCDefendant', 'CCRelatedPerson',
+           'CCPartyAlias', 'CCPartyAddress', 'CCAttorney', 'CCCourtSchedule',
+           'CCJudgment', 'CCJudgmentModification', 'CCJudgmentAgainst',
+           'CCJudgmentInFavor', 'CCSupportOrder', 'CCDocument'],
+    'ODYTRAF': ['ODYTRAF', 'ODYTRAFReferenceNumber', 'ODYTRAFDefendant',
+                'ODYTRAFInvolvedParty', 'ODYTRAFAttorney',
+                'ODYTRAFCourtSchedule', 'ODYTRAFCharge', 'ODYTRAFWarrant',
+                'ODYTRAFBailBond', 'ODYTRAFBondSetting',
+                'ODYTRAFDocument', 'ODYTRAFAlias', 'ODYTRAFService'],
+    'ODYCRIM': ['ODYCRIM', 'ODYCRIMReferenceNumber', 'ODYCRIMDefendant',
+                'ODYCRIMInvolvedParty', 'ODYCRIMAlias', 'ODYCRIMAttorney',
+                'ODYCRIMCourtSchedule', 'ODYCRIMCharge',
+                'ODYCRIMProbation', 'ODYCRIMRestitution',
+                'ODYCRIMWarrant', 'ODYCRIMBailBond', 'ODYCRIMBondSetting',
+                'ODYCRIMDocument', 'ODYCRIMService',
+                'ODYCRIMSexOffenderRegistration'],
+    'ODYCIVIL': ['ODYCIVIL', 'ODYCIVILReferenceNumber', 'ODYCIVILCause',
+                 'ODYCIVILCauseRemedy', 'ODYCIVILDefendant',
+                 'ODYCIVILInvolvedParty', 'ODYCIVILAlias',
+                 'ODYCIVILAttorney', 'ODYCIVILJudgment',
+                 'ODYCIVILJudgmentStatus', 'ODYCIVILCourtSchedule',
+                 'ODYCIVILWarrant', 'ODYCIVILDocument',
+                 'ODYCIVILService', 'ODYCIVILJudgmentComment',
+                 'ODYCIVILBondSetting', 'ODYCIVILBailBond',
+                 'ODYCIVILDisposition'],
+    'ODYCVCIT': ['ODYCVCIT', 'ODYCVCITReferenceNumber', 'ODYCVCITDefendant',
+                 'ODYCVCITInvolvedParty', 'ODYCVCITAlias',
+                 'ODYCVCITAttorney', 'ODYCVCITCourtSchedule',
+                 'ODYCVCITCharge', 'ODYCVCITProbation',
+                 'ODYCVCITRestitution', 'ODYCVCITWarrant',
+                 'ODYCVCITBailBond', 'ODYCVCITBondSetting',
+                 'ODYCVCITDocument', 'ODYCVCITService'],
+    'DSTRAF': ['DSTRAF', 'DSTRAFCharge', 'DSTRAFDisposition', 'DSTRAFDefendant',
+               'DSTRAFEvent', 'DSTRAFTrial', 'DSTRAFRelatedPerson'],
+    'K': ['K', 'KDefendant', 'KCharge', 'KRelatedPerson', 'KPartyAlias', 'KPartyAddress',
+          'KAttorney', 'KCourtSchedule', 'KJudgment', 'KJudgmentModification',
+          'KJudgmentAgainst', 'KJudgmentInFavor', 'KSupportOrder', 'KDocument',
+          'KSentencingNetTools'],
+    'PG': ['PG', 'PGCharge', 'PGDefendant', 'PGDefendantAlias', 'PGOtherParty',
+           'PGAttorney', 'PGCourtSchedule', 'PGDocket', 'PGPlaintiff'],
+    'DV': ['DV', 'DVDefendant', 'DVHearing', 'DVEvent', 'DVDefendantAttorney'],
+    'MCCR': ['MCCR', 'MCCRAttorney', 'MCCRCharge', 'MCCRCourtSchedule', 'MCCRDefendant',
+             'MCCRDocket', 'MCCRBailBond', 'MCCRAudioMedia', 'MCCRJudgment',
+             'MCCRProbationOfficer', 'MCCRAlias', 'MCCRBondRemitter',
+             'MCCRDistrictCourtNumber', 'MCCRTrackingNumber',
+             'MCCRDWIMonitor'],
+    'MCCI': ['MCCI', 'MCCIAttorney', 'MCCICourtSchedule', 'MCCIDefendant', 'MCCIDocket',
+             'MCCIInterestedParty', 'MCCIIssue', 'MCCIJudgment',
+             'MCCIPlaintiff', 'MCCIAlias', 'MCCIWard', 'MCCIAudioMedia',
+             'MCCIGarnishee', 'MCCIResidentAgent'],
+    'PGV': ['PGV', 'PGVDefendant', 'PGVPlaintiff', 'PGVOtherParty', 'PGVAttorney',
+            'PGVJudgment', 'PGVDocket', 'PGVCourtSchedule',
+            'PGVDefendantAlias'],
+    'ODYCOSA': ['ODYCOSA', 'ODYCOSAAttorney', 'ODYCOSADocument', 'ODYCOSAJudgment',
+                'ODYCOSAInvolvedParty', 'ODYCOSAReferenceNumber',
+                'ODYCOSACourtSchedule'],
+    'ODYCOA': ['ODYCOA', 'ODYCOAAttorney', 'ODYCOADocument', 'ODYCOAJudgment',
+               'ODYCOAInvolvedParty', 'ODYCOAReferenceNumber',
+               'ODYCOACourtSchedule'],
+}
+
+__all__ = ['ColumnMetadata', 'Case', 'Scrape', 'ScrapeVersion'] + \
+    [name for names in case_type_models.values() for name in names]
+
+def __getattr__(name):
+    for module_name, names in case_type_models.items():
+        if name in names:
+            module = importlib.import_module(f'.{module_name}', __name__)
+            for model_name in names:
+                globals()[model_name] = getattr(module, model_name)
+            return globals()[name]
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+
+def case_type_module(module_name):
+    __getattr__(case_type_models[module_name][0])
+    return sys.modules[f'{__name__}.{module_name}']
+
+def load_all():
+    for names in case_type_models.values():
+        __getattr__(names[0])
@@ -18,6 +18,7 @@ class Case(TableBase):
     loc = Column(Integer)
     detail_loc = Column(String, enum=True)
     last_scrape = Column(DateTime)
+    scrape_enqueued = Column(DateTime)  # when the case was last sent to the scraper queue
     last_parse = Column(DateTime)
     active = Column(Boolean, nullable=False, server_default='true')
     scrape_exempt = Column(Boolean, nullable=False, server_default='false')
\ No newline at end of file
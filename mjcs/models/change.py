@@ -0,0 +1,17 @@
+from sqlalchemy import Column, BigInteger, DateTime, String, Index, func, text
+from .common import TableBase
+
+class CaseChange(TableBase):
+    '''Append-only log of parsed cases, so downstream consumers can sync only what changed'''
+    __tablename__ = 'case_changes'
+
+    seq = Column(BigInteger, primary_key=True)
+    xid = Column(BigInteger, nullable=False, server_default=text('txid_current()')) # transaction that wrote the change
+    case_number = Column(String, nullable=False)
+    detail_loc = Column(String)
+    last_parse = Column(DateTime)
+    content_hash = Column(String) # sha256 of the parsed case details HTML
+    recorded = Column(DateTime, nullable=False, server_default=func.now())
+
+Index('ix_case_changes_case_number', CaseChange.case_number)
+Index('ix_case_changes_xid_seq', CaseChange.xid, CaseChange.seq)
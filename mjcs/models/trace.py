@@ -0,0 +1,14 @@
+from sqlalchemy import Column, DateTime, String, ForeignKey, Index
+from .common import TableBase
+
+class CaseTrace(TableBase):
+    '''When a case last moved through each stage, for measuring how fresh parsed data is'''
+    __tablename__ = 'case_traces'
+
+    case_number = Column(String, ForeignKey('cases.case_number', ondelete='CASCADE'), primary_key=True)
+    discovered = Column(DateTime) # found by the spider or collector, only set for new cases
+    enqueued = Column(DateTime) # sent to the scraper queue
+    scraped = Column(DateTime)
+    parsed = Column(DateTime)
+
+Index('ix_case_traces_scraped', CaseTrace.scraped)
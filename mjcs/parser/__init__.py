@@ -1,8 +1,11 @@
 from ..config import config
-from ..util import (NoItemsInQueue, db_session, get_detail_loc, send_to_queue)
+from ..util import (NoItemsInQueue, Checkpoint, db_session, get_detail_loc, send_to_queue, log_db_pool_metrics)
 from ..models import Case
+from ..queues import LeaseHeartbeat, PackedMessage, parser_messages
 from sqlalchemy import and_, update, select, text
 from sqlalchemy.exc import PendingRollbackError, IntegrityError
+from collections.abc import Mapping
+import importlib
 import json
 import logging
 from os import getpid, cpu_count
@@ -22,61 +25,69 @@ class UnparsedDataError(BaseParserError):
         self.message = message
         self.content = content
 
-# begin parser module exports
-from .DSCR import DSCRParser
-from .DSCP import DSCPParser
-from .DSK8 import DSK8Parser
-from .DSCIVIL import DSCIVILParser
-from .CC import CCParser
-from .ODYTRAF import ODYTRAFParser
-from .ODYCRIM import ODYCRIMParser
-from .ODYCIVIL import ODYCIVILParser
-from .ODYCVCIT import ODYCVCITParser
-from .DSTRAF import DSTRAFParser
-from .K import KParser
-from .PG import PGParser
-from .DV import DVParser
-from .MCCI import MCCIParser
-from .PGV import PGVParser
-from .MCCR import MCCRParser
-from .ODYCOSA import ODYCOSAParser
-from .ODYCOA import ODYCOAParser
+class ParserRegistry(Mapping):
+    """Maps case types to parser classes, importing each parser module on first use"""
+    def __init__(self, detail_locs):
+        self.detail_locs = detail_locs
+        self.loaded = {}
+
+    def __getitem__(self, detail_loc):
+        if detail_loc not in self.detail_locs:
+            raise KeyError(detail_loc)
+        if detail_loc not in self.loaded:
+            module = importlib.import_module(f'.{detail_loc}', __name__)
+            self.loaded[detail_loc] = getattr(module, f'{detail_loc}Parser')
+        return self.loaded[detail_loc]
+
+    def __iter__(self):
+        return iter(self.detail_locs)
+
+    def __len__(self):
+        return len(self.detail_locs)
 
 # ordered by most common case type
-parsers = {
-    'ODYCIVIL': ODYCIVILParser,
-    'ODYTRAF': ODYTRAFParser,
-    'DSTRAF': DSTRAFParser,
-    'ODYCRIM': ODYCRIMParser,
-    'DSCR': DSCRParser,
-    'DSCIVIL': DSCIVILParser,
-    'CC': CCParser,
-    'MCCI': MCCIParser,
-    'PGV': PGVParser,
-    'DSK8': DSK8Parser,
-    'DV': DVParser,
-    'DSCP': DSCPParser,
-    'PG': PGParser,
-    'ODYCVCIT': ODYCVCITParser,
-    'MCCR': MCCRParser,
-    'K': KParser,
-    'ODYCOSA': ODYCOSAParser,
-    'ODYCOA': ODYCOAParser
-}
+parsers = ParserRegistry([
+    'ODYCIVIL',
+    'ODYTRAF',
+    'DSTRAF',
+    'ODYCRIM',
+    'DSCR',
+    'DSCIVIL',
+    'CC',
+    'MCCI',
+    'PGV',
+    'DSK8',
+    'DV',
+    'DSCP',
+    'PG',
+    'ODYCVCIT',
+    'MCCR',
+    'K',
+    'ODYCOSA',
+    'ODYCOA'
+])
 
-def parse_case(case_number, detail_loc=None, parse_as=None):
-    case_details = config.case_details_bucket.Object(case_number).get()
+def fetch_case_details(case_number):
+    # Uses the S3 client rather than the bucket resource, since clients are thread safe
+    case_details = config.client('s3').get_object(
+        Bucket=config.CASE_DETAILS_BUCKET,
+        Key=case_number
+    )
     case_html = case_details['Body'].read().decode('utf-8')
+    return case_html, case_details['Metadata'].get('detail_loc')
+
+def parse_case(case_number, detail_loc=None, parse_as=None, session=db_session):
+    case_html, metadata_detail_loc = fetch_case_details(case_number)
+    parse_case_html(case_number, case_html, detail_loc or metadata_detail_loc, parse_as, session)
+
+def parse_case_html(case_number, case_html, detail_loc=None, parse_as=None, session=db_session):
     if not detail_loc:
-        try:
-            detail_loc = case_details['Metadata']['detail_loc']
-        except KeyError:
-            detail_loc = get_detail_loc(case_number)
+        detail_loc = get_detail_loc(case_number)
 
     if parse_as:
         logger.debug(f'Parsing case {case_number} as {parse_as}')
         parser = parsers[parse_as]
-        parser(case_number, case_html).parse()
+        parser(case_number, case_html).parse(session)
         logger.debug(f"Successfully parsed {case_number} as {parse_as}")
     else:
         logger.debug(f'Parsing case {case_number}')
@@ -89,7 +100,7 @@ def parse_case(case_number, detail_loc=None, parse_as=None):
                 raise NotImplementedError(err)
             parser = parsers[detail_loc]
             try:
-                parser(case_number, case_html).parse()
+                parser(case_number, case_html).parse(session)
             except BaseParserError:
                 logger.debug(f"Failed to parse {case_number} as current detail_loc {detail_loc}")
             else:
@@ -99,11 +110,13 @@ def parse_case(case_number, detail_loc=None, parse_as=None):
         # Try all parsers
         for category, parser in parsers.items():
             try:
-                parser(case_number, case_html).parse()
+                parser(case_number, case_html).parse(session)
             except BaseParserError:
                 logger.debug(f"Failed to parse {case_number} as {category}")
             else:
                 logger.debug(f"Successfully parsed {case_number} as {category}")
+                if session is not db_session:
+                    return  # detail_loc is updated when offline output is loaded
                 with db_session() as db:
                     db.execute(
                         update(Case)
@@ -121,156 +134,286 @@ def parse_case(case_number, detail_loc=None, parse_as=None):
         raise ParserError(err)
 
 class Parser:
-    def __init__(self, ignore_errors=False, parallel=False):
+    def __init__(self, ignore_errors=False, parallel=False, output_dir=None, output_format='csv'):
         self.ignore_errors = ignore_errors
         self.parallel = parallel
+        self.output_dir = output_dir
+        self.output_format = output_format
         from multiprocessing_logging import install_mp_handler
         install_mp_handler(logger)
 
-    def parse_case(self, case_number, detail_loc=None, parse_as=None):
+    def session(self, previous_versions=None):
+        # Write parsed rows to files instead of the database when an output directory is given
+        if self.output_dir:
+            from .offline import offline_session
+            return offline_session(self.output_dir, self.output_format, previous_versions)
+        return db_session
+
+    def previous_versions(self, case_numbers):
+        '''Look up the previous scrape versions offline parses need for a batch of cases in one query'''
+        if not self.output_dir:
+            return {}
+        from .offline import load_previous_versions
+        with db_session() as db:
+            return load_previous_versions(db, case_numbers)
+
+    def parse_case(self, case_number, detail_loc=None, parse_as=None, previous_versions=None):
         logger.debug(f'Worker {getpid()} parsing {case_number} of type {parse_as or detail_loc}')
-        parse_case(case_number, detail_loc, parse_as)
+        if previous_versions is not None:
+            previous_versions = {case_number: previous_versions}
+        elif self.output_dir:
+            # Called directly (e.g. for a single case), not with a batch's versions
+            previous_versions = self.previous_versions([case_number])
+        parse_case(case_number, detail_loc, parse_as, self.session(previous_versions))
 
-    def parse_unparsed(self, detail_loc=None):
-        logger.info(f'Loading unparsed cases of type {detail_loc if detail_loc else "ANY"} into parser queue')
+    def parse_unparsed(self, detail_loc=None, local=False, checkpoint_file=None):
+        logger.info(f'Loading unparsed cases of type {detail_loc if detail_loc else "ANY"}')
         if detail_loc:
             filter = and_(Case.last_parse == None, Case.last_scrape != None,
                 Case.detail_loc == detail_loc)
         else:
             filter = and_(Case.last_parse == None, Case.last_scrape != None,
                 Case.detail_loc.in_(parsers.keys()))
-        with db_session() as db:
-            self.load_into_queue(db.execute(select(Case.case_number, Case.detail_loc).distinct().where(filter)).all(), config.parser_queue)
+        self.load_cases(filter, local, checkpoint_file)
     
-    def parse_stale(self, detail_loc=None):
-        logger.info(f'Loading stale cases of type {detail_loc if detail_loc else "ANY"} into parser queue')
+    def parse_stale(self, detail_loc=None, local=False, checkpoint_file=None):
+        logger.info(f'Loading stale cases of type {detail_loc if detail_loc else "ANY"}')
         if detail_loc:
             filter = and_(Case.last_parse != None, Case.last_scrape != None,
                 Case.last_parse < Case.last_scrape ,Case.detail_loc == detail_loc)
         else:
             filter = and_(Case.last_parse == None, Case.last_scrape != None,
                 Case.last_parse < Case.last_scrape, Case.detail_loc.in_(parsers.keys()))
-        with db_session() as db:
-            self.load_into_queue(db.execute(select(Case.case_number, Case.detail_loc).distinct().where(filter)).all(), config.parser_queue)
+        self.load_cases(filter, local, checkpoint_file)
 
-    def reparse(self, detail_loc=None):
-        logger.info(f'Loading all cases of type {detail_loc if detail_loc else "ANY"} into parser queue')
+    def reparse(self, detail_loc=None, local=False, checkpoint_file=None):
+        logger.info(f'Loading all cases of type {detail_loc if detail_loc else "ANY"}')
         if detail_loc:
             filter = and_(Case.last_scrape != None,
                 Case.detail_loc == detail_loc)
         else:
             filter = and_(Case.last_scrape != None,
                 Case.detail_loc.in_(parsers.keys()))
-        with db_session() as db:
-            self.load_into_queue(db.execute(select(Case.case_number, Case.detail_loc).distinct().where(filter)).all(), config.parser_queue)
+        self.load_cases(filter, local, checkpoint_file)
+
+    def load_cases(self, filter, local=False, checkpoint_file=None):
+        if local:
+            self.parse_from_database(filter, checkpoint_file)
+        else:
+            logger.info('Loading cases into parser queue')
+            with db_session() as db:
+                self.load_into_queue(db.execute(
+                    select(Case.case_number, Case.detail_loc).distinct().where(filter)
+                    .execution_options(yield_per=config.CASE_BATCH_SIZE)
+                ), config.parser_queue)
 
-    def parse_from_queue(self, queue, parse_as=None):
+    def parse_from_database(self, filter, checkpoint_file=None):
+        """Parse cases streamed from a server-side cursor, bypassing the parser queue.
+
+        Cases are parsed in case number order, and the checkpoint only advances past
+        a case once it and every case before it have finished, so an interrupted
+        run can resume from the checkpoint without skipping anything.
+        """
+        checkpoint = Checkpoint(checkpoint_file)
+        if checkpoint.value:
+            logger.info(f'Resuming after case {checkpoint.value}')
+            filter = and_(filter, Case.case_number > checkpoint.value)
+        query = (
+            select(Case.case_number, Case.detail_loc)
+            .where(filter)
+            .order_by(Case.case_number)
+            .execution_options(yield_per=config.CASE_BATCH_SIZE)
+        )
+        count = 0
+        try:
+            if self.parallel:
+                from multiprocessing import Pool
+                from collections import deque
+                window = cpu_count() * 4  # bound the number of cases waiting on workers
+                in_flight = deque()
+                # start the worker pool before opening the cursor so no connection is shared with workers
+                with Pool() as worker_pool:
+                    with db_session() as db:
+                        for case_number, detail_loc, previous_versions in self.__with_previous_versions(db.execute(query)):
+                            while len(in_flight) >= window:
+                                done_job, done_case_number = in_flight.popleft()
+                                self.__finish_job(done_job, done_case_number)
+                                count += 1
+                                checkpoint.update(done_case_number)
+                            job = worker_pool.apply_async(self.parse_case, (case_number, detail_loc, None, previous_versions))
+                            in_flight.append((job, case_number))
+                    while in_flight:
+                        done_job, done_case_number = in_flight.popleft()
+                        self.__finish_job(done_job, done_case_number)
+                        count += 1
+                        checkpoint.update(done_case_number)
+                    worker_pool.close()
+                    worker_pool.join()
+            else:
+                with db_session() as db:
+                    for case_number, detail_loc, previous_versions in self.__with_previous_versions(db.execute(query)):
+                        try:
+                            self.parse_case(case_number, detail_loc, None, previous_versions)
+                        except NotImplementedError:
+                            pass
+                        except BaseParserError as e:
+                            self.__handle_error(case_number, e)
+                        count += 1
+                        checkpoint.update(case_number)
+        finally:
+            checkpoint.save()
+            logger.info(f'Parsed {count} cases from the database')
+            log_db_pool_metrics()
+
+    def __with_previous_versions(self, rows):
+        '''Yield each case of a query's (case_number, detail_loc) rows with its previous scrape versions'''
+        for batch in rows.partitions():
+            previous = self.previous_versions([case_number for case_number, _ in batch])
+            for case_number, detail_loc in batch:
+                yield case_number, detail_loc, previous.get(case_number)
+
+    def __finish_job(self, job, case_number):
+        try:
+            job.get()  # To re-raise exceptions from child process
+        except NotImplementedError:
+            pass
+        except (BaseParserError, PendingRollbackError, IntegrityError) as e:
+            self.__handle_error(case_number, e)
+
+    def __handle_error(self, case_number, e):
+        if self.ignore_errors:
+            logger.error(f'Error parsing case {case_number} (https://mdcaseexplorer.com/case/{case_number}): {e}', exc_info=not self.ignore_errors)
+        else:
+            logger.error(f'Error parsing case {case_number} (https://mdcaseexplorer.com/case/{case_number})')
+            raise e
+
+    def parse_from_queue(self, queue, parse_as=None, failed_queue=None):
         if parse_as:
             logger.info(f'Parsing cases from queue as {parse_as}')
         else:
             logger.info('Parsing cases from queue')
         
-        if self.parallel:
-            from multiprocessing import Pool
-            cpus = cpu_count()
-            # start worker processes according to available CPU resources
-            with Pool() as worker_pool:
-                jobs = []
+        # Keep received messages hidden from other consumers until they're parsed
+        with LeaseHeartbeat(queue) as heartbeat:
+            if self.parallel:
+                from multiprocessing import Pool
+                cpus = cpu_count()
+                # start worker processes according to available CPU resources
+                with Pool() as worker_pool:
+                    jobs = []
+                    while True:
+                        try:
+                            cases = self.__fetch_cases_from_queue(queue, failed_queue, heartbeat)
+                        except NoItemsInQueue:
+                            logger.info('No items found in queue')
+                            break
+                        previous = self.previous_versions([case_number for case_number, _, _ in cases])
+                        for case_number, detail_loc, packed in cases:
+                            logger.debug(f'Dispatching {case_number} {parse_as or detail_loc} to worker')
+                            def callback_wrapper(case, packed):
+                                def callback(_):
+                                    packed.ack(case)
+                                def error_callback(e):
+                                    packed.ack(case, failed=not isinstance(e, NotImplementedError))
+                                return callback, error_callback
+                            callback, error_callback = callback_wrapper((case_number, detail_loc), packed)
+                            job = worker_pool.apply_async(self.parse_case, (case_number, detail_loc, parse_as, previous.get(case_number)),
+                                callback=callback, error_callback=error_callback)
+                            jobs.append((job, case_number, parse_as or detail_loc))
+                        # Prune completed jobs from active list
+                        while len(jobs) > cpus:
+                            for job, case_number, detail_loc in jobs:
+                                try:
+                                    if job.ready():
+                                        try:
+                                            job.get()  # To re-raise exceptions from child process
+                                        except NotImplementedError:
+                                            pass
+                                        except (BaseParserError, PendingRollbackError, IntegrityError) as e:
+                                            if self.ignore_errors:
+                                                logger.error(f'Error parsing case {case_number} (https://mdcaseexplorer.com/case/{case_number}): {e}', exc_info=not self.ignore_errors)
+                                            else:
+                                                logger.error(f'Error parsing case {case_number} (https://mdcaseexplorer.com/case/{case_number})')
+                                                raise
+                                        jobs.remove((job, case_number, detail_loc))
+                                except ValueError:
+                                    # Job not finished, let it keep running
+                                    pass
+                    logger.info('Wait for remaining jobs to complete before exiting')
+                    for job,_,_ in jobs:
+                        job.wait(timeout=60)
+                    if self.output_dir:
+                        # Let workers exit normally so their output files get closed
+                        worker_pool.close()
+                        worker_pool.join()
+            else:
                 while True:
                     try:
-                        cases = self.__fetch_cases_from_queue(queue)
+                        cases = self.__fetch_cases_from_queue(queue, failed_queue, heartbeat)
                     except NoItemsInQueue:
                         logger.info('No items found in queue')
                         break
-                    for case_number, detail_loc, receipt_handle in cases:
-                        logger.debug(f'Dispatching {case_number} {parse_as or detail_loc} to worker')
-                        def callback_wrapper(case_number, receipt_handle):
-                            def callback(_):
-                                logger.debug(f'Deleting {case_number} from queue')
-                                queue.delete_messages(Entries=[{'Id': 'unused', 'ReceiptHandle': receipt_handle}])
-                            return callback
-                        callback = callback_wrapper(case_number, receipt_handle)
-                        job = worker_pool.apply_async(self.parse_case, (case_number, detail_loc, parse_as), callback=callback, error_callback=callback)
-                        jobs.append((job, case_number, parse_as or detail_loc))
-                    # Prune completed jobs from active list
-                    while len(jobs) > cpus:
-                        for job, case_number, detail_loc in jobs:
-                            try:
-                                if job.ready():
-                                    try:
-                                        job.get()  # To re-raise exceptions from child process
-                                    except NotImplementedError:
-                                        pass
-                                    except (BaseParserError, PendingRollbackError, IntegrityError) as e:
-                                        if self.ignore_errors:
-                                            logger.error(f'Error parsing case {case_number} (https://mdcaseexplorer.com/case/{case_number}): {e}', exc_info=not self.ignore_errors)
-                                        else:
-                                            logger.error(f'Error parsing case {case_number} (https://mdcaseexplorer.com/case/{case_number})')
-                                            raise
-                                    jobs.remove((job, case_number, detail_loc))
-                            except ValueError:
-                                # Job not finished, let it keep running
-                                pass
-                logger.info('Wait for remaining jobs to complete before exiting')
-                for job,_,_ in jobs:
-                    job.wait(timeout=60)
-        else:
-            while True:
-                try:
-                    cases = self.__fetch_cases_from_queue(queue)
-                except NoItemsInQueue:
-                    logger.info('No items found in queue')
-                    break
-                for case_number, detail_loc, receipt_handle in cases:
-                    try:
-                        parse_case(case_number, detail_loc, parse_as)
-                    except NotImplementedError:
-                        pass
-                    except BaseParserError as e:
-                        if self.ignore_errors:
-                            logger.error(f'Error parsing case {case_number} (https://mdcaseexplorer.com/case/{case_number}): {e}', exc_info=not self.ignore_errors)
-                        else:
-                            logger.error(f'Error parsing case {case_number} (https://mdcaseexplorer.com/case/{case_number})')
+                    previous = self.previous_versions([case_number for case_number, _, _ in cases])
+                    for i, (case_number, detail_loc, packed) in enumerate(cases):
+                        try:
+                            self.parse_case(case_number, detail_loc, parse_as, previous.get(case_number))
+                        except NotImplementedError:
+                            packed.ack((case_number, detail_loc))
+                        except BaseParserError as e:
+                            packed.ack((case_number, detail_loc), failed=True)
+                            if self.ignore_errors:
+                                logger.error(f'Error parsing case {case_number} (https://mdcaseexplorer.com/case/{case_number}): {e}', exc_info=not self.ignore_errors)
+                            else:
+                                logger.error(f'Error parsing case {case_number} (https://mdcaseexplorer.com/case/{case_number})')
+                                self.__abandon(cases[i + 1:])
+                                raise
+                        except Exception:
+                            packed.ack((case_number, detail_loc), failed=True)
+                            self.__abandon(cases[i + 1:])
                             raise
-                    finally:
-                        queue.delete_messages(Entries=[{'Id': 'unused', 'ReceiptHandle': receipt_handle}])
-    
+                        except:
+                            # Interrupted, not the case's fault
+                            self.__abandon(cases[i:])
+                            raise
+                        else:
+                            packed.ack((case_number, detail_loc))
+        log_db_pool_metrics()
+
     def load_into_queue(self, results, queue):
-        messages = [
-            json.dumps({
-                'Records': [
-                    {
-                        'manual': {
-                            'case_number': case_number,
-                            'detail_loc': detail_loc
-                        }
-                    }
-                ]
-            }) for case_number, detail_loc in results
-        ]
-        send_to_queue(queue, messages)
-        logger.debug(f'Sent {len(messages)} messages to queue')
+        sent = send_to_queue(queue, parser_messages(results))
+        logger.debug(f'Sent {sent} messages to queue')
 
-    def __fetch_cases_from_queue(self, queue):
+    def __abandon(self, cases):
+        '''Put cases that won't be parsed back on the queue, grouped by their message'''
+        by_message = {}
+        for case_number, detail_loc, packed in cases:
+            by_message.setdefault(packed, []).append((case_number, detail_loc))
+        for packed, packed_cases in by_message.items():
+            packed.abandon(packed_cases)
+
+    def __fetch_cases_from_queue(self, queue, failed_queue=None, heartbeat=None):
         logger.debug('Requesting 10 items from queue')
-        queue_items = queue.receive_messages(
-            WaitTimeSeconds = config.QUEUE_WAIT,
-            MaxNumberOfMessages = 10
-        )
+        queue_items = queue.receive(wait_seconds=config.QUEUE_WAIT)
         if not queue_items:
             raise NoItemsInQueue
+        if heartbeat:
+            heartbeat.add(queue_items)
         cases = []
         for item in queue_items:
-            record = json.loads(item.body)['Records'][0]
-            detail_loc = None
-            if 's3' in record:
-                case_number = record['s3']['object']['key']
-            elif 'Sns' in record:
-                msg = json.loads(record['Sns']['Message'])
-                case_number = msg['case_number']
-                detail_loc = msg['detail_loc']
-            elif 'manual' in record:
-                case_number = record['manual']['case_number']
-                detail_loc = record['manual']['detail_loc']
-            cases.append((case_number, detail_loc, item.receipt_handle))
-        return cases
\ No newline at end of file
+            body = json.loads(item.body)
+            item_cases = []
+            for record in body['Records']:
+                detail_loc = None
+                if 's3' in record:
+                    case_number = record['s3']['object']['key']
+                elif 'Sns' in record:
+                    msg = json.loads(record['Sns']['Message'])
+                    case_number = msg['case_number']
+                    detail_loc = msg['detail_loc']
+                elif 'manual' in record:
+                    case_number = record['manual']['case_number']
+                    detail_loc = record['manual']['detail_loc']
+                item_cases.append((case_number, detail_loc))
+            packed = PackedMessage(queue, item, item_cases, body.get('attempt', 0), parser_messages, failed_queue, heartbeat)
+            cases += [(case_number, detail_loc, packed) for case_number, detail_loc in item_cases]
+        return cases
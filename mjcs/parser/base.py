@@ -4,6 +4,11 @@ from ..util import db_session
 from ..models import Case, Scrape
 from ..config import config
 from . import ParserError, UnparsedDataError, BaseParserError
+from .offline import OfflineSession
+from ..trace import record_parse
+from ..changes import record_change
+from hashlib import sha256
+from functools import cached_property
 import re
 from sqlalchemy.sql import select, text
 from datetime import datetime
@@ -21,6 +26,12 @@ def consumer(func):
 class CaseDetailsParser(ABC):
     inactive_statuses = []
 
+    def __new__(cls, case_number, html):
+        parser = super().__new__(cls)
+        # Kept here rather than in __init__, which some parsers override without calling
+        parser.html = html
+        return parser
+
     def __init__(self, case_number, html):
         # <body> should only have a single child div that holds the data
         self.case_number = case_number
@@ -34,9 +45,18 @@ class CaseDetailsParser(ABC):
         self.marked_for_deletion = []
         self.case_status = None
 
-    def parse(self):
+    @property
+    def detail_loc(self):
+        return inspect.getmodule(self).__name__.split('.')[-1]
+
+    @cached_property
+    def content_hash(self):
+        '''sha256 of the case details HTML, recorded in the change feed'''
+        return sha256(self.html.encode('utf-8')).hexdigest()
+
+    def parse(self, session=db_session):
         # All parsing is done within a single database transaction, so no partial data is added or destroyed
-        with db_session() as db:
+        with session() as db:
             self.header(self.soup)
             self.delete_previous(db)
             self.case(db, self.soup)
@@ -67,11 +87,17 @@ class CaseDetailsParser(ABC):
         self.update_last_parse(db)
 
     def update_last_parse(self, db):
+        if isinstance(db, OfflineSession):
+            db.record_parse(self.case_number, self.detail_loc, datetime.now(), self.is_active(), self.content_hash)
+            return
+        now = datetime.now()
         db.execute(
             Case.__table__.update()
                 .where(Case.case_number == self.case_number)
-                .values(last_parse = datetime.now(), active = self.is_active())
+                .values(last_parse = now, active = self.is_active())
         )
+        record_parse(db, self.case_number, now)
+        record_change(db, self.case_number, self.detail_loc, now, self.content_hash)
 
     def is_active(self):
         if not hasattr(self,'case_status') or self.case_status not in self.inactive_statuses:
@@ -91,6 +117,8 @@ class CaseDetailsParser(ABC):
         raise NotImplementedError
 
     def delete_previous(self, db):
+        if isinstance(db, OfflineSession):
+            return  # the loader deletes previous data when the output is loaded
         # Disable foreign key on delete cascade triggers for performance
         db.execute(text('SET session_replication_role = replica'))
         for _, cls in inspect.getmembers(inspect.getmodule(self), lambda obj: hasattr(obj, '__tablename__')):
@@ -445,21 +473,24 @@ class ChargeFinder(ABC):
 
     def find_charges(self, db, latest_version_charge_numbers):
         logger.debug(f'Finding old charges for {self.case_number}')
-        versions = db.scalars(
-            select(Scrape)
-            .filter_by(case_number=self.case_number)
-            .where(Scrape.s3_version_id != None)
-            .order_by(Scrape.timestamp.desc())
-            .offset(1)
-        )
+        if isinstance(db, OfflineSession):
+            version_ids = db.previous_scrape_versions(self.case_number)
+        else:
+            version_ids = db.scalars(
+                select(Scrape.s3_version_id)
+                .filter_by(case_number=self.case_number)
+                .where(Scrape.s3_version_id != None)
+                .order_by(Scrape.timestamp.desc())
+                .offset(1)
+            ).all()
         
         expunged_charge_numbers = []
-        for version in versions:
-            logger.debug(f'Fetching version {version.s3_version_id}')
+        for version_id in version_ids:
+            logger.debug(f'Fetching version {version_id}')
             html = config.s3.ObjectVersion(
                 config.CASE_DETAILS_BUCKET,
                 self.case_number,
-                version.s3_version_id
+                version_id
             ).get()['Body'].read()
             strainer = SoupStrainer('div',class_='BodyWindow')
             soup = BeautifulSoup(html,'html.parser',parse_only=strainer)
@@ -0,0 +1,376 @@
+from ..util import db_session, get_model_list
+from .. import models
+from ..models import Scrape
+from ..models.common import TableBase
+from contextlib import contextmanager
+from decimal import Decimal
+from datetime import date, datetime, time
+from sqlalchemy import inspect as sa_inspect, text, select, func, Table, MetaData, Column, String, DateTime, Boolean
+from multiprocessing import util as mp_util
+import socket
+import gzip
+import csv
+import io
+import os
+import logging
+
+logger = logging.getLogger('mjcs')
+
+# Marker for NULL values in CSV output, matching the NULL option used by the loader's COPY
+CSV_NULL = r'\N'
+OUTPUT_FORMATS = ['csv', 'parquet']
+
+# Columns of the cases table that get written for each parsed case
+parsed_cases_table = Table('cases', MetaData(),
+    Column('case_number', String),
+    Column('detail_loc', String),
+    Column('last_parse', DateTime),
+    Column('active', Boolean)
+)
+
+# Change feed rows for parsed cases, loaded into case_changes
+parsed_changes_table = Table('case_changes', MetaData(),
+    Column('case_number', String),
+    Column('detail_loc', String),
+    Column('last_parse', DateTime),
+    Column('content_hash', String)
+)
+
+# Per-process writer, so each parser worker process writes to its own set of files
+_writer = None
+
+def get_writer(output_dir, output_format='csv'):
+    global _writer
+    if not _writer or _writer.pid != os.getpid():
+        _writer = ParsedRowWriter(output_dir, output_format)
+        # Pool workers that exit normally run finalizers with an exitpriority
+        mp_util.Finalize(_writer, _writer.close, exitpriority=10)
+    return _writer
+
+def model_row(obj):
+    mapper = sa_inspect(type(obj))
+    return {attr.columns[0].name: getattr(obj, attr.key) for attr in mapper.column_attrs}
+
+def csv_value(val):
+    if val is None:
+        return CSV_NULL
+    elif isinstance(val, (datetime, date, time)):
+        return val.isoformat()
+    return val
+
+
+class ParsedRowWriter:
+    '''Writes parsed rows to <output_dir>/<detail_loc>/<table>/<part>.<ext>
+
+    Every process gets its own part name, and local row IDs are only unique
+    within a part. The loader remaps them onto real sequence values.
+    '''
+    def __init__(self, output_dir, output_format='csv', buffer_rows=10000):
+        if output_format not in OUTPUT_FORMATS:
+            raise Exception(f'Invalid output format {output_format}')
+        self.output_dir = output_dir
+        self.output_format = output_format
+        self.buffer_rows = buffer_rows
+        self.pid = os.getpid()
+        self.part = f'{socket.gethostname()}-{self.pid}'
+        self.ids = {}
+        self.files = {}
+        self.buffers = {}
+
+    def next_id(self, table_name):
+        self.ids[table_name] = self.ids.get(table_name, 0) + 1
+        return self.ids[table_name]
+
+    def path(self, detail_loc, table_name):
+        ext = 'csv.gz' if self.output_format == 'csv' else 'parquet'
+        return os.path.join(self.output_dir, detail_loc, table_name, f'{self.part}.{ext}')
+
+    def write(self, detail_loc, table, rows):
+        key = (detail_loc, table.name)
+        if self.output_format == 'csv':
+            if key not in self.files:
+                path = self.path(detail_loc, table.name)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                f = gzip.open(path, 'wt', newline='', encoding='utf-8')
+                writer = csv.writer(f)
+                writer.writerow([col.name for col in table.columns])
+                self.files[key] = (f, writer)
+            _, writer = self.files[key]
+            for row in rows:
+                writer.writerow([csv_value(row.get(col.name)) for col in table.columns])
+        else:
+            self.buffers.setdefault(key, []).extend(rows)
+            if len(self.buffers[key]) >= self.buffer_rows:
+                self.flush_parquet(detail_loc, table)
+
+    def flush_parquet(self, detail_loc, table):
+        import pyarrow as pa  # optional dependency, only needed for parquet output
+        import pyarrow.parquet as pq
+        key = (detail_loc, table.name)
+        rows = self.buffers.pop(key, [])
+        if not rows:
+            return
+        if key not in self.files:
+            path = self.path(detail_loc, table.name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            self.files[key] = (None, pq.ParquetWriter(path, parquet_schema(table.columns)))
+        _, writer = self.files[key]
+        columns = {col.name: [parquet_value(row.get(col.name)) for row in rows] for col in table.columns}
+        writer.write_table(pa.table(columns, schema=writer.schema))
+
+    def close(self):
+        for detail_loc, table_name in list(self.buffers.keys()):
+            self.flush_parquet(detail_loc, TableBase.metadata.tables[table_name])
+        for f, writer in self.files.values():
+            if f:
+                f.close()
+            else:
+                writer.close()
+        self.files = {}
+
+def parquet_schema(columns):
+    import pyarrow as pa
+    from sqlalchemy import Integer, Boolean, Date, DateTime, Time
+    fields = []
+    for col in columns:
+        if isinstance(col.type, Integer):
+            type_ = pa.int64()
+        elif isinstance(col.type, Boolean):
+            type_ = pa.bool_()
+        elif isinstance(col.type, DateTime):
+            type_ = pa.timestamp('us')
+        elif isinstance(col.type, Date):
+            type_ = pa.date32()
+        elif isinstance(col.type, Time):
+            type_ = pa.time64('us')
+        else:
+            type_ = pa.string()  # Numeric included, so no precision is lost
+        fields.append(pa.field(col.name, type_))
+    return pa.schema(fields)
+
+def parquet_value(val):
+    if isinstance(val, (Decimal, float)):
+        return str(val)
+    return val
+
+
+class OfflineSession:
+    '''Stands in for a database session while parsing a single case.
+
+    Objects added by the parser are assigned local IDs on flush and written out
+    when the parse succeeds, instead of being inserted into the database.
+    Nothing is read from the database either: the previous scrape versions
+    ChargeFinder parsers look through are passed in, from load_previous_versions.
+    '''
+    def __init__(self, writer, previous_versions=None):
+        self.writer = writer
+        self.previous_versions = previous_versions
+        self.pending = []
+        self.objects = []
+        self.case_row = None
+        self.content_hash = None
+
+    def add(self, obj):
+        self.pending.append(obj)
+
+    def add_all(self, objs):
+        self.pending += objs
+
+    def flush(self):
+        for obj in self.pending:
+            table = obj.__table__
+            if 'id' in table.columns and getattr(obj, 'id', None) is None:
+                obj.id = self.writer.next_id(table.name)
+            self.objects.append(obj)
+        self.pending = []
+
+    def previous_scrape_versions(self, case_number):
+        if self.previous_versions is None or case_number not in self.previous_versions:
+            raise Exception(f'No previous scrape versions of {case_number} were passed to the offline session')
+        return self.previous_versions[case_number]
+
+    def record_parse(self, case_number, detail_loc, last_parse, active, content_hash=None):
+        self.content_hash = content_hash
+        self.case_row = {
+            'case_number': case_number,
+            'detail_loc': detail_loc,
+            'last_parse': last_parse,
+            'active': active
+        }
+
+    def commit(self):
+        self.flush()
+        if not self.case_row:
+            return
+        detail_loc = self.case_row['detail_loc']
+        rows = {}
+        for obj in self.objects:
+            rows.setdefault(obj.__table__.name, []).append(model_row(obj))
+        for table_name, table_rows in rows.items():
+            self.writer.write(detail_loc, TableBase.metadata.tables[table_name], table_rows)
+        self.writer.write(detail_loc, parsed_cases_table, [self.case_row])
+        self.writer.write(detail_loc, parsed_changes_table, [{
+            'case_number': self.case_row['case_number'],
+            'detail_loc': detail_loc,
+            'last_parse': self.case_row['last_parse'],
+            'content_hash': self.content_hash
+        }])
+
+def offline_session(output_dir, output_format='csv', previous_versions=None):
+    '''Returns a session factory for CaseDetailsParser.parse that writes to files'''
+    @contextmanager
+    def session():
+        db = OfflineSession(get_writer(output_dir, output_format), previous_versions)
+        yield db
+        db.commit()
+    return session
+
+def load_previous_versions(db, case_numbers):
+    '''Return {case_number: S3 version IDs of every scrape but the latest, newest first}'''
+    versions = (
+        select(
+            Scrape.case_number,
+            Scrape.s3_version_id,
+            func.row_number().over(partition_by=Scrape.case_number, order_by=Scrape.timestamp.desc()).label('n')
+        )
+        .where(Scrape.case_number.in_(case_numbers), Scrape.s3_version_id != None)
+        .subquery()
+    )
+    previous_versions = {case_number: [] for case_number in case_numbers}
+    for case_number, version_id in db.execute(
+            select(versions.c.case_number, versions.c.s3_version_id)
+            .where(versions.c.n > 1)
+            .order_by(versions.c.case_number, versions.c.n)):
+        previous_versions[case_number].append(version_id)
+    return previous_versions
+
+
+def read_part(path):
+    '''Return file-like CSV content (with header) for a part file, converting Parquet if needed'''
+    if path.endswith('.csv.gz'):
+        return gzip.open(path, 'rt', newline='', encoding='utf-8')
+    import pyarrow.parquet as pq
+    table = pq.read_table(path)
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    writer.writerow(table.column_names)
+    for row in table.to_pylist():
+        writer.writerow([csv_value(row[name]) for name in table.column_names])
+    buf.seek(0)
+    return buf
+
+def part_files(output_dir, detail_loc):
+    parts = {}
+    loc_dir = os.path.join(output_dir, detail_loc)
+    for table_name in os.listdir(loc_dir):
+        for filename in os.listdir(os.path.join(loc_dir, table_name)):
+            part = filename.split('.')[0]
+            parts.setdefault(part, {})[table_name] = os.path.join(loc_dir, table_name, filename)
+    return parts
+
+def quote(name):
+    return f'"{name}"'
+
+def copy_into_temp(db, table_name, path):
+    with read_part(path) as f:
+        header = next(csv.reader([f.readline()]))
+        # No constraints are copied, so omitted values can fall back to server defaults on insert
+        db.execute(text(f'CREATE TEMP TABLE tmp_{table_name} ON COMMIT DROP AS SELECT * FROM {table_name} WITH NO DATA'))
+        cursor = db.connection().connection.cursor()
+        cursor.copy_expert(
+            f"COPY tmp_{table_name} ({', '.join(quote(name) for name in header)}) FROM STDIN WITH (FORMAT csv, NULL '{CSV_NULL}')",
+            f
+        )
+    return header
+
+def load_part(db, detail_loc, files):
+    from . import parsers
+    module = models.case_type_module(detail_loc)
+    module_tables = [model.__table__ for model in get_model_list(module) if model.__module__ == module.__name__]
+    tables = [table for table in TableBase.metadata.sorted_tables if table in module_tables]
+
+    # Remove previously parsed data for these cases
+    copy_into_temp(db, 'cases', files['cases'])
+    db.execute(text('SET session_replication_role = replica'))
+    for table in reversed(tables):
+        db.execute(text(f'DELETE FROM {table.name} WHERE case_number IN (SELECT case_number FROM tmp_cases)'))
+    db.execute(text('SET session_replication_role = DEFAULT'))
+
+    # Cases that were parsed as a different type than before lose their old data
+    old_detail_locs = db.scalars(text('''
+        SELECT DISTINCT cases.detail_loc FROM cases JOIN tmp_cases USING (case_number)
+        WHERE cases.detail_loc != tmp_cases.detail_loc
+    ''')).all()
+    for old_detail_loc in old_detail_locs:
+        if old_detail_loc in parsers.keys():
+            db.execute(text(f'''
+                DELETE FROM {old_detail_loc} WHERE case_number IN (
+                    SELECT case_number FROM tmp_cases WHERE detail_loc != :old_detail_loc
+                )
+            '''), {'old_detail_loc': old_detail_loc})
+
+    # Insert new rows, remapping local IDs onto reserved blocks of each table's sequence
+    offsets = {}
+    for table in tables:
+        if table.name not in files:
+            continue
+        columns = copy_into_temp(db, table.name, files[table.name])
+        db.execute(text(f'LOCK TABLE {table.name} IN SHARE ROW EXCLUSIVE MODE'))
+        max_id = db.scalar(text(f'SELECT max(id) FROM tmp_{table.name}')) or 0
+        offset = 0
+        if max_id:
+            first_id = db.scalar(text(f"SELECT nextval(pg_get_serial_sequence('{table.name}', 'id'))"))
+            db.execute(text(f"SELECT setval(pg_get_serial_sequence('{table.name}', 'id'), {first_id + max_id - 1})"))
+            offset = first_id - 1
+        offsets[table.name] = offset
+
+        select_exprs = []
+        for name in columns:
+            col = table.columns[name]
+            expr = f't.{quote(name)}'
+            if name == 'id':
+                expr = f'{expr} + {offset}'
+            else:
+                for fk in col.foreign_keys:
+                    if fk.column.name != 'id':
+                        continue
+                    referenced = fk.column.table.name
+                    if referenced in offsets:
+                        expr = f'{expr} + {offsets[referenced]}'
+                    elif db.scalar(text(f'SELECT EXISTS (SELECT 1 FROM tmp_{table.name} WHERE {quote(name)} IS NOT NULL)')):
+                        raise Exception(f'{table.name}.{name} references {referenced}, which has no rows in this part')
+            if col.server_default is not None:
+                expr = f'COALESCE({expr}, {col.server_default.arg})'
+            select_exprs.append(expr)
+        db.execute(text(f'''
+            INSERT INTO {table.name} ({', '.join(quote(name) for name in columns)})
+            SELECT {', '.join(select_exprs)} FROM tmp_{table.name} t
+        '''))
+
+    db.execute(text('''
+        UPDATE cases SET
+            last_parse = t.last_parse,
+            active = t.active,
+            detail_loc = t.detail_loc
+        FROM tmp_cases t
+        WHERE cases.case_number = t.case_number
+    '''))
+
+    if 'case_changes' in files:
+        columns = ', '.join(quote(name) for name in copy_into_temp(db, 'case_changes', files['case_changes']))
+        db.execute(text(f'INSERT INTO case_changes ({columns}) SELECT {columns} FROM tmp_case_changes'))
+
+def load_parsed_output(output_dir):
+    '''Bulk load files written by an offline parse into the database.
+
+    Loading a part deletes previously parsed data for its cases first, so parts
+    can safely be loaded more than once.
+    '''
+    for detail_loc in sorted(os.listdir(output_dir)):
+        for part, files in part_files(output_dir, detail_loc).items():
+            if 'cases' not in files:
+                logger.warning(f'Skipping {detail_loc} part {part} with no parsed cases')
+                continue
+            logger.info(f'Loading {detail_loc} part {part}')
+            with db_session() as db:
+                load_part(db, detail_loc, files)
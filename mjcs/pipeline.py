@@ -0,0 +1,159 @@
+from .queues import Queue, unpack_scraper_message
+from .spider import SearchNode, FailedSearch, spider_slices
+from .scraper import Scraper, FailedScrape
+from .session import MjcsSession, RequestTimeout, Forbidden, session_pool
+from .parser import parse_case_html, BaseParserError
+from .trace import trace_context
+from datetime import datetime
+import queue
+import threading
+import logging
+
+logger = logging.getLogger('mjcs')
+
+_STOP = object()
+
+class StageQueue(Queue):
+    '''In-memory queue between two pipeline stages.
+
+    Sending blocks while the queue is full, so a fast stage can't run ahead of
+    a slow one.
+    '''
+    def __init__(self, maxsize=0):
+        self.items = queue.Queue(maxsize)
+
+    def send(self, bodies):
+        sent = 0
+        for body in bodies:
+            self.items.put(body)
+            sent += 1
+        return sent
+
+    def count(self):
+        return self.items.qsize()
+
+
+class Pipeline:
+    '''Spiders, scrapes and parses a search range in a single process.
+
+    Each stage runs in its own pool of threads. Newly found cases go straight
+    from the spider to the scrapers, and scraped case details straight to the
+    parsers, instead of going through SQS and S3 event notifications.
+    Scrapes are still stored in S3 and the database as usual.
+    '''
+    def __init__(self, spider_workers=4, scraper_workers=8, parser_workers=2, queue_size=1000, parse=True):
+        self.spider_workers = spider_workers
+        self.scraper_workers = scraper_workers
+        self.parser_workers = parser_workers if parse else 0
+        # Spider workers add child searches to their own queue, so it can't be bounded
+        self.searches = StageQueue()
+        self.scrapes = StageQueue(queue_size)
+        self.parses = StageQueue(queue_size)
+        self.aborted = threading.Event()
+        self.error = None
+        self.lock = threading.Lock()
+        self.queries = 0
+        self.new_cases = 0
+        self.scraped = 0
+        self.parsed = 0
+        self.failed = 0
+
+    def count(self, attr, n=1):
+        with self.lock:
+            setattr(self, attr, getattr(self, attr) + n)
+
+    def abort(self, e):
+        logger.warning(f'Caught {type(e).__name__} error, stopping pipeline: {e}')
+        self.error = e
+        self.aborted.set()
+
+    def worker(self, stage, handle, state):
+        items = stage.items
+        while True:
+            item = items.get()
+            try:
+                if item is _STOP:
+                    return
+                if not self.aborted.is_set():  # after an abort, just drain the queue
+                    handle(item, state)
+            except (RequestTimeout, Forbidden) as e:
+                self.abort(e)
+            except Exception as e:
+                logger.exception(f'Unexpected pipeline error: {e}')
+                self.count('failed')
+            finally:
+                items.task_done()
+
+    def search(self, body, session):
+        node = SearchNode.from_message(body, spider_queue=self.searches, scraper_queue=self.scrapes)
+        try:
+            self.count('new_cases', node.search(session))
+        except FailedSearch as e:
+            logger.warning(f'Search {node.id} failed: {type(e).__name__}')
+            self.count('failed')
+        self.count('queries')
+
+    def scrape(self, body, scraper):
+        cases, _ = unpack_scraper_message(body)
+        already_scraped = scraper.scraped_since_enqueued(cases)
+        for case in cases:
+            case_number = case['case_number']
+            if case_number in already_scraped:
+                continue
+            detail_loc = case.get('detail_loc')
+            try:
+                case_html = scraper.scrape_case(case_number, detail_loc, trace_context(case))
+            except FailedScrape:
+                self.count('failed')
+                continue
+            if case_html:
+                self.count('scraped')
+                if self.parser_workers:
+                    self.parses.items.put((case_number, detail_loc, case_html))
+
+    def parse(self, item, state):
+        case_number, detail_loc, case_html = item
+        try:
+            parse_case_html(case_number, case_html, detail_loc)
+        except NotImplementedError:
+            pass
+        except BaseParserError as e:
+            logger.error(f'Error parsing case {case_number} (https://mdcaseexplorer.com/case/{case_number}): {e}')
+            self.count('failed')
+        else:
+            self.count('parsed')
+
+    def start(self, stage, n, handle, state_factory):
+        threads = []
+        for _ in range(n):
+            thread = threading.Thread(target=self.worker, args=(stage, handle, state_factory()), daemon=True)
+            thread.start()
+            threads.append(thread)
+        return threads
+
+    def stop(self, stage, threads):
+        # Wait for the stage to finish everything sent to it, then its workers
+        stage.items.join()
+        for _ in threads:
+            stage.items.put(_STOP)
+        for thread in threads:
+            thread.join()
+
+    def run(self, range_start_date, range_end_date=None, court=None, site=None):
+        begin = datetime.now()
+        slices = spider_slices(range_start_date, range_end_date or datetime.now(), court, site)
+        logger.info(f'Running pipeline with {len(slices)} search slices')
+        self.searches.send(slices)
+
+        spider_threads = self.start(self.searches, self.spider_workers, self.search, lambda: MjcsSession(pool=session_pool()))
+        scraper_threads = self.start(self.scrapes, self.scraper_workers, self.scrape, Scraper)
+        parser_threads = self.start(self.parses, self.parser_workers, self.parse, lambda: None)
+        self.stop(self.searches, spider_threads)
+        self.stop(self.scrapes, scraper_threads)
+        self.stop(self.parses, parser_threads)
+
+        logger.info(f'Pipeline finished in {(datetime.now() - begin).total_seconds():.0f}s: '
+            f'{self.queries} queries, {self.new_cases} new cases, {self.scraped} scraped, '
+            f'{self.parsed} parsed, {self.failed} failed')
+        if self.error:
+            raise self.error
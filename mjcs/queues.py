@@ -0,0 +1,557 @@
+'''Message queues used to hand work between the spider, scraper and parser.
+
+SQSQueue wraps an SQS queue. SQLiteQueue and MemoryQueue implement the same
+at-least-once semantics locally (messages become visible again if they aren't
+deleted before their visibility timeout), for single node harvests and
+benchmarks without AWS round trips.
+'''
+from .config import config
+from .util import pack_batches, send_batch, SQS_BATCH_MAX_BYTES
+from collections import deque
+import concurrent.futures
+import json
+import threading
+import sqlite3
+import logging
+import time
+import uuid
+import os
+
+logger = logging.getLogger('mjcs')
+
+QUEUE_BACKENDS = ['sqs', 'sqlite', 'memory']
+
+# Packed messages carry many cases each. Scraper messages look like
+#   {"cases": [{"case_number": ..., "detail_loc": ..., "loc": ...}, ...], "attempt": 0}
+# and parser messages like
+#   {"Records": [{"manual": {"case_number": ..., "detail_loc": ...}}, ...], "attempt": 0}
+# Single-case scraper messages ({"case_number": ...}) are still understood.
+
+def pack_messages(records, make_body, max_records):
+    '''Pack records into message bodies of up to max_records records each, within the SQS size limit'''
+    # Several messages go in each SendMessageBatch request, which shares the same size limit
+    max_bytes = SQS_BATCH_MAX_BYTES // 10
+    packed = []
+    packed_bytes = 0
+    for record in records:
+        size = len(json.dumps(record)) + 2
+        if packed and (len(packed) == max_records or packed_bytes + size > max_bytes):
+            yield make_body(packed)
+            packed = []
+            packed_bytes = 0
+        packed.append(record)
+        packed_bytes += size
+    if packed:
+        yield make_body(packed)
+
+def scraper_messages(cases, attempt=0):
+    '''Scraper queue messages for an iterable of {'case_number', 'detail_loc', 'loc'} dicts'''
+    return pack_messages(cases, lambda packed: json.dumps({'cases': packed, 'attempt': attempt}),
+        config.SCRAPER_QUEUE_PACK_SIZE)
+
+def parser_messages(cases, attempt=0):
+    '''Parser queue messages for an iterable of (case_number, detail_loc) tuples'''
+    return pack_messages(
+        ({'manual': {'case_number': case_number, 'detail_loc': detail_loc}} for case_number, detail_loc in cases),
+        lambda packed: json.dumps({'Records': packed, 'attempt': attempt}),
+        config.PARSER_QUEUE_PACK_SIZE
+    )
+
+def unpack_scraper_message(body):
+    '''Returns the message's cases and how many times they have been attempted before'''
+    body = json.loads(body)
+    if 'cases' in body:
+        return body['cases'], body.get('attempt', 0)
+    return [body], 0
+
+
+class PackedMessage:
+    '''Tracks the cases of a packed message as they're acknowledged.
+
+    Once every case has been acknowledged, failed cases are re-enqueued in a
+    new message (or sent to failed_queue, if any, once they've used up their
+    attempts) and the original message is deleted. Acknowledgements can come from any thread.
+    '''
+    def __init__(self, queue, message, cases, attempt, make_messages, failed_queue=None, heartbeat=None):
+        self.queue = queue
+        self.heartbeat = heartbeat
+        self.message = message
+        self.cases = cases
+        self.attempt = attempt
+        self.make_messages = make_messages
+        self.failed_queue = failed_queue
+        self.remaining = len(cases)
+        self.failed = []
+        self.abandoned = []
+        self.lock = threading.Lock()
+        if not cases:
+            self.settle()
+
+    def ack(self, case, failed=False):
+        with self.lock:
+            if failed:
+                self.failed.append(case)
+            self.remaining -= 1
+            finished = self.remaining == 0
+        if finished:
+            self.settle()
+
+    def abandon(self, cases):
+        '''Re-enqueue cases that won't be processed (e.g. when stopping early) without using up an attempt'''
+        with self.lock:
+            self.abandoned += cases
+            self.remaining -= len(cases)
+            finished = self.remaining == 0
+        if finished:
+            self.settle()
+
+    def settle(self):
+        if self.failed:
+            if self.attempt + 1 < config.QUEUE_MAX_ATTEMPTS:
+                self.queue.send(self.make_messages(self.failed, self.attempt + 1))
+            elif self.failed_queue:
+                logger.warning(f'Sending {len(self.failed)} cases to failed queue after {self.attempt + 1} attempts')
+                self.failed_queue.send(self.make_messages(self.failed, self.attempt + 1))
+            else:
+                logger.warning(f'Giving up on {len(self.failed)} cases after {self.attempt + 1} attempts')
+        if self.abandoned:
+            self.queue.send(self.make_messages(self.abandoned, self.attempt))
+        if self.heartbeat:
+            self.heartbeat.remove([self.message])
+        self.queue.delete([self.message])
+
+
+class QueueMessage:
+    def __init__(self, queue, body, receipt_handle, message_id=None):
+        self.queue = queue
+        self.body = body
+        self.receipt_handle = receipt_handle
+        self.message_id = message_id
+
+    def delete(self):
+        self.queue.delete([self])
+
+
+class Queue:
+    '''Interface shared by all queue backends'''
+    def receive(self, max_messages=10, wait_seconds=0):
+        '''Return up to max_messages messages, waiting up to wait_seconds for any to arrive'''
+        raise NotImplementedError
+
+    def delete(self, messages):
+        raise NotImplementedError
+
+    def send(self, bodies):
+        '''Send an iterable of message bodies, returning the number sent'''
+        raise NotImplementedError
+
+    def count(self):
+        '''Approximate number of messages available for receiving'''
+        raise NotImplementedError
+
+    def extend_visibility(self, messages, timeout):
+        '''Keep messages hidden from other consumers for another timeout seconds'''
+        raise NotImplementedError
+
+
+class SQSQueue(Queue):
+    def __init__(self, client, url):
+        # Clients are thread-safe, unlike queue resources, so consumers can use the queue from several threads
+        self.client = client
+        self.url = url
+
+    @property
+    def name(self):
+        return self.url.rsplit('/', 1)[-1]
+
+    def receive(self, max_messages=10, wait_seconds=0):
+        response = self.client.receive_message(
+            QueueUrl = self.url,
+            WaitTimeSeconds = wait_seconds,
+            MaxNumberOfMessages = max_messages
+        )
+        return [
+            QueueMessage(self, item['Body'], item['ReceiptHandle'], item['MessageId'])
+            for item in response.get('Messages', [])
+        ]
+
+    def delete(self, messages):
+        for i in range(0, len(messages), 10):
+            self.client.delete_message_batch(QueueUrl=self.url, Entries=[
+                {'Id': str(idx), 'ReceiptHandle': message.receipt_handle}
+                for idx, message in enumerate(messages[i:i + 10])
+            ])
+
+    def send(self, bodies):
+        start = time.time()
+        sent = 0
+        max_pending = config.QUEUE_SEND_THREADS * 4
+        with concurrent.futures.ThreadPoolExecutor(max_workers=config.QUEUE_SEND_THREADS) as executor:
+            pending = set()
+            for batch in pack_batches(bodies):
+                if len(pending) >= max_pending:
+                    done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                    sent += sum(f.result() for f in done)
+                pending.add(executor.submit(send_batch, self.client, self.url, batch))
+            for future in concurrent.futures.as_completed(pending):
+                sent += future.result()
+        elapsed = time.time() - start
+        if sent:
+            logger.info(f'Sent {sent} messages in {elapsed:.1f}s ({sent / max(elapsed, 0.001):.0f} messages/s)')
+        return sent
+
+    def count(self):
+        response = self.client.get_queue_attributes(QueueUrl=self.url, AttributeNames=['ApproximateNumberOfMessages'])
+        return int(response['Attributes']['ApproximateNumberOfMessages'])
+
+    def extend_visibility(self, messages, timeout):
+        for i in range(0, len(messages), 10):
+            self.client.change_message_visibility_batch(QueueUrl=self.url, Entries=[
+                {'Id': str(idx), 'ReceiptHandle': message.receipt_handle, 'VisibilityTimeout': timeout}
+                for idx, message in enumerate(messages[i:i + 10])
+            ])
+
+
+class MemoryQueue(Queue):
+    '''Queue that lives in this process's memory, shared between its threads'''
+    def __init__(self, name, visibility_timeout=300):
+        self.name = name
+        self.visibility_timeout = visibility_timeout
+        self.ready = deque()
+        self.in_flight = {}  # receipt handle -> (message id, body, visible at)
+        self.next_id = 0
+        self.cond = threading.Condition()
+
+    def _requeue_expired(self, now):
+        expired = [receipt for receipt, (_, _, visible_at) in self.in_flight.items() if visible_at <= now]
+        for receipt in expired:
+            message_id, body, _ = self.in_flight.pop(receipt)
+            self.ready.appendleft((message_id, body))
+        return len(expired)
+
+    def receive(self, max_messages=10, wait_seconds=0):
+        deadline = time.time() + wait_seconds
+        with self.cond:
+            while True:
+                now = time.time()
+                self._requeue_expired(now)
+                if self.ready or now >= deadline:
+                    break
+                self.cond.wait(min(deadline - now, 1))
+            messages = []
+            while self.ready and len(messages) < max_messages:
+                message_id, body = self.ready.popleft()
+                receipt = uuid.uuid4().hex
+                self.in_flight[receipt] = (message_id, body, now + self.visibility_timeout)
+                messages.append(QueueMessage(self, body, receipt, str(message_id)))
+        return messages
+
+    def delete(self, messages):
+        with self.cond:
+            for message in messages:
+                self.in_flight.pop(message.receipt_handle, None)
+
+    def send(self, bodies):
+        sent = 0
+        with self.cond:
+            for body in bodies:
+                self.next_id += 1
+                self.ready.append((self.next_id, body))
+                sent += 1
+            self.cond.notify_all()
+        return sent
+
+    def count(self):
+        with self.cond:
+            self._requeue_expired(time.time())
+            return len(self.ready)
+
+    def extend_visibility(self, messages, timeout):
+        visible_at = time.time() + timeout
+        with self.cond:
+            for message in messages:
+                if message.receipt_handle in self.in_flight:
+                    message_id, body, _ = self.in_flight[message.receipt_handle]
+                    self.in_flight[message.receipt_handle] = (message_id, body, visible_at)
+
+
+class SQLiteQueue(Queue):
+    '''Durable queue stored in a local SQLite database, safe to share between processes'''
+    def __init__(self, name, path, visibility_timeout=300, poll_interval=0.2):
+        self.name = name
+        self.path = path
+        self.visibility_timeout = visibility_timeout
+        self.poll_interval = poll_interval
+        self.local = threading.local()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with self.connection() as conn:
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS messages (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    body TEXT NOT NULL,
+                    visible_at REAL NOT NULL,
+                    receipt_handle TEXT UNIQUE
+                )
+            ''')
+            conn.execute('CREATE INDEX IF NOT EXISTS messages_visible_at ON messages (visible_at)')
+
+    def connection(self):
+        # sqlite3 connections can't be shared between threads or forked processes
+        conn = getattr(self.local, 'conn', None)
+        if not conn or self.local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self.local.conn = conn
+            self.local.pid = os.getpid()
+        return _Transaction(conn)
+
+    def receive(self, max_messages=10, wait_seconds=0):
+        deadline = time.time() + wait_seconds
+        while True:
+            now = time.time()
+            with self.connection() as conn:
+                rows = conn.execute(
+                    'SELECT id, body FROM messages WHERE visible_at <= ? ORDER BY id LIMIT ?',
+                    (now, max_messages)
+                ).fetchall()
+                messages = []
+                for message_id, body in rows:
+                    receipt = uuid.uuid4().hex
+                    conn.execute(
+                        'UPDATE messages SET visible_at = ?, receipt_handle = ? WHERE id = ?',
+                        (now + self.visibility_timeout, receipt, message_id)
+                    )
+                    messages.append(QueueMessage(self, body, receipt, str(message_id)))
+            if messages or now >= deadline:
+                return messages
+            time.sleep(min(self.poll_interval, max(deadline - now, 0)))
+
+    def delete(self, messages):
+        with self.connection() as conn:
+            conn.executemany(
+                'DELETE FROM messages WHERE receipt_handle = ?',
+                [(message.receipt_handle,) for message in messages]
+            )
+
+    def send(self, bodies):
+        sent = 0
+        batch = []
+        for body in bodies:
+            batch.append((body,))
+            if len(batch) == 10000:
+                sent += self._insert(batch)
+                batch = []
+        if batch:
+            sent += self._insert(batch)
+        return sent
+
+    def _insert(self, batch):
+        with self.connection() as conn:
+            conn.executemany('INSERT INTO messages (body, visible_at) VALUES (?, 0)', batch)
+        return len(batch)
+
+    def count(self):
+        with self.connection() as conn:
+            return conn.execute('SELECT count(*) FROM messages WHERE visible_at <= ?', (time.time(),)).fetchone()[0]
+
+    def extend_visibility(self, messages, timeout):
+        visible_at = time.time() + timeout
+        with self.connection() as conn:
+            conn.executemany(
+                'UPDATE messages SET visible_at = ? WHERE receipt_handle = ?',
+                [(visible_at, message.receipt_handle) for message in messages]
+            )
+
+class _Transaction:
+    '''Runs a block in an immediate transaction, so concurrent receivers can't claim the same rows'''
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __enter__(self):
+        self.conn.execute('BEGIN IMMEDIATE')
+        return self.conn
+
+    def __exit__(self, exc_type, exc, tb):
+        self.conn.execute('ROLLBACK' if exc_type else 'COMMIT')
+
+
+class LeaseHeartbeat:
+    '''Extends the visibility timeout of messages while they're being worked on.
+
+    Add messages when they're received and remove them when they're deleted.
+    Every third of the lease timeout, a background thread extends the leases
+    of all current messages, so slow work (like a search that runs up to
+    QUERY_TIMEOUT and renews its session) doesn't make messages reappear on
+    the queue for another worker.
+    '''
+    def __init__(self, queue, lease_timeout=None):
+        self.queue = queue
+        self.lease_timeout = lease_timeout or config.QUEUE_LEASE_TIMEOUT
+        self.interval = max(self.lease_timeout / 3, 1)
+        self.messages = {}  # receipt handle -> message
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.stop()
+
+    def __len__(self):
+        with self.lock:
+            return len(self.messages)
+
+    def add(self, messages):
+        with self.lock:
+            for message in messages:
+                self.messages[message.receipt_handle] = message
+
+    def remove(self, messages):
+        with self.lock:
+            for message in messages:
+                self.messages.pop(message.receipt_handle, None)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread.is_alive():
+            self.thread.join()
+
+    def beat(self):
+        with self.lock:
+            messages = list(self.messages.values())
+        if messages:
+            logger.debug(f'Extending visibility of {len(messages)} messages')
+            self.queue.extend_visibility(messages, self.lease_timeout)
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.beat()
+            except Exception as e:
+                logger.warning(f'Error extending queue message leases: {e}')
+
+
+class QueueConsumer:
+    '''Receives messages in the background, keeping a local buffer of leased messages topped up.
+
+    Iterate over the consumer to get messages, and delete them when they're
+    done; deletes are sent in batches. Messages that are buffered or being
+    worked on are kept leased by a LeaseHeartbeat, so they don't reappear
+    on the queue. Iteration stops once the queue is empty and the buffer has
+    been drained. On close, buffered messages that weren't handed out are
+    released back to the queue.
+
+        with QueueConsumer(config.spider_queue) as consumer:
+            for message in consumer:
+                ...
+                consumer.delete([message])
+    '''
+    def __init__(self, queue, buffer_size=20, receivers=2, lease_timeout=None, wait_seconds=None):
+        self.queue = queue
+        self.buffer_size = buffer_size
+        self.lease_timeout = lease_timeout or config.QUEUE_LEASE_TIMEOUT
+        self.wait_seconds = config.QUEUE_WAIT if wait_seconds is None else wait_seconds
+        self.buffer = deque()
+        self.heartbeat = LeaseHeartbeat(queue, self.lease_timeout)  # buffered and in progress messages
+        self.to_delete = []
+        self.cond = threading.Condition()
+        self.stopped = threading.Event()
+        self.error = None
+        self.receivers = [threading.Thread(target=self._receive, daemon=True) for _ in range(receivers)]
+        self.active_receivers = len(self.receivers)
+        self.flusher = threading.Thread(target=self._flush_periodically, daemon=True)
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def start(self):
+        self.heartbeat.start()
+        for thread in self.receivers:
+            thread.start()
+        self.flusher.start()
+
+    def _receive(self):
+        try:
+            while not self.stopped.is_set():
+                with self.cond:
+                    while len(self.heartbeat) >= self.buffer_size and not self.stopped.is_set():
+                        self.cond.wait(1)
+                    space = min(10, self.buffer_size - len(self.heartbeat))
+                if self.stopped.is_set():
+                    break
+                messages = self.queue.receive(max_messages=max(space, 1), wait_seconds=self.wait_seconds)
+                if not messages:
+                    break  # queue is empty
+                self.heartbeat.add(messages)
+                with self.cond:
+                    self.buffer.extend(messages)
+                    self.cond.notify_all()
+        except Exception as e:
+            logger.error(f'Error receiving from queue: {e}')
+            self.error = e
+        finally:
+            with self.cond:
+                self.active_receivers -= 1
+                self.cond.notify_all()
+
+    def _flush_periodically(self):
+        while not self.stopped.wait(1):
+            try:
+                self.flush()
+            except Exception as e:
+                logger.warning(f'Error deleting queue messages: {e}')
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        with self.cond:
+            while not self.buffer:
+                if not self.active_receivers or self.stopped.is_set():
+                    if self.error:
+                        raise self.error
+                    raise StopIteration
+                self.cond.wait(1)
+            return self.buffer.popleft()
+
+    def delete(self, messages):
+        self.heartbeat.remove(messages)
+        with self.cond:
+            self.to_delete += messages
+            flush = len(self.to_delete) >= 10
+            self.cond.notify_all()
+        if flush:
+            self.flush()
+
+    def send(self, bodies):
+        return self.queue.send(bodies)
+
+    def flush(self):
+        with self.cond:
+            to_delete, self.to_delete = self.to_delete, []
+        if to_delete:
+            self.queue.delete(to_delete)
+
+    def close(self):
+        self.stopped.set()
+        for thread in self.receivers + [self.flusher]:
+            if thread.is_alive():
+                thread.join()
+        self.flush()
+        self.heartbeat.stop()
+        with self.cond:
+            unused = list(self.buffer)
+            self.buffer.clear()
+        if unused:
+            self.queue.extend_visibility(unused, 0)
@@ -0,0 +1,194 @@
+'''Redacted copies of case tables, generated from the redacted column flags on the models.
+
+The redacted schema holds one relation per case table that has redacted
+columns, with those columns left out. It can be built three ways:
+
+- view: plain views over the full tables (what db/sql/redactions.sql sets up)
+- materialized: materialized views, refreshed for the case types that show up
+  in the change feed
+- table: ordinary tables with their own indexes, updated case by case from
+  the change feed
+
+Materialized views and tables are read as fast as the full tables, at the
+cost of lagging behind parsing until the next refresh. The change feed
+position (xid, seq) refreshes have reached is kept in redacted.refresh_state.
+
+The relations have to expose the same columns as db/sql/redactions.sql, which
+sets up the redacted views by hand; create_redacted checks that they do
+before replacing anything.
+'''
+from .changes import fetch_changes, change_position, current_position
+from .export import export_columns
+from .util import db_session, get_case_model_list
+from . import models
+from sqlalchemy import select, text
+import logging
+import re
+import os
+
+logger = logging.getLogger('mjcs')
+
+SCHEMA = 'redacted'
+MODES = ['view', 'materialized', 'table']
+READ_ROLE = 'mjcs_ro_redacted'
+REDACTIONS_SQL = os.path.join(os.path.dirname(__file__), '..', 'db', 'sql', 'redactions.sql')
+
+# pg_class.relkind -> mode
+RELKINDS = {'v': 'view', 'm': 'materialized', 'r': 'table'}
+DROP = {'view': 'VIEW', 'materialized': 'MATERIALIZED VIEW', 'table': 'TABLE'}
+
+def redacted_models():
+    '''Case models with at least one redacted column'''
+    return [
+        model for model in get_case_model_list(models)
+        if any(getattr(col, 'redacted', False) for col in model.__table__.columns)
+    ]
+
+def case_type(model):
+    for detail_loc, names in models.case_type_models.items():
+        if model.__name__ in names:
+            return detail_loc
+
+def redacted_query(table):
+    return select(*export_columns(table, redacted=True))
+
+def has_case_number(table):
+    '''Whether the redacted copy of table keeps its case_number column'''
+    return any(col.name == 'case_number' for col in export_columns(table, redacted=True))
+
+def sql_redacted_columns(path=REDACTIONS_SQL):
+    '''Return {table name: column names} for the views defined in redactions.sql'''
+    with open(path) as f:
+        sql = f.read()
+    return {
+        match.group(1): re.findall(rf'\b{match.group(1)}\.(\w+)', match.group(2))
+        for match in re.finditer(r'CREATE OR REPLACE VIEW redacted\.(\w+)\s+AS\s+SELECT(.*?)\bFROM\b', sql, re.S)
+    }
+
+def check_redacted_columns(path=REDACTIONS_SQL):
+    '''Raise if the generated relations wouldn't expose the same columns as redactions.sql'''
+    expected = sql_redacted_columns(path)
+    generated = {
+        model.__table__.name: [col.name for col in export_columns(model.__table__, redacted=True)]
+        for model in redacted_models()
+    }
+    differences = []
+    for table_name in sorted(expected.keys() | generated.keys()):
+        if table_name not in generated:
+            differences.append(f'{table_name} is in redactions.sql but has no redacted columns')
+        elif table_name not in expected:
+            differences.append(f'{table_name} has redacted columns but is not in redactions.sql')
+        elif set(expected[table_name]) != set(generated[table_name]):
+            differences.append(f'{table_name} would expose {sorted(generated[table_name])}, '
+                f'not {sorted(expected[table_name])}')
+    if differences:
+        raise Exception('Redacted columns differ from redactions.sql: ' + '; '.join(differences))
+
+def compile_query(db, query):
+    return str(query.compile(db.get_bind(), compile_kwargs={'literal_binds': True}))
+
+def current_mode(db, table_name):
+    relkind = db.scalar(text('''
+        SELECT relkind FROM pg_class JOIN pg_namespace ON pg_namespace.oid = relnamespace
+        WHERE nspname = :schema AND relname = :name
+    '''), {'schema': SCHEMA, 'name': table_name})
+    return RELKINDS.get(relkind)
+
+def get_refresh_position(db):
+    row = db.execute(text(f'SELECT xid, seq FROM {SCHEMA}.refresh_state')).first()
+    return tuple(row) if row else None
+
+def set_refresh_position(db, position):
+    db.execute(text(f'UPDATE {SCHEMA}.refresh_state SET xid = :xid, seq = :seq'), dict(zip(('xid', 'seq'), position)))
+
+def create_redacted(mode='view'):
+    '''(Re)create the redacted schema's relations for every redacted model'''
+    if mode not in MODES:
+        raise Exception(f'Invalid redaction mode {mode}')
+    check_redacted_columns()
+    with db_session() as db:
+        db.execute(text(f'CREATE TABLE IF NOT EXISTS {SCHEMA}.refresh_state (xid bigint NOT NULL, seq bigint NOT NULL)'))
+        if get_refresh_position(db) is None:
+            db.execute(text(f'INSERT INTO {SCHEMA}.refresh_state VALUES (0, 0)'))
+        # Changes after this point are applied by the next refresh, even if the copies below include them
+        set_refresh_position(db, current_position(db))
+
+    for model in redacted_models():
+        table = model.__table__
+        name = f'{SCHEMA}.{table.name}'
+        with db_session() as db:
+            existing = current_mode(db, table.name)
+            if existing:
+                db.execute(text(f'DROP {DROP[existing]} {name}'))
+            query = compile_query(db, redacted_query(table))
+            if mode == 'view':
+                db.execute(text(f'CREATE VIEW {name} AS {query}'))
+            else:
+                db.execute(text(f"CREATE {'MATERIALIZED VIEW' if mode == 'materialized' else 'TABLE'} {name} AS {query}"))
+                # A unique index lets materialized views refresh concurrently, without blocking readers
+                db.execute(text(f'CREATE UNIQUE INDEX ix_{table.name}_id ON {name} (id)'))
+                if has_case_number(table):
+                    db.execute(text(f'CREATE INDEX ixh_{table.name}_case_number ON {name} USING hash (case_number)'))
+            db.execute(text(f'REVOKE SELECT ON TABLE public.{table.name} FROM {READ_ROLE}'))
+            db.execute(text(f'GRANT SELECT ON {name} TO {READ_ROLE}'))
+        logger.info(f'Created {name} as {mode}')
+
+def refresh_redacted(page_size=1000):
+    '''Bring materialized views and tables in the redacted schema up to date with the change feed'''
+    with db_session() as db:
+        after = get_refresh_position(db)
+    if after is None:
+        raise Exception(f'No {SCHEMA}.refresh_state, create the redacted relations first')
+
+    redacted = {model.__table__.name: model for model in redacted_models()}
+    with db_session() as db:
+        modes = {table_name: current_mode(db, table_name) for table_name in redacted}
+    tables = [name for name, mode in modes.items() if mode == 'table']
+    materialized = [name for name, mode in modes.items() if mode == 'materialized']
+
+    changed_types = set()
+    cases = 0
+    while True:
+        with db_session() as db:
+            page = fetch_changes(db, after, page_size)
+            if not page:
+                break
+            case_numbers = list({change['case_number'] for change in page})
+            changed_types.update(change['detail_loc'] for change in page)
+            # A reparse can move a case between case types, so check every table, not just its current type's
+            for table_name in tables:
+                table = redacted[table_name].__table__
+                params = {'case_numbers': case_numbers}
+                query = compile_query(db, redacted_query(table))
+                if has_case_number(table):
+                    db.execute(text(f'DELETE FROM {SCHEMA}.{table_name} WHERE case_number = ANY(:case_numbers)'), params)
+                    db.execute(text(f'INSERT INTO {SCHEMA}.{table_name} {query} WHERE case_number = ANY(:case_numbers)'), params)
+                else:
+                    # Rows replaced by the reparse are deleted below, since they can't be found by case number
+                    db.execute(text(f'INSERT INTO {SCHEMA}.{table_name} {query} WHERE case_number = ANY(:case_numbers) '
+                        'ON CONFLICT (id) DO NOTHING'), params)
+            after = change_position(page[-1])
+            if not materialized:
+                set_refresh_position(db, after)
+        cases += len(case_numbers)
+        if len(page) < page_size:
+            break
+
+    for table_name in tables:
+        if not has_case_number(redacted[table_name].__table__):
+            with db_session() as db:
+                db.execute(text(f'''
+                    DELETE FROM {SCHEMA}.{table_name} r
+                    WHERE NOT EXISTS (SELECT 1 FROM public.{table_name} t WHERE t.id = r.id)
+                '''))
+
+    for table_name in materialized:
+        if case_type(redacted[table_name]) in changed_types:
+            with db_session() as db:
+                db.execute(text(f'REFRESH MATERIALIZED VIEW CONCURRENTLY {SCHEMA}.{table_name}'))
+            logger.info(f'Refreshed {SCHEMA}.{table_name}')
+    if materialized:
+        with db_session() as db:
+            set_refresh_position(db, after)
+    logger.info(f'Applied {cases} changed cases to {len(tables)} redacted tables')
+    return after
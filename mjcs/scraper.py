@@ -1,13 +1,15 @@
 from .config import config
-from .session import MjcsSession, RequestTimeout, Forbidden
-from .util import db_session, get_detail_loc, send_to_queue, get_queue_count, RepeatedTimer
+from .session import MjcsSession, RequestTimeout, Forbidden, session_pool
+from .util import db_session, get_detail_loc, send_to_queue, get_queue_count, claim_for_scraping, release_from_scraping
 from .models import ScrapeVersion, Scrape, Case
+from .metrics import MetricsReporter, registry, scrape_outcomes, s3_write_seconds, db_write_seconds
+from .trace import trace_context, record_scrape
+from .queues import QueueConsumer, PackedMessage, scraper_messages, unpack_scraper_message
 from hashlib import sha256
 import logging
 import botocore
 import boto3
 import re
-import json
 import time
 import requests
 from datetime import datetime, timedelta
@@ -55,7 +57,6 @@ class Scraper:
         self.scrapes = 0
         self.last_scrape_count = 0
         self.last_request_count = 0
-        self.metrics = []
     
     @property
     def instance_id(self):
@@ -67,7 +68,7 @@ class Scraper:
     @property
     def session(self):
         if not hasattr(self, '_session'):
-            self._session = MjcsSession()
+            self._session = MjcsSession(pool=session_pool())
         return self._session
 
     def record_metrics(self):
@@ -90,7 +91,27 @@ class Scraper:
                 'Value': config.environment
             }
         ]
-        self.metrics += [
+        metrics = []
+        pool = self.session.pool
+        if pool:
+            renewals, renewal_ms = pool.take_renewal_metrics()
+            metrics += [
+                {
+                    'MetricName': 'SessionRenewals',
+                    'Dimensions': dimensions,
+                    'Timestamp': now,
+                    'Value': renewals
+                },
+                {
+                    'MetricName': 'SessionRenewalLatency',
+                    'Dimensions': dimensions,
+                    'Timestamp': now,
+                    'Value': renewal_ms,
+                    'Unit': 'Milliseconds'
+                }
+            ]
+        metrics += registry.cloudwatch_data(dimensions)
+        metrics += [
             {
                 'MetricName': 'Scrapes',
                 'Dimensions': dimensions,
@@ -104,12 +125,7 @@ class Scraper:
                 'Value': delta_requests
             }
         ]
-        
-    def report(self):
-        config.boto3_session.client('cloudwatch').put_metric_data(
-            Namespace='CaseHarvester',
-            MetricData=self.metrics
-        )
+        return metrics
 
     def stale_filter(self, range_start_date=None, range_end_date=None, include_unscraped=False, include_inactive=False):
         or_filters = [and_(
@@ -167,54 +183,65 @@ class Scraper:
             partitions = db.execute(
                 select(Case.case_number, Case.detail_loc)
                 .where(filter)
-                .execution_options(yield_per=10)
+                .execution_options(yield_per=config.CASE_BATCH_SIZE)
             ).partitions()
             for partition in partitions:
-                # add cases to scraper queue
-                messages = [
-                    json.dumps({
-                        'case_number': case[0],
-                        'detail_loc': case[1]
-                    }) for case in partition
-                ]
-                send_to_queue(config.scraper_queue, messages)
-                logger.info(f'Submitted {len(partition)} cases for rescraping')
-                total += len(partition)
+                # add cases to scraper queue, skipping ones still waiting there from a previous run
+                with db_session() as claim_db:
+                    claimed = claim_for_scraping(claim_db, [case[0] for case in partition])
+                send_to_queue(config.scraper_queue, scraper_messages(claimed))
+                logger.info(f'Submitted {len(claimed)} cases for rescraping ({len(partition) - len(claimed)} already enqueued)')
+                total += len(claimed)
         
         logger.info(f"Submitted a total of {total} cases for rescraping")
 
     def scrape_from_queue(self, record_metrics=False):
         if record_metrics:
-            timer = RepeatedTimer(60, self.record_metrics)
-            timer.start()
+            # Sends metrics every minute while running, so dashboards stay live
+            reporter = MetricsReporter(self.record_metrics).start()
         try:
-            while True:
-                queue_items = config.scraper_queue.receive_messages(
-                    WaitTimeSeconds = config.QUEUE_WAIT,
-                    MaxNumberOfMessages = 10
-                )
-                if queue_items:
-                    for item in queue_items:
-                        body = json.loads(item.body)
-                        case_number = body['case_number']
-                        detail_loc = body.get('detail_loc')
+            # Prefetch the next few messages in the background, so the next case never waits on the
+            # queue. Their leases are kept extended while they wait and while their cases are scraped
+            with QueueConsumer(config.scraper_queue, buffer_size=config.SCRAPER_QUEUE_BUFFER,
+                    receivers=config.SCRAPER_QUEUE_RECEIVERS) as consumer:
+                for item in consumer:
+                    cases, attempt = unpack_scraper_message(item.body)
+                    packed = PackedMessage(consumer, item, cases, attempt, scraper_messages)
+                    already_scraped = self.scraped_since_enqueued(cases)
+                    for i, case in enumerate(cases):
+                        if case['case_number'] in already_scraped:
+                            logger.debug(f"Skipping {case['case_number']}, already scraped since it was enqueued")
+                            packed.ack(case)
+                            continue
                         try:
-                            self.scrape_case(case_number, detail_loc)
+                            self.scrape_case(case['case_number'], case.get('detail_loc'), trace_context(case))
                         except FailedScrape:
                             pass
-                        item.delete()
-                else:
-                    logger.info('No items in scraper queue.')
-                    break
+                        except:
+                            # Put the rest of the message's cases back on the queue before stopping
+                            packed.abandon(cases[i:])
+                            raise
+                        packed.ack(case)
+            logger.info('No items in scraper queue.')
         finally:
             if record_metrics:
-                timer.stop()
-                self.record_metrics()
-                self.report()
+                reporter.stop()
             logger.info(f'Number of requests: {self.session.requests}')
             logger.info(f'Number of scrapes: {self.scrapes}')
 
-    def scrape_case(self, case_number, detail_loc=None):
+    def scraped_since_enqueued(self, cases):
+        '''Return the case numbers of queued cases that have been scraped since they were enqueued'''
+        enqueued = {case['case_number']: datetime.fromisoformat(case['enqueued']) for case in cases if case.get('enqueued')}
+        if not enqueued:
+            return set()
+        with db_session() as db:
+            last_scrapes = db.execute(
+                select(Case.case_number, Case.last_scrape)
+                .where(Case.case_number.in_(enqueued.keys()), Case.last_scrape != None)
+            ).all()
+        return {case_number for case_number, last_scrape in last_scrapes if last_scrape >= enqueued[case_number]}
+
+    def scrape_case(self, case_number, detail_loc=None, trace=None):
         logger.debug(f"Requesting case details for {case_number}")
         begin = datetime.now()
 
@@ -231,6 +258,9 @@ class Scraper:
             raise Forbidden
         elif response.status_code != 200:
             logger.debug(f"Failed to retrieve search page: {response.status_code}")
+            scrape_outcomes.inc(outcome='FailedScrapeUnknownError')
+            with db_session() as db:
+                release_from_scraping(db, [case_number])
             raise FailedScrapeUnknownError(response.text)
         
         soup = BeautifulSoup(response.text, 'html.parser')
@@ -258,10 +288,15 @@ class Scraper:
             self.__check_scrape_response(case_number, response)
         except (FailedScrapeTimeout, FailedScrape500, FailedScrapeUnexpectedError, FailedScrapeUnknownError) as e:
             logger.debug(f'Scrape error {type(e).__name__}: {e}')
+            scrape_outcomes.inc(outcome=type(e).__name__)
+            # The case won't be retried from the queue, so let the next rescrape pick it up
+            with db_session() as db:
+                release_from_scraping(db, [case_number])
             time.sleep(1) #anti hammer
         except FailedScrape as e:
             logger.debug(f'Scrape error {type(e).__name__}: {e}')
-            with db_session() as db:
+            scrape_outcomes.inc(outcome=type(e).__name__)
+            with db_write_seconds.time(stage='scraper'), db_session() as db:
                 scrape = Scrape(
                     case_number=case_number,
                     timestamp=begin,
@@ -269,6 +304,7 @@ class Scraper:
                     error=type(e).__name__
                 )
                 db.add(scrape)
+                release_from_scraping(db, [case_number])
                 # if 3 bad scrapes, scrape_exempt = True
                 scrape_error_count = db.scalar(
                     select(func.count())
@@ -283,7 +319,9 @@ class Scraper:
                             .values(scrape_exempt=True)
                     )
         else:
-            self.__store_case_details(case_number, detail_loc, response.text, begin, duration)
+            scrape_outcomes.inc(outcome='success')
+            self.__store_case_details(case_number, detail_loc, response.text, begin, duration, trace)
+            return response.text
 
     def __check_scrape_response(self, case_number, response):
         if response.status_code == 500:
@@ -308,7 +346,7 @@ class Scraper:
                 not re.search(r'[- ]*'.join(case_number.lower()),response.text)):
             raise FailedScrapeNoCaseNumber
 
-    def __store_case_details(self, case_number, detail_loc, html, timestamp, scrape_duration=None):
+    def __store_case_details(self, case_number, detail_loc, html, timestamp, scrape_duration=None, trace=None):
         add = False
         with db_session() as db:
             latest_sha256 = db.scalars(
@@ -333,25 +371,28 @@ class Scraper:
                     .where(Case.case_number == case_number)
                     .values(last_scrape = timestamp)
             )
+            if trace:
+                record_scrape(db, case_number, trace, timestamp)
 
             if add:
-                obj = config.case_details_bucket.put_object(
-                    Body = html,
-                    Key = case_number,
-                    Metadata = {
-                        'timestamp': timestamp.isoformat(),
-                        'detail_loc': detail_loc or 'Unknown'
-                    }
-                )
-                try:
-                    version_id = obj.version_id
-                except botocore.exceptions.ClientError as e:
-                    logger.debug(f'S3 error {type(e).__name__}: {e}')
-                    # Sometimes the version_id property isn't available from S3 when we first try to access it, so wait and try again
-                    time.sleep(5)
-                    version_id = obj.version_id
-
-                with db_session() as db:
+                with s3_write_seconds.time():
+                    obj = config.case_details_bucket.put_object(
+                        Body = html,
+                        Key = case_number,
+                        Metadata = {
+                            'timestamp': timestamp.isoformat(),
+                            'detail_loc': detail_loc or 'Unknown'
+                        }
+                    )
+                    try:
+                        version_id = obj.version_id
+                    except botocore.exceptions.ClientError as e:
+                        logger.debug(f'S3 error {type(e).__name__}: {e}')
+                        # Sometimes the version_id property isn't available from S3 when we first try to access it, so wait and try again
+                        time.sleep(5)
+                        version_id = obj.version_id
+
+                with db_write_seconds.time(stage='scraper'), db_session() as db:
                     scrape_version = ScrapeVersion(
                         s3_version_id = version_id,
                         case_number = case_number,
@@ -1,7 +1,11 @@
 from .config import config
+from .metrics import mjcs_request_seconds
+from collections import deque
+import threading
 import logging
 import requests
 import time
+import os
 from bs4 import BeautifulSoup
 # from pypasser import reCaptchaV3
 
@@ -13,12 +17,209 @@ class RequestTimeout(Exception):
 class Forbidden(Exception):
     pass
 
+class RateGovernor:
+    '''Token bucket that paces requests to MJCS, with a rate that adapts to how MJCS is responding.
+
+    The rate starts at (and never goes above) the target rate. It increases
+    additively while responses are fast and healthy, and is cut
+    multiplicatively on 403s, 500s, timeouts and slow responses (AIMD).
+    Cuts are limited to one per cooldown, so a burst of failures from
+    concurrent sessions only counts once.
+    '''
+    def __init__(self, target_rate, min_rate, burst=1, increase=0.05, decrease=0.5, slow_response=10, cooldown=10):
+        self.target_rate = target_rate
+        self.min_rate = min(min_rate, target_rate)
+        self.burst = burst
+        self.increase = increase # requests/sec gained per second of healthy responses
+        self.decrease = decrease # factor applied to the rate on distress
+        self.slow_response = slow_response # seconds
+        self.cooldown = cooldown # seconds between rate cuts
+        self.rate = target_rate
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.last_decrease = 0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        '''Block until a request may be sent'''
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            # Reserve a token even if the bucket is empty, so waiting requests go in order
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait:
+            time.sleep(wait)
+
+    def record(self, latency, status_code=None, timed_out=False):
+        '''Adjust the rate based on one response (or a timeout, with no status code)'''
+        distressed = timed_out or status_code in (403, 500) or latency > self.slow_response
+        with self.lock:
+            now = time.monotonic()
+            if distressed:
+                if now - self.last_decrease < self.cooldown:
+                    return
+                self.last_decrease = now
+                old_rate = self.rate
+                self.rate = max(self.min_rate, self.rate * self.decrease)
+                logger.info(f'Slowing MJCS requests from {old_rate:.2f}/s to {self.rate:.2f}/s '
+                    f'(status {status_code}, {latency:.1f}s{", timed out" if timed_out else ""})')
+            else:
+                # Additive increase of `increase` per second at the current rate
+                self.rate = min(self.target_rate, self.rate + self.increase / self.rate)
+
+_governor = None
+_governor_lock = threading.Lock()
+
+def rate_governor():
+    '''Return the RateGovernor shared by every session in this process, or None if rate limiting is off'''
+    global _governor
+    if not config.MJCS_TARGET_RATE:
+        return None
+    with _governor_lock:
+        if not _governor or _governor.pid != os.getpid():
+            _governor = RateGovernor(
+                target_rate = config.MJCS_TARGET_RATE,
+                min_rate = config.MJCS_MIN_RATE,
+                burst = config.MJCS_RATE_BURST,
+                slow_response = config.MJCS_SLOW_RESPONSE
+            )
+            _governor.pid = os.getpid()
+        return _governor
+
+
+class MjcsSessionPool:
+    '''Keeps a few authenticated MJCS sessions ready, so expiring sessions can be swapped for warm ones.
+
+    A background thread authenticates spare sessions and replaces spares
+    once they're half of max_age old, so a session handed out is good for at
+    least another max_age / 2 seconds. Sessions that reach max_age are
+    swapped for a spare before their next request, instead of finding out
+    they've expired mid-scrape and renewing inline.
+    '''
+    def __init__(self, size, max_age, governor=None):
+        self.size = size
+        self.max_age = max_age # seconds
+        self.governor = governor
+        self.spares = deque() # (requests.Session, authenticated_at)
+        self.cond = threading.Condition()
+        self.stopped = threading.Event()
+        self.thread = None
+        self.renewals = 0
+        self.renewal_failures = 0
+        self.renewal_time = 0.0
+        self.warm_checkouts = 0
+        self.cold_checkouts = 0
+        self.inline_renewals = 0
+        self.reported = (0, 0.0)
+
+    def start(self):
+        if not self.thread:
+            self.thread = threading.Thread(target=self.run, name='mjcs-session-pool', daemon=True)
+            self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+        with self.cond:
+            self.cond.notify_all()
+
+    def authenticate(self):
+        '''Return a newly authenticated requests session and when it was authenticated'''
+        mjcs_session = MjcsSession(self.governor)
+        begin = time.monotonic()
+        try:
+            mjcs_session.renew()
+        except:
+            with self.cond:
+                self.renewal_failures += 1
+            raise
+        with self.cond:
+            self.renewals += 1
+            self.renewal_time += time.monotonic() - begin
+        return mjcs_session.session, time.monotonic()
+
+    def get(self):
+        '''Take a warm session, or authenticate one now if there are no spares'''
+        with self.cond:
+            if self.spares:
+                self.warm_checkouts += 1
+                self.cond.notify_all() # so the renewal thread replaces it
+                return self.spares.popleft()
+            self.cold_checkouts += 1
+        return self.authenticate()
+
+    def run(self):
+        while not self.stopped.is_set():
+            with self.cond:
+                now = time.monotonic()
+                while self.spares and now - self.spares[0][1] > self.max_age / 2:
+                    self.spares.popleft()
+                if len(self.spares) >= self.size:
+                    # Sleep until the oldest spare needs replacing, or a spare is taken
+                    self.cond.wait(self.spares[0][1] + self.max_age / 2 - now)
+                    continue
+            try:
+                spare = self.authenticate()
+            except Exception as e:
+                logger.warning(f'Failed to renew MJCS session in the background: {e}')
+                self.stopped.wait(30)
+                continue
+            with self.cond:
+                self.spares.append(spare)
+
+    def metrics(self):
+        with self.cond:
+            return {
+                'renewals': self.renewals,
+                'renewal_failures': self.renewal_failures,
+                'avg_renewal_ms': self.renewal_time / self.renewals * 1000 if self.renewals else 0,
+                'warm_checkouts': self.warm_checkouts,
+                'cold_checkouts': self.cold_checkouts,
+                'inline_renewals': self.inline_renewals,
+                'spares': len(self.spares)
+            }
+
+    def take_renewal_metrics(self):
+        '''Return the number of renewals and their average latency (ms) since the last call'''
+        with self.cond:
+            renewals = self.renewals - self.reported[0]
+            renewal_time = self.renewal_time - self.reported[1]
+            self.reported = (self.renewals, self.renewal_time)
+        return renewals, renewal_time / renewals * 1000 if renewals else 0
+
+_session_pool = None
+_session_pool_lock = threading.Lock()
+
+def session_pool():
+    '''Return the MjcsSessionPool shared by this process, or None if it's disabled'''
+    global _session_pool
+    if not config.MJCS_SESSION_POOL_SIZE:
+        return None
+    with _session_pool_lock:
+        if not _session_pool or _session_pool.pid != os.getpid():
+            _session_pool = MjcsSessionPool(
+                size = config.MJCS_SESSION_POOL_SIZE,
+                max_age = config.MJCS_SESSION_MAX_AGE,
+                governor = rate_governor()
+            ).start()
+            _session_pool.pid = os.getpid()
+        return _session_pool
+
+
 class MjcsSession:
-    def __init__(self):
-        self.new_session()
+    def __init__(self, governor=None, pool=None):
         self.requests = 0
-    
+        self.governor = governor or rate_governor()
+        self.pool = pool
+        self.new_session()
+
     def new_session(self):
+        if self.pool:
+            self.session, self.authenticated_at = self.pool.get()
+            return
+        self.authenticated_at = None
         self.session = requests.Session()
         # Because all it takes to bypass DataDome is a few headers...
         self.session.headers.update({
@@ -28,11 +229,38 @@ class MjcsSession:
             'Accept-Language': 'en-US,en;q=0.9'
         })
 
+    def send(self, *args, **kwargs):
+        '''Send a request through the rate governor, recording its response time'''
+        self.requests += 1
+        url = kwargs['url'] if 'url' in kwargs else args[1]
+        endpoint = url.split('?')[0].rsplit('/', 1)[-1]
+        if self.governor:
+            self.governor.acquire()
+        begin = time.monotonic()
+        try:
+            response = self.session.request(*args, **kwargs)
+        except requests.Timeout:
+            latency = time.monotonic() - begin
+            mjcs_request_seconds.observe(latency, endpoint=endpoint, status='timeout')
+            if self.governor:
+                self.governor.record(latency, timed_out=True)
+            raise
+        latency = time.monotonic() - begin
+        mjcs_request_seconds.observe(latency, endpoint=endpoint, status=response.status_code)
+        if self.governor:
+            self.governor.record(
+                latency,
+                response.status_code,
+                timed_out = 'Sorry, but your query has timed out' in response.text
+            )
+        return response
+
     def request(self, *args, i=1, **kwargs):
         if i > 2:
             raise Exception('Too many recursed requests')
-        self.requests += 1
-        response = self.session.request(
+        if self.pool and time.monotonic() - self.authenticated_at > self.pool.max_age:
+            self.new_session()
+        response = self.send(
             *args, 
             **kwargs,
             timeout=config.QUERY_TIMEOUT
@@ -42,13 +270,15 @@ class MjcsSession:
                     response.history[0].headers['location'] == f'{config.MJCS_BASE_URL}/inquiry-index.jsp')
                 or "Acceptance of the following agreement is" in response.text):
             logger.debug("Renewing session...")
+            if self.pool:
+                with self.pool.cond:
+                    self.pool.inline_renewals += 1
             self.renew()
             return self.request(*args, i=i+1, **kwargs)
         return response
 
     def renew(self):
-        self.requests += 1
-        response = self.session.request(
+        response = self.send(
             'GET',
             f'{config.MJCS_BASE_URL}/inquiry-index.jsp'
         )
@@ -57,8 +287,7 @@ class MjcsSession:
 
         # captcha_endpoint = 'https://www.google.com/recaptcha/api2/anchor?ar=1&k=6LeZrYYbAAAAAKAZ8DD6m9pYpfd-9-zgw7AHNX02&co=aHR0cHM6Ly9jYXNlc2VhcmNoLmNvdXJ0cy5zdGF0ZS5tZC51czo0NDM.&hl=en&v=UrRmT3mBwY326qQxUfVlHu1P&size=invisible&sa=submit&cb=y2j4jglyhuqt'
         # recaptcha_response = reCaptchaV3(captcha_endpoint)
-        self.requests += 1
-        response = self.session.request(
+        response = self.send(
             'POST',
             f'{config.MJCS_BASE_URL}/processDisclaimer.jis',
             data = {
@@ -75,5 +304,5 @@ class MjcsSession:
             err = f"Failed to authenticate with MJCS: code = {response.status_code}, body = {response.text}"
             logger.error(err)
             raise Exception(err)
-        
+        self.authenticated_at = time.monotonic()
         return response
\ No newline at end of file
@@ -1,10 +1,13 @@
 from .config import config
-from .util import send_to_queue, db_session, split_date_range, RepeatedTimer
+from .util import send_to_queue, db_session, split_date_range
 from .models import Case
-from .session import MjcsSession, RequestTimeout, Forbidden
+from .metrics import MetricsReporter, registry, search_outcomes, search_result_rows, db_write_seconds
+from .queues import QueueConsumer, scraper_messages
+from .session import MjcsSession, RequestTimeout, Forbidden, session_pool
 from datetime import datetime, timedelta
 from bs4 import BeautifulSoup
 from sqlalchemy import select
+from sqlalchemy.dialects.postgresql import insert
 import xml.etree.ElementTree as ElementTree
 import json
 import logging
@@ -52,7 +55,6 @@ class Spider:
         self.last_request_count = 0
         self.last_query_count = 0
         self.last_new_case_count = 0
-        self.metrics = []
     
     @property
     def instance_id(self):
@@ -64,7 +66,7 @@ class Spider:
     @property
     def session(self):
         if not hasattr(self, '_session'):
-            self._session = MjcsSession()
+            self._session = MjcsSession(pool=session_pool())
         return self._session
 
     def record_metrics(self):
@@ -91,7 +93,27 @@ class Spider:
                 'Value': config.environment
             }
         ]
-        self.metrics += [
+        metrics = []
+        pool = self.session.pool
+        if pool:
+            renewals, renewal_ms = pool.take_renewal_metrics()
+            metrics += [
+                {
+                    'MetricName': 'SessionRenewals',
+                    'Dimensions': dimensions,
+                    'Timestamp': now,
+                    'Value': renewals
+                },
+                {
+                    'MetricName': 'SessionRenewalLatency',
+                    'Dimensions': dimensions,
+                    'Timestamp': now,
+                    'Value': renewal_ms,
+                    'Unit': 'Milliseconds'
+                }
+            ]
+        metrics += registry.cloudwatch_data(dimensions)
+        metrics += [
             {
                 'MetricName': 'SpiderRequests',
                 'Dimensions': dimensions,
@@ -111,55 +133,36 @@ class Spider:
                 'Value': delta_new_cases
             }
         ]
-    
-    def report(self):
-        config.boto3_session.client('cloudwatch').put_metric_data(
-            Namespace='CaseHarvester',
-            MetricData=self.metrics
-        )
+        return metrics
 
     def spider_from_queue(self, record_metrics=False, skip_search_errors=True):
         if record_metrics:
-            timer = RepeatedTimer(60, self.record_metrics)
-            timer.start()
+            # Sends metrics every minute while running, so dashboards stay live
+            reporter = MetricsReporter(self.record_metrics).start()
         try:
-            while True:
-                queue_items = config.spider_queue.receive_messages(
-                    WaitTimeSeconds = config.QUEUE_WAIT,
-                    MaxNumberOfMessages = 10
-                )
-                if queue_items:
-                    for item in queue_items:
-                        body = json.loads(item.body)
-                        range_start_date = datetime.fromisoformat(body['range_start_date'])
-                        range_end_date = datetime.fromisoformat(body['range_end_date'])
-                        search_string = body['search_string']
-                        court = body.get('court')
-                        site = body.get('site')
-                        node = SearchNode(range_start_date, range_end_date, search_string, court, site)
-                        try:
-                            new_cases = node.search(self.session)
-                            self.new_cases += new_cases
-                        except FailedSearch:
-                            if not skip_search_errors:
-                                raise
-                        item.delete()
-                        self.queries += 1
-                else:
-                    logger.info('No items in spider queue.')
-                    break
+            # Prefetch messages in the background, so the next search never waits on the queue
+            with QueueConsumer(config.spider_queue, buffer_size=10) as consumer:
+                for item in consumer:
+                    node = SearchNode.from_message(item.body)
+                    try:
+                        new_cases = node.search(self.session)
+                        self.new_cases += new_cases
+                    except FailedSearch:
+                        if not skip_search_errors:
+                            raise
+                    consumer.delete([item])
+                    self.queries += 1
+            logger.info('No items in spider queue.')
         finally:
             if record_metrics:
-                timer.stop()
-                self.record_metrics()
-                self.report()
+                reporter.stop()
             logger.info(f'Number of queries: {self.queries}')
             logger.info(f'Number of new case numbers: {self.new_cases}')
 
 
-def generate_spider_slices(range_start_date, range_end_date=datetime.now(), court=None, site=None):
+def spider_slices(range_start_date, range_end_date=datetime.now(), court=None, site=None):
     def gen_timeranges(start_date, end_date):
-        for n in range(0,int((end_date - start_date).days),config.SPIDER_DAYS_PER_QUERY):
+        for n in range(0,int((end_date - start_date).days) + 1,config.SPIDER_DAYS_PER_QUERY):
             start = start_date + timedelta(n)
             end = start_date + timedelta(n) + timedelta(config.SPIDER_DAYS_PER_QUERY - 1)
             if end > end_date:
@@ -181,18 +184,46 @@ def generate_spider_slices(range_start_date, range_end_date=datetime.now(), cour
                         'search_string': f'{char1}{char2}',
                     })
                 )
-    
+    return slices
+
+def generate_spider_slices(range_start_date, range_end_date=datetime.now(), court=None, site=None):
+    slices = spider_slices(range_start_date, range_end_date, court, site)
     logger.info(f'Submitting {len(slices)} slices for spidering')
     send_to_queue(config.spider_queue, slices)
 
 
 class SearchNode:    
-    def __init__(self, range_start_date, range_end_date, search_string, court=None, site=None):
+    def __init__(self, range_start_date, range_end_date, search_string, court=None, site=None,
+            spider_queue=None, scraper_queue=None):
         self.range_start_date = range_start_date
         self.range_end_date = range_end_date
         self.court = court
         self.site = site
         self.search_string = search_string
+        # Where child searches and new cases are sent, if not the configured queues
+        self._spider_queue = spider_queue
+        self._scraper_queue = scraper_queue
+
+    @classmethod
+    def from_message(cls, body, spider_queue=None, scraper_queue=None):
+        body = json.loads(body)
+        return cls(
+            datetime.fromisoformat(body['range_start_date']),
+            datetime.fromisoformat(body['range_end_date']),
+            body['search_string'],
+            body.get('court'),
+            body.get('site'),
+            spider_queue,
+            scraper_queue
+        )
+
+    @property
+    def spider_queue(self):
+        return self._spider_queue or config.spider_queue
+
+    @property
+    def scraper_queue(self):
+        return self._scraper_queue or config.scraper_queue
 
     @property
     def id(self):
@@ -208,22 +239,32 @@ class SearchNode:
         try:
             response = self.__get_results(session)
         except FailedSearchTimeout:
+            search_outcomes.inc(outcome='FailedSearchTimeout')
             if self.range_start_date == self.range_end_date:
                 self.__spawn_children()
             else:
                 self.__split()
             return 0
         except CompletedSearchNoResults:
+            search_outcomes.inc(outcome='no_results')
             return 0
+        except FailedSearch as e:
+            search_outcomes.inc(outcome=type(e).__name__)
+            raise
         
+        discovered = datetime.now()
+
         # Parse XML
         try:
             root = ElementTree.fromstring(response.text)
         except ElementTree.ParseError as e:
             logger.warning(f'Failed to parse XML: {e}')
+            search_outcomes.inc(outcome='invalid_xml')
             return 0
 
         rows = [[element.text for element in row] for row in root]
+        search_result_rows.observe(len(rows))
+        search_outcomes.inc(outcome='row_cap' if len(rows) == config.SPIDER_ROW_CAP else 'results')
 
         # Process results
         processed_cases = {}
@@ -237,7 +278,7 @@ class SearchNode:
                         filing_date = None
                 else:
                     filing_date = None
-                case = Case(
+                case = dict(
                     case_number = row[0],
                     court = row[4],
                     case_type = row[5],
@@ -252,7 +293,7 @@ class SearchNode:
         logger.debug(f"Search string {self.search_string} returned {len(rows)} items ({len(processed_cases)} unique)")
 
         new_cases = []
-        with db_session() as db:
+        with db_write_seconds.time(stage='spider'), db_session() as db:
             # See which cases need to be added to DB
             existing_cases = db.scalars(
                 select(Case.case_number)
@@ -261,23 +302,33 @@ class SearchNode:
             new_case_numbers = set(processed_cases.keys()) - set(existing_cases)
             new_cases = [processed_cases[x] for x in new_case_numbers]
 
-            # Save new cases to database
-            db.add_all(new_cases)
-
-            # Then send them to the scraper queue
-            messages = [
-                json.dumps({
-                    'case_number': case.case_number,
-                    'detail_loc': case.detail_loc,
-                    'loc': case.loc
-                }) for case in new_cases
+            # Save new cases to database, marked as enqueued for scraping. Other spiders
+            # can find the same cases concurrently, so only enqueue the ones inserted here.
+            if new_cases:
+                enqueued = datetime.now()
+                new_cases = db.execute(
+                    insert(Case)
+                    .values([dict(case, scrape_enqueued=enqueued) for case in new_cases])
+                    .on_conflict_do_nothing(index_elements=['case_number'])
+                    .returning(Case.case_number, Case.detail_loc, Case.loc)
+                ).all()
+            new_case_records = [
+                {
+                    'case_number': case_number,
+                    'detail_loc': detail_loc,
+                    'loc': loc,
+                    'discovered': discovered.isoformat(),
+                    'enqueued': enqueued.isoformat()
+                } for case_number, detail_loc, loc in new_cases
             ]
-            send_to_queue(config.scraper_queue, messages)
-            
+
+        # Then send them to the scraper queue, once scrapers can see them in the database
+        send_to_queue(self.scraper_queue, scraper_messages(new_case_records))
+
         if len(new_cases) > 0:
             logger.info(f"{self.id} added {len(new_cases)} new cases")
         
-        if len(rows) == 500:
+        if len(rows) == config.SPIDER_ROW_CAP:
             # Procreate!
             self.__spawn_children()
         
@@ -374,7 +425,7 @@ class SearchNode:
                 })
             )
 
-        send_to_queue(config.spider_queue, slices)
+        send_to_queue(self.spider_queue, slices)
         logger.info(f'Submitted {len(slices)} slices for spidering')
 
     def __split(self):
@@ -382,7 +433,7 @@ class SearchNode:
             return
         logger.debug(f'Splitting date range {self.id}')
         range1, range2 = split_date_range(self.range_start_date, self.range_end_date)
-        send_to_queue(config.spider_queue, [
+        send_to_queue(self.spider_queue, [
             json.dumps({
                 'range_start_date': range1[0].isoformat(),
                 'range_end_date': range1[1].isoformat(),
@@ -0,0 +1,60 @@
+'''Tracing cases from discovery to parse.
+
+Scraper queue records carry a case's trace context: when it was discovered
+(new cases only) and when it was enqueued. The scraper stores that with the
+scrape time in case_traces, and the parser fills in when the scrape was
+first parsed, so freshness can be reported per stage.
+'''
+from .models import CaseTrace
+from sqlalchemy import update, text
+from sqlalchemy.dialects.postgresql import insert
+from datetime import datetime
+
+# Stage-to-stage intervals reported by freshness_report
+STAGES = [
+    ('discovered', 'enqueued'),
+    ('enqueued', 'scraped'),
+    ('scraped', 'parsed'),
+    ('discovered', 'parsed'),
+    ('enqueued', 'parsed'),
+]
+
+def trace_context(case):
+    '''The trace timestamps in a scraper queue record'''
+    return {stage: datetime.fromisoformat(case[stage]) for stage in ('discovered', 'enqueued') if case.get(stage)}
+
+def record_scrape(db, case_number, trace, scraped):
+    '''Start a new trace for a scraped case, replacing the previous one'''
+    values = dict(
+        discovered = trace.get('discovered'),
+        enqueued = trace.get('enqueued'),
+        scraped = scraped,
+        parsed = None
+    )
+    db.execute(
+        insert(CaseTrace)
+        .values(case_number=case_number, **values)
+        .on_conflict_do_update(index_elements=['case_number'], set_=values)
+    )
+
+def record_parse(db, case_number, parsed):
+    '''Record the first parse after the traced scrape'''
+    db.execute(
+        update(CaseTrace)
+        .where(CaseTrace.case_number == case_number, CaseTrace.parsed == None, CaseTrace.scraped != None)
+        .values(parsed=parsed)
+    )
+
+def freshness_report(db, since):
+    '''Returns (from stage, to stage, cases, p50 seconds, p95 seconds) for traces scraped since `since`'''
+    report = []
+    for start, end in STAGES:
+        count, p50, p95 = db.execute(text(f'''
+            SELECT count(*), percentile_cont(0.5) WITHIN GROUP (ORDER BY delta), percentile_cont(0.95) WITHIN GROUP (ORDER BY delta)
+            FROM (
+                SELECT extract(epoch FROM {end} - {start}) AS delta FROM case_traces
+                WHERE scraped >= :since AND {start} IS NOT NULL AND {end} IS NOT NULL
+            ) deltas
+        '''), {'since': since}).one()
+        report.append((start, end, count, p50, p95))
+    return report
@@ -1,12 +1,13 @@
-import concurrent.futures
 import logging
 import math
+import random
 import json
 import threading 
 import time
+import os
 from decimal import Decimal
 from datetime import timedelta, datetime
-from sqlalchemy import and_, func, select
+from sqlalchemy import and_, or_, func, select, update
 from sqlalchemy.orm import sessionmaker
 from contextlib import contextmanager
 from .config import config
@@ -14,6 +15,10 @@ from .models import Case, ScrapeVersion, Scrape
 
 logger = logging.getLogger('mjcs')
 
+# Shared session factory. Sessions are bound to config.db_engine when opened,
+# since the engine only exists once config is initialized.
+Session = sessionmaker(future=True)
+
 class RepeatedTimer:
   def __init__(self, interval, function, *args, **kwargs):
     self._timer = None
@@ -40,6 +45,31 @@ class RepeatedTimer:
     self._timer.cancel()
     self.is_running = False
 
+class Checkpoint:
+    '''Persists the last completed value of an ordered scan, so it can be resumed'''
+    def __init__(self, path=None, interval=5):
+        self.path = path
+        self.interval = interval # seconds between saves
+        self.value = None
+        self.last_save = time.time()
+        if path and os.path.exists(path):
+            with open(path) as f:
+                self.value = f.read().strip() or None
+
+    def update(self, value):
+        self.value = value
+        if time.time() - self.last_save >= self.interval:
+            self.save()
+
+    def save(self):
+        if not self.path or self.value is None:
+            return
+        tmp_path = f'{self.path}.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write(self.value)
+        os.replace(tmp_path, self.path)
+        self.last_save = time.time()
+
 class NoItemsInQueue(Exception):
     pass
 
@@ -51,38 +81,96 @@ class JSONDatetimeEncoder(json.JSONEncoder):
         if isinstance(obj, datetime):
             return obj.isoformat()
 
-# Concurrently fetch up to nitems (or 100) messages from queue, 10 per thread
-def fetch_from_queue(queue, nitems=100):
-    if not nitems:
-        nitems = 100
-    def queue_receive(n):
-        return queue.receive_messages(
-            WaitTimeSeconds = config.QUEUE_WAIT,
-            MaxNumberOfMessages = n
-        )
+# SQS limits for a single SendMessageBatch request
+SQS_BATCH_MAX_ENTRIES = 10
+SQS_BATCH_MAX_BYTES = 256 * 1024
 
-    queue_items = []
-    q,r = divmod(nitems,10)
-    nitems_per_thread = [10 for _ in range(0,q)]
-    if r:
-        nitems_per_thread.append(r)
-    with concurrent.futures.ThreadPoolExecutor(max_workers=len(nitems_per_thread)) as executor:
-        results = executor.map(queue_receive,nitems_per_thread)
-        for result in results:
-            if result:
-                queue_items += result
-    return queue_items
+class QueueSendError(Exception):
+    pass
+
+def pack_batches(items):
+    '''Group message bodies into batches within the SQS entry count and payload size limits'''
+    batch = []
+    batch_bytes = 0
+    for item in items:
+        size = len(item.encode('utf-8'))
+        if size > SQS_BATCH_MAX_BYTES:
+            raise QueueSendError(f'Message of {size} bytes exceeds the SQS payload limit')
+        if batch and (len(batch) == SQS_BATCH_MAX_ENTRIES or batch_bytes + size > SQS_BATCH_MAX_BYTES):
+            yield batch
+            batch = []
+            batch_bytes = 0
+        batch.append(item)
+        batch_bytes += size
+    if batch:
+        yield batch
+
+def send_batch(client, queue_url, batch):
+    '''Send one batch of messages to SQS, retrying entries that fail with exponential backoff'''
+    entries = {str(idx): item for idx, item in enumerate(batch)}
+    for attempt in range(config.QUEUE_SEND_RETRIES + 1):
+        response = client.send_message_batch(
+            QueueUrl=queue_url,
+            Entries=[{'Id': id, 'MessageBody': body} for id, body in entries.items()]
+        )
+        failed = response.get('Failed', [])
+        if not failed:
+            return len(batch)
+        sender_faults = [f for f in failed if f.get('SenderFault')]
+        if sender_faults:
+            raise QueueSendError(f'Failed to send messages: {sender_faults}')
+        delay = min(0.1 * 2 ** attempt, 10) * (0.5 + random.random())
+        logger.debug(f'{len(failed)} of {len(entries)} messages failed to send, retrying in {delay:.2f}s')
+        entries = {f['Id']: entries[f['Id']] for f in failed}
+        time.sleep(delay)
+    raise QueueSendError(f'Failed to send {len(entries)} messages after {config.QUEUE_SEND_RETRIES} retries')
 
 def send_to_queue(queue, items):
-    # Can only send <= 10 items at a time
-    for i in range(0, len(items), 10):
-        Entries = [
-            {
-                'Id': str(idx),
-                'MessageBody': item
-            } for idx, item in enumerate(items[i:i + 10])
-        ]
-        queue.send_messages(Entries=Entries)
+    '''Send message bodies to a queue (see mjcs.queues), returning the number sent'''
+    return queue.send(items)
+
+def claim_for_scraping(db, case_numbers):
+    '''Mark cases as enqueued for scraping, skipping ones that are already in the scraper
+    queue, and return scraper queue records for the cases that were claimed.
+
+    A case counts as enqueued until it is scraped, its scrape fails (see release_from_scraping)
+    or SCRAPE_ENQUEUE_WINDOW hours pass.
+    '''
+    if not case_numbers:
+        return []
+    now = datetime.now()
+    claimed = db.execute(
+        update(Case)
+        .where(
+            Case.case_number.in_(case_numbers),
+            or_(
+                Case.scrape_enqueued == None,
+                Case.last_scrape >= Case.scrape_enqueued,
+                Case.scrape_enqueued < now - timedelta(hours=config.SCRAPE_ENQUEUE_WINDOW)
+            )
+        )
+        .values(scrape_enqueued=now)
+        .returning(Case.case_number, Case.detail_loc, Case.loc)
+        .execution_options(synchronize_session=False)
+    ).all()
+    return [
+        {
+            'case_number': case_number,
+            'detail_loc': detail_loc,
+            'loc': loc,
+            'enqueued': now.isoformat()
+        } for case_number, detail_loc, loc in claimed
+    ]
+
+def release_from_scraping(db, case_numbers):
+    '''Clear the enqueued mark of cases that left the scraper queue without being scraped,
+    so they can be claimed again right away'''
+    db.execute(
+        update(Case)
+        .where(Case.case_number.in_(case_numbers))
+        .values(scrape_enqueued=None)
+        .execution_options(synchronize_session=False)
+    )
 
 def total_cases(db):
     return db.scalar(select(func.count()).select_from(Case))
@@ -98,10 +186,13 @@ def get_detail_loc(case_number):
 @contextmanager
 def db_session():
     """Provide a transactional scope around a series of operations."""
-    Session = sessionmaker(bind=config.db_engine, future=True)
-    with Session.begin() as session:
+    with Session(bind=config.db_engine) as session, session.begin():
         yield session
 
+def log_db_pool_metrics(level=logging.INFO):
+    metrics = config.db_engine.pool.metrics()
+    logger.log(level, 'Database pool: ' + ', '.join(f'{k}={v:.1f}' if isinstance(v, float) else f'{k}={v}' for k, v in metrics.items()))
+
 def delete_latest_scrape(db, case_number):
     versions = db.scalars(
         select(ScrapeVersion.s3_version_id)
@@ -187,10 +278,11 @@ def decimal_to_float(obj):
     return obj
 
 def get_queue_count(queue):
-    queue.load()
-    return int(queue.attributes['ApproximateNumberOfMessages'])
+    return queue.count()
 
 def get_model_list(module):
+    if hasattr(module, 'load_all'):
+        module.load_all()  # case type models are loaded lazily
     class_list = [cls for name, cls in module.__dict__.items() if isinstance(cls, type) and hasattr(cls, '__table__')]
     class_list = [x for x in set(class_list)]  # Remove duplicates
     return class_list
@@ -201,6 +293,7 @@ def get_root_model_list(module):
 
 def get_orm_class_by_name(table_name):
     from . import models
+    models.load_all()
     model_map = {cls.__table__.name: cls for name, cls in models.__dict__.items() if isinstance(cls, type) and hasattr(cls, '__table__')}
     try:
         return model_map[table_name]